@@ -17,11 +17,44 @@ public:
 };
 
 
-void evolve_propagator_CPP(const PulseSequence & pulseSeq, const SystemParams & systemParams, const int & simType, cdouble * totPropPtr){
+void TrajectoryRecorder::record(const Mapcd & totProp, const double & curTime){
+	/*
+	 * Record the state for the propagator so far.
+	 * The numpy (row-major) data is seen transposed here so we work with the transposed state rhoT; this way the states are written back
+	 * in numpy's order and the propagator is applied the same way Python applies the one evolve_propagator_CPP returns.
+	 */
+	if (numRecords >= maxRecords) return;
+
+	MatrixXcd rhoT;
+	if (simType == 0){
+		rhoT = totProp.adjoint()*rhoIn*totProp;
+	}
+	else{
+		//Column-stack the state, propagate and reshape
+		MatrixXcd rhoInT = rhoIn.transpose();
+		VectorXcd rhoVec = totProp.transpose()*Map<VectorXcd>(rhoInT.data(), dim*dim);
+		rhoT = Map<MatrixXcd>(rhoVec.data(), dim, dim).transpose();
+	}
+
+	timesPtr[numRecords] = curTime;
+	if (observablePtrs.size() > 0){
+		//Tr(O rho) as an elementwise product
+		for (size_t obsct = 0; obsct < observablePtrs.size(); ++obsct) {
+			expectsPtr[numRecords*observablePtrs.size() + obsct] = real(rhoT.cwiseProduct(Mapcd(observablePtrs[obsct], dim, dim).transpose()).sum());
+		}
+	}
+	else{
+		Mapcd(statesPtr + numRecords*dim*dim, dim, dim) = rhoT;
+	}
+	++numRecords;
+}
+
+void evolve_propagator_CPP(const PulseSequence & pulseSeq, const SystemParams & systemParams, const int & simType, cdouble * totPropPtr, TrajectoryRecorder * recorder){
 	/*
 	 * Propagate evolution through a pulse sequence.
 	 * It is assumed that the totPropPtr points to memory initialized to the initial condition
 	 * The simType defines whether we do unitary (0) or lindbladian (1) evolution
+	 * If given a recorder we record the initial state and then on its decimation as we go
 	 */
 
 	//Some shorthand for the system dimension and dimension squared
@@ -74,6 +107,8 @@ void evolve_propagator_CPP(const PulseSequence & pulseSeq, const SystemParams &
 	//The total time through the pulse sequence
 	double curTime = 0.0;
 
+	if (recorder != NULL) recorder->record(totProp, curTime);
+
 	for (size_t timect = 0; timect < pulseSeq.numTimeSteps; ++timect) {
 		//Time in this timestep
 		double tmpTime = 0.0;
@@ -121,7 +156,10 @@ void evolve_propagator_CPP(const PulseSequence & pulseSeq, const SystemParams &
 			//Update the times
 			tmpTime += subTimeStep;
 			curTime += subTimeStep;
+
+			if (recorder != NULL) recorder->sub_step(totProp, curTime);
 		}
+		if (recorder != NULL) recorder->end_time_step(totProp, curTime);
 	}
 }
 
@@ -131,7 +169,12 @@ double eval_pulse_fitness(const OptimParams & optimParams, const PropResults & p
 	switch (optimParams.optimType) {
 		//Unitary
 		case 0: {
-			tmpResult = abs(optimParams.Ugoal.conjugate().cwiseProduct(propResults.totU).sum());
+			if (optimParams.has_subspace()) {
+				tmpResult = abs(optimParams.UgoalSubspace.conjugate().cwiseProduct(propResults.totU).sum());
+			}
+			else {
+				tmpResult = abs(optimParams.Ugoal.conjugate().cwiseProduct(propResults.totU).sum());
+			}
 			fitness = (tmpResult*tmpResult)/optimParams.dimC2;
 			break;
 		}
@@ -169,8 +212,13 @@ void opt_evolve_propagator_CPP(const OptimParams & optimParams, const SystemPara
 		new (&H_int) Mapcd(optimParams.H_intPtr, dim, dim);
 	}
 
-	//Initialize the total unitary to the identity
-	propResults.Uforward[0].setIdentity();
+	//Initialize the total unitary to the identity or the subspace columns
+	if (optimParams.has_subspace()) {
+		propResults.Uforward[0] = optimParams.subspaceBasis;
+	}
+	else {
+		propResults.Uforward[0] = MatrixXcd::Identity(dim,dim);
+	}
 
 	//Loop over each timestep in the sequence
     double curTime = 0.0;
@@ -180,7 +228,7 @@ void opt_evolve_propagator_CPP(const OptimParams & optimParams, const SystemPara
     	Htot = (optimParams.H_intPtr != NULL) ? move2interaction_frame(H_int, curTime, Hnat) : Hnat;
     	//Add each of the control Hamiltonians
     	for (size_t controlct = 0; controlct < optimParams.numControlLines; ++controlct) {
-    		Htot += controlAmps(controlct,timect)*Map<MatrixXcd>(controlHams_int[controlct][timect], dim, dim);
+    		Htot += systemParams.ampScale*controlAmps(controlct,timect)*Map<MatrixXcd>(controlHams_int[controlct][timect], dim, dim);
     	}
 
     	//Propagate the unitary
@@ -208,7 +256,12 @@ void eval_derivs(const OptimParams & optimParams, const SystemParams & systemPar
 	switch (optimParams.optimType) {
 		//Unitary
 		case 0:
-			propResults.Uback.back() = optimParams.Ugoal;
+			if (optimParams.has_subspace()) {
+				propResults.Uback.back() = optimParams.UgoalSubspace;
+			}
+			else {
+				propResults.Uback.back() = optimParams.Ugoal;
+			}
 			break;
 		//state2state
 		case 1:
@@ -226,23 +279,25 @@ void eval_derivs(const OptimParams & optimParams, const SystemParams & systemPar
 	switch (optimParams.optimType) {
 		//Unitary optimization
 		case 0: {
-			cdouble curOverlap = (propResults.totU.conjugate().cwiseProduct(optimParams.Ugoal)).sum();
+			cdouble curOverlap = (propResults.totU.conjugate().cwiseProduct(propResults.Uback.back())).sum();
 			for (size_t timect = 0; timect < optimParams.numTimeSteps; ++timect) {
 				//Put the Hz to rad conversion in the timestep
 				double tmpTimeStep = TWOPI*timeSteps(timect);
 				for (size_t controlct = 0; controlct < optimParams.numControlLines; ++controlct) {
-					MatrixXcd dUjdUk;
+					//The derivative of the step applied to the forward evolution before it.  We multiply onto the (subspace) columns from the right
+					//so with a subspace of k columns the products are dim x dim x k.
+					MatrixXcd dUjdUkForward;
 					switch (optimParams.derivType) {
 						//Finite difference approach
 						case 0: {
 							MatrixXcd tmpU1 = expm_eigen(propResults.totHams[timect] + 1e-6*Map<MatrixXcd>(controlHams_int[controlct][timect],dim,dim), -1j*tmpTimeStep);
 							MatrixXcd tmpU2 = expm_eigen(propResults.totHams[timect] - 1e-6*Map<MatrixXcd>(controlHams_int[controlct][timect],dim,dim), -1j*tmpTimeStep);
-							dUjdUk = (tmpU1-tmpU2)/2e-6;
+							dUjdUkForward = ((tmpU1-tmpU2)/2e-6)*propResults.Uforward[timect];
 							break;
 						}
 						//Approximate gradients
 						case 1:
-							dUjdUk = -i*tmpTimeStep*Map<MatrixXcd>(controlHams_int[controlct][timect],dim,dim)*propResults.Us[timect];
+							dUjdUkForward = -i*tmpTimeStep*Map<MatrixXcd>(controlHams_int[controlct][timect],dim,dim)*propResults.Uforward[timect+1];
 							break;
 
 						//Exact gradients
@@ -266,7 +321,7 @@ void eval_derivs(const OptimParams & optimParams, const SystemParams & systemPar
 								}
 							}
 							//Convert back to the standard basis
-							dUjdUk = propResults.Vs[timect]*eigenFrameDeriv*propResults.Vs[timect].adjoint();
+							dUjdUkForward = propResults.Vs[timect]*(eigenFrameDeriv*(propResults.Vs[timect].adjoint()*propResults.Uforward[timect]));
 							break;
 						}
 						default: {
@@ -275,7 +330,7 @@ void eval_derivs(const OptimParams & optimParams, const SystemParams & systemPar
 						}
 					}
 
-					derivsMat(controlct, timect) = (2.0/optimParams.dimC2)*(propResults.Uback[timect].conjugate().cwiseProduct(dUjdUk*propResults.Uforward[timect]).sum()*curOverlap).real();
+					derivsMat(controlct, timect) = (2.0/optimParams.dimC2)*(propResults.Uback[timect].conjugate().cwiseProduct(dUjdUkForward).sum()*curOverlap).real();
 
 				}
 			}
@@ -309,6 +364,71 @@ void eval_derivs(const OptimParams & optimParams, const SystemParams & systemPar
 
 	}
 
+	//Chain rule for any control amplitude scaling
+	derivsMat *= systemParams.ampScale;
+
+}
+
+double eval_pulse_ensemble(const OptimParams & optimParams, const std::vector<SystemParams *> & systemParams, const std::vector<cdouble ***> & controlHams_int, std::vector<PropResults *> & propResults, const std::vector<double> & weights){
+	/*
+	 * Weighted fitness over an ensemble of systems.  Each member has its own propResults so the members can be evolved in parallel.
+	 */
+	double fitness = 0.0;
+	const int numMembers = systemParams.size();
+#pragma omp parallel for reduction(+:fitness) schedule(dynamic)
+	for (int memberct = 0; memberct < numMembers; ++memberct) {
+		opt_evolve_propagator_CPP(optimParams, *systemParams[memberct], controlHams_int[memberct], *propResults[memberct]);
+		fitness += weights[memberct]*eval_pulse_fitness(optimParams, *propResults[memberct]);
+	}
+	return fitness;
+}
+
+void eval_derivs_ensemble(const OptimParams & optimParams, const std::vector<SystemParams *> & systemParams, const std::vector<cdouble ***> & controlHams_int, std::vector<PropResults *> & propResults, const std::vector<double> & weights, double * derivsPtr){
+	/*
+	 * Weighted derivatives over an ensemble of systems.  Each member writes into its own derivative matrix which are summed at the end.
+	 */
+	const int numMembers = systemParams.size();
+	std::vector<MatrixXd> memberDerivs(numMembers);
+#pragma omp parallel for schedule(dynamic)
+	for (int memberct = 0; memberct < numMembers; ++memberct) {
+		memberDerivs[memberct] = MatrixXd::Zero(optimParams.numControlLines, optimParams.numTimeSteps);
+		eval_derivs(optimParams, *systemParams[memberct], controlHams_int[memberct], *propResults[memberct], memberDerivs[memberct].data());
+	}
+
+	Map<MatrixXd> derivsMat(derivsPtr, optimParams.numControlLines, optimParams.numTimeSteps);
+	derivsMat.setZero();
+	for (int memberct = 0; memberct < numMembers; ++memberct) {
+		derivsMat += weights[memberct]*memberDerivs[memberct];
+	}
 }
 
+void eval_pulse_batch(const OptimParams & optimParams, const SystemParams & systemParams, cdouble *** controlHams_int, std::vector<PropResults *> & propResults, double * pulsesPtr, const size_t & numCandidates, double * fitnessPtr){
+	/*
+	 * Fitness of a population of pulses (numCandidates x numControlLines x numTimeSteps row-major) for the population optimizers.
+	 * Each thread works through the candidates with its own copy of the optimization parameters and its own propResults.
+	 */
+	const size_t pulseSize = optimParams.numControlLines*optimParams.numTimeSteps;
+	const int numCandidatesInt = numCandidates;
+#pragma omp parallel num_threads(propResults.size())
+	{
+		int threadct = 0;
+#ifdef _OPENMP
+		threadct = omp_get_thread_num();
+#endif
+		OptimParams candidateParams(optimParams);
+#pragma omp for schedule(dynamic)
+		for (int candidatect = 0; candidatect < numCandidatesInt; ++candidatect) {
+			candidateParams.controlAmpsPtr = pulsesPtr + candidatect*pulseSize;
+			opt_evolve_propagator_CPP(candidateParams, systemParams, controlHams_int, *propResults[threadct]);
+			fitnessPtr[candidatect] = eval_pulse_fitness(candidateParams, *propResults[threadct]);
+		}
+	}
+}
 
+size_t max_threads(){
+#ifdef _OPENMP
+	return omp_get_max_threads();
+#else
+	return 1;
+#endif
+}
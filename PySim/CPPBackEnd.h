@@ -15,7 +15,12 @@
 #include <Eigen/StdVector>
 #include <unsupported/Eigen/MatrixFunctions>
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
 using Eigen::MatrixXcd;
+using Eigen::VectorXcd;
 
 using Eigen::VectorXd;
 using Eigen::MatrixXd;
@@ -71,6 +76,10 @@ public:
 	std::vector<ControlHam> controlHams;
 	std::vector<cdouble *> dissipatorPtrs;
 	cdouble * HnatPtr;
+	//Scaling of the control amplitudes (used to model drive amplitude drift in ensemble optimization)
+	double ampScale;
+
+	SystemParams() : ampScale(1.0) {};
 };
 
 class OptimParams : public PulseSequence {
@@ -81,6 +90,10 @@ public:
 	Mapcd Ugoal;
 	Mapcd rhoStart;
 	Mapcd rhoGoal;
+	//Optional orthonormal basis (dim x k) of the subspace a unitary goal is defined on: only these columns are propagated
+	MatrixXcd subspaceBasis;
+	//The goal columns on the subspace (Ugoal*subspaceBasis)
+	MatrixXcd UgoalSubspace;
 
 	OptimParams(cdouble * UgoalPtr, cdouble * rhoStartPtr, cdouble * rhoGoalPtr, size_t dim, size_t dimC2In) : Ugoal(NULL,0,0), rhoStart(NULL,0,0), rhoGoal(NULL,0,0), dimC2(dimC2In) {
 		if (UgoalPtr != NULL){
@@ -93,6 +106,15 @@ public:
 			new (&rhoGoal) Mapcd(rhoGoalPtr,dim,dim);
 		}
 	};
+
+	void set_subspace(cdouble * subspaceBasisPtr, size_t numCols){
+		subspaceBasis = Mapcd(subspaceBasisPtr, Ugoal.rows(), numCols);
+		UgoalSubspace = Ugoal*subspaceBasis;
+	};
+
+	bool has_subspace() const {
+		return subspaceBasis.size() > 0;
+	};
 };
 
 //Class for holding intermediate propagator evolution results
@@ -106,11 +128,11 @@ public:
 	std::vector<MatrixXcd> Vs;
 	//The unitary of each time step
 	std::vector<MatrixXcd> Us;
-	//The unitary after each time step
+	//The unitary after each time step (only the subspace columns if there is one)
 	std::vector<MatrixXcd> Uforward;
-	//The reverse-time unitary up to each time step
+	//The reverse-time unitary up to each time step (only the subspace columns if there is one)
 	std::vector<MatrixXcd> Uback;
-	//The total unitary
+	//The total unitary (only the subspace columns if there is one)
 	MatrixXcd totU;
 
 	//Constructor initializes all the memory given the number of timesteps and the system dimensions
@@ -131,13 +153,50 @@ public:
 };
 
 
+//Class for recording the expectation values of observables (or the state) along an evolution
+class TrajectoryRecorder{
+public:
+	int simType;
+	size_t dim;
+	//The input state
+	Mapcd rhoIn;
+	//The observables to record (if there are none we record the state)
+	std::vector<cdouble *> observablePtrs;
+	//Record every decimation sub-steps or, if byPixel, every decimation time steps
+	size_t decimation;
+	bool byPixel;
+	//Preallocated output: maxRecords times, maxRecords x numObservables expectation values (row-major) or maxRecords states
+	size_t maxRecords;
+	double * timesPtr;
+	double * expectsPtr;
+	cdouble * statesPtr;
+	size_t numRecords;
+	size_t stepct;
+
+	TrajectoryRecorder(int simTypeIn, size_t dimIn, cdouble * rhoInPtr, std::vector<cdouble *> observablePtrsIn, size_t decimationIn, bool byPixelIn,
+			size_t maxRecordsIn, double * timesPtrIn, double * expectsPtrIn, cdouble * statesPtrIn) :
+		simType(simTypeIn), dim(dimIn), rhoIn(rhoInPtr, dimIn, dimIn), observablePtrs(observablePtrsIn), decimation(decimationIn), byPixel(byPixelIn),
+		maxRecords(maxRecordsIn), timesPtr(timesPtrIn), expectsPtr(expectsPtrIn), statesPtr(statesPtrIn), numRecords(0), stepct(0) {};
+
+	//Record the state for the propagator so far
+	void record(const Mapcd &, const double &);
+
+	//Called after each sub-step and at the end of each time step to record on the decimation
+	void sub_step(const Mapcd & totProp, const double & curTime){
+		if (!byPixel && (++stepct % decimation == 0)) record(totProp, curTime);
+	};
+	void end_time_step(const Mapcd & totProp, const double & curTime){
+		if (byPixel && (++stepct % decimation == 0)) record(totProp, curTime);
+	};
+};
+
 
 #include "HelperFunctions.h"
 
 //Forward declarations of the functions
 
-//Simulation evolution
-void evolve_propagator_CPP(const PulseSequence &, const SystemParams &, const int &,  cdouble *);
+//Simulation evolution (optionally recording the trajectory)
+void evolve_propagator_CPP(const PulseSequence &, const SystemParams &, const int &,  cdouble *, TrajectoryRecorder * recorder = NULL);
 
 
 //Optimization evolution (returns all intermediate steps and has precalculated interaction frame control Hamiltonians)
@@ -149,5 +208,16 @@ void eval_derivs(const OptimParams & optimParams, const SystemParams & systemPar
 //Helper function to calculate the fitness of a simulated unitary
 double eval_pulse_fitness(const OptimParams &, const PropResults &);
 
+//Ensemble versions that evaluate the weighted fitness and derivatives over system variants in parallel
+double eval_pulse_ensemble(const OptimParams &, const std::vector<SystemParams *> &, const std::vector<cdouble ***> &, std::vector<PropResults *> &, const std::vector<double> &);
+
+void eval_derivs_ensemble(const OptimParams &, const std::vector<SystemParams *> &, const std::vector<cdouble ***> &, std::vector<PropResults *> &, const std::vector<double> &, double *);
+
+//Batched fitness of a population of pulses evaluated in parallel with one propResults per thread
+void eval_pulse_batch(const OptimParams &, const SystemParams &, cdouble ***, std::vector<PropResults *> &, double *, const size_t &, double *);
+
+//Number of threads the parallel evaluators will use
+size_t max_threads();
+
 
 #endif /* CPPBACKEND_H__ */
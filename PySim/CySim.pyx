@@ -2,13 +2,18 @@
 #cython: wraparound=False
 
 from libcpp.vector cimport vector
+from libcpp cimport bool
 cimport numpy as np
 import numpy as np
 from cython.operator cimport dereference as deref
 from libc.stdlib cimport malloc, free
 
+#Pointer to the interaction frame control Hamiltonians: numControlHams x numTimeSteps array of pointers to the matrix data 
+ctypedef complex *** ControlHamsPtr
+
 #Load some classes and functions from the C++ backend.  We use these classes for passing data back and forth between Python and C++
-cdef extern from "CPPBackEnd.h":
+#The C++ functions don't touch any Python objects so we release the GIL around them to let optimizations run in parallel threads.
+cdef extern from "CPPBackEnd.h" nogil:
     cdef cppclass ControlLine:
         double freq
         double phase
@@ -33,9 +38,11 @@ cdef extern from "CPPBackEnd.h":
         vector[ControlHam] controlHams
         complex * HnatPtr
         vector[complex *] dissipatorPtrs
+        double ampScale
         
     cdef cppclass OptimParams(PulseSequence):
         OptimParams(complex *, complex *, complex *, size_t, size_t)
+        void set_subspace(complex *, size_t)
         size_t dimC2
         int derivType
         int optimType
@@ -43,8 +50,11 @@ cdef extern from "CPPBackEnd.h":
     cdef cppclass PropResults:
         PropResults(size_t, size_t)
         
+    cdef cppclass TrajectoryRecorder:
+        TrajectoryRecorder(int, size_t, complex *, vector[complex *], size_t, bool, size_t, double *, double *, complex *)
+        size_t numRecords
 
-    void evolve_propagator_CPP(PulseSequence, SystemParams, int, complex * )
+    void evolve_propagator_CPP(PulseSequence, SystemParams, int, complex *, TrajectoryRecorder *)
 
     void opt_evolve_propagator_CPP(OptimParams, SystemParams, complex ***, PropResults)
 
@@ -52,6 +62,14 @@ cdef extern from "CPPBackEnd.h":
 
     double eval_pulse_fitness(OptimParams, PropResults)
 
+    double eval_pulse_ensemble(OptimParams, vector[SystemParams *], vector[ControlHamsPtr], vector[PropResults *], vector[double])
+
+    void eval_derivs_ensemble(OptimParams, vector[SystemParams *], vector[ControlHamsPtr], vector[PropResults *], vector[double], double *)
+
+    void eval_pulse_batch(OptimParams, SystemParams, complex ***, vector[PropResults *], double *, size_t, double *)
+
+    size_t max_threads()
+
 
 
 #Python versions of the classes that will be accessible from Python. 
@@ -90,8 +108,9 @@ cdef class PyPulseSequence(object):
         
 cdef class PySystemParams(object):
     cdef SystemParams *thisPtr
-    def __cinit__(self, systemParamsIn):
+    def __cinit__(self, systemParamsIn, ampScale=1.0):
         self.thisPtr = new SystemParams()
+        self.thisPtr.ampScale = ampScale
         #Error check for data ordering
         assert systemParamsIn.Hnat.matrix.flags['C_CONTIGUOUS'], "Uhoh! We need row-major ordering for Hnat for passing data to C++. Use np.copy(order='C')."
         self.thisPtr.HnatPtr = <complex *> np.PyArray_DATA(systemParamsIn.Hnat.matrix)
@@ -179,6 +198,11 @@ cdef class PyOptimParams(object):
         self.thisPtr.derivType = derivTypeMap[optimParamsIn.derivType]
         optimTypeMap = {'unitary':0, 'state2state':1}
         self.thisPtr.optimType = optimTypeMap[optimParamsIn.optimType]
+        #The C++ side keeps its own copy of the subspace basis
+        cdef np.ndarray subspaceBasis
+        if optimParamsIn.subspaceBasis is not None:
+            subspaceBasis = np.ascontiguousarray(optimParamsIn.subspaceBasis, dtype=np.complex128)
+            self.thisPtr.set_subspace(<complex *> subspaceBasis.data, subspaceBasis.shape[1])
 
     def __dealloc__(self):
         del self.thisPtr   
@@ -200,24 +224,106 @@ cdef class PyPropResults:
         del self.thisPtr                                                        
     
 
+#One set of propagator storage for each C++ thread for evaluating a population of pulses in parallel
+cdef class PyPropResultsPool(object):
+    cdef vector[PropResults *] propResultsPtrs
+    cdef object members
+    def __init__(self, numTimeSteps, dim):
+        cdef PyPropResults tmpPropResults
+        #Hold on to the Python objects so the pointers stay valid
+        self.members = [PyPropResults(numTimeSteps, dim) for _ in range(max_threads())]
+        for tmpPropResults in self.members:
+            self.propResultsPtrs.push_back(tmpPropResults.thisPtr)
+
+
+#Hold the C++ pointers for each member of an ensemble optimization.  Members can share the same PyControlHams_int. 
+cdef class PyEnsemble(object):
+    cdef vector[SystemParams *] systemParamsPtrs
+    cdef vector[ControlHamsPtr] controlHamsPtrs
+    cdef vector[PropResults *] propResultsPtrs
+    cdef vector[double] weights
+    cdef object members
+    def __init__(self, systemParamsList, controlHamsList, propResultsList, weights):
+        cdef PySystemParams tmpSystemParams
+        cdef PyControlHams_int tmpControlHams
+        cdef PyPropResults tmpPropResults
+        #Hold on to the Python objects so the pointers stay valid
+        self.members = (systemParamsList, controlHamsList, propResultsList)
+        for tmpSystemParams, tmpControlHams, tmpPropResults, weight in zip(systemParamsList, controlHamsList, propResultsList, weights):
+            self.systemParamsPtrs.push_back(tmpSystemParams.thisPtr)
+            self.controlHamsPtrs.push_back(tmpControlHams.dataPtrs)
+            self.propResultsPtrs.push_back(tmpPropResults.thisPtr)
+            self.weights.push_back(weight)
+
+
 #Pass-thru function to evaluate the goodness of a pulse
 def Cy_eval_pulse(PyOptimParams optimParamsIn, PySystemParams systemParamsIn, PyControlHams_int controlHams_int, PyPropResults propResults):
-    #Pass everything through to the C++ function
-    opt_evolve_propagator_CPP(deref(optimParamsIn.thisPtr), deref(systemParamsIn.thisPtr), controlHams_int.dataPtrs, deref(propResults.thisPtr))
-    
-    #Calculate the goodness
-    return eval_pulse_fitness(deref(optimParamsIn.thisPtr), deref(propResults.thisPtr))
+    cdef OptimParams * optimParamsPtr = optimParamsIn.thisPtr
+    cdef SystemParams * systemParamsPtr = systemParamsIn.thisPtr
+    cdef complex *** controlHamsPtrs = controlHams_int.dataPtrs
+    cdef PropResults * propResultsPtr = propResults.thisPtr
+    cdef double fitness
+    with nogil:
+        #Pass everything through to the C++ function
+        opt_evolve_propagator_CPP(deref(optimParamsPtr), deref(systemParamsPtr), controlHamsPtrs, deref(propResultsPtr))
+        
+        #Calculate the goodness
+        fitness = eval_pulse_fitness(deref(optimParamsPtr), deref(propResultsPtr))
+    return fitness
 
 #Pass-thru function to evaluate the derivatives of a pulse
 def Cy_eval_derivs(PyOptimParams optimParamsIn, PySystemParams systemParamsIn, PyControlHams_int controlHams_int, PyPropResults propResults):
     #Allocate space for the derivatives
     derivs = np.zeros((controlHams_int.numControlHams, controlHams_int.numTimeSteps), dtype=np.float64) 
     
+    cdef OptimParams * optimParamsPtr = optimParamsIn.thisPtr
+    cdef SystemParams * systemParamsPtr = systemParamsIn.thisPtr
+    cdef complex *** controlHamsPtrs = controlHams_int.dataPtrs
+    cdef PropResults * propResultsPtr = propResults.thisPtr
+    cdef double * derivsPtr = <double*> np.PyArray_DATA(derivs)
+    
     #Pass on to the C++ function
-    eval_derivs(deref(optimParamsIn.thisPtr), deref(systemParamsIn.thisPtr), controlHams_int.dataPtrs, deref(propResults.thisPtr), <double*> np.PyArray_DATA(derivs))
+    with nogil:
+        eval_derivs(deref(optimParamsPtr), deref(systemParamsPtr), controlHamsPtrs, deref(propResultsPtr), derivsPtr)
             
     return -derivs.flatten()
 
+#Pass-thru function to evaluate the weighted goodness of a pulse over an ensemble
+def Cy_eval_pulse_ensemble(PyOptimParams optimParamsIn, PyEnsemble ensemble):
+    cdef OptimParams * optimParamsPtr = optimParamsIn.thisPtr
+    cdef double fitness
+    with nogil:
+        fitness = eval_pulse_ensemble(deref(optimParamsPtr), ensemble.systemParamsPtrs, ensemble.controlHamsPtrs, ensemble.propResultsPtrs, ensemble.weights)
+    return fitness
+
+#Pass-thru function to evaluate the weighted derivatives of a pulse over an ensemble
+def Cy_eval_derivs_ensemble(PyOptimParams optimParamsIn, PyEnsemble ensemble):
+    #Allocate space for the derivatives
+    derivs = np.zeros((optimParamsIn.thisPtr.numControlLines, optimParamsIn.thisPtr.numTimeSteps), dtype=np.float64) 
+    
+    cdef OptimParams * optimParamsPtr = optimParamsIn.thisPtr
+    cdef double * derivsPtr = <double*> np.PyArray_DATA(derivs)
+    with nogil:
+        eval_derivs_ensemble(deref(optimParamsPtr), ensemble.systemParamsPtrs, ensemble.controlHamsPtrs, ensemble.propResultsPtrs, ensemble.weights, derivsPtr)
+    
+    return -derivs.flatten()
+
+#Pass-thru function to evaluate the goodness of a population of pulses (numCandidates x numControlLines*numTimeSteps) in parallel
+def Cy_eval_pulse_batch(PyOptimParams optimParamsIn, PySystemParams systemParamsIn, PyControlHams_int controlHams_int, PyPropResultsPool propResultsPool, pulsesIn):
+    cdef np.ndarray pulses = np.ascontiguousarray(pulsesIn, dtype=np.float64)
+    cdef np.ndarray fitness = np.zeros(pulses.shape[0], dtype=np.float64)
+    cdef OptimParams * optimParamsPtr = optimParamsIn.thisPtr
+    cdef SystemParams * systemParamsPtr = systemParamsIn.thisPtr
+    cdef complex *** controlHamsPtrs = controlHams_int.dataPtrs
+    cdef double * pulsesPtr = <double*> pulses.data
+    cdef double * fitnessPtr = <double*> fitness.data
+    cdef size_t numCandidates = pulses.shape[0]
+    
+    with nogil:
+        eval_pulse_batch(deref(optimParamsPtr), deref(systemParamsPtr), controlHamsPtrs, propResultsPool.propResultsPtrs, pulsesPtr, numCandidates, fitnessPtr)
+    
+    return fitness
+
 #Pass-thru function to evaluate the evolution propagator for either unitary or lindblad.
 def Cy_evolution(pulseSeqIn, systemParamsIn, simType):
     
@@ -232,11 +338,49 @@ def Cy_evolution(pulseSeqIn, systemParamsIn, simType):
     cdef np.ndarray totProp
     if simType == 'unitary':
         totProp = np.eye(systemParamsIn.dim, dtype=np.complex128)
-        evolve_propagator_CPP(deref(pulseSeq.thisPtr), deref(systemParams.thisPtr), 0, <complex *> totProp.data )
+        evolve_propagator_CPP(deref(pulseSeq.thisPtr), deref(systemParams.thisPtr), 0, <complex *> totProp.data, NULL)
     elif simType == 'lindblad':
         totProp = np.eye(systemParamsIn.dim**2, dtype=np.complex128)
-        evolve_propagator_CPP(deref(pulseSeq.thisPtr), deref(systemParams.thisPtr), 1, <complex *> totProp.data )
+        evolve_propagator_CPP(deref(pulseSeq.thisPtr), deref(systemParams.thisPtr), 1, <complex *> totProp.data, NULL)
     
     return totProp
 
-
+#Evolve the propagator recording the trajectory of the observables (or the state if observables is None) on the decimation.
+#Returns the total propagator, the record times and the records.
+def Cy_evolution_trajectory(pulseSeqIn, systemParamsIn, simType, rhoIn, observables, decimation, byPixel, maxRecords):
+    
+    #Some error checking
+    assert pulseSeqIn.numControlLines==systemParamsIn.numControlHams, 'Oops! We need the same number of control Hamiltonians as control lines.'
+    
+    pulseSeq = PyPulseSequence(pulseSeqIn)
+    
+    systemParams = PySystemParams(systemParamsIn)
+    
+    cdef np.ndarray rhoInC = np.ascontiguousarray(rhoIn, dtype=np.complex128)
+    cdef np.ndarray observablesC
+    cdef vector[complex *] observablePtrs
+    cdef size_t ct
+    cdef size_t dim2 = systemParamsIn.dim**2
+    cdef np.ndarray times = np.zeros(maxRecords, dtype=np.float64)
+    cdef np.ndarray records
+    if observables is not None:
+        observablesC = np.ascontiguousarray(observables, dtype=np.complex128)
+        for ct in range(observablesC.shape[0]):
+            observablePtrs.push_back(<complex *> np.PyArray_DATA(observablesC) + ct*dim2)
+        records = np.zeros((maxRecords, observablesC.shape[0]), dtype=np.float64)
+    else:
+        records = np.zeros((maxRecords, systemParamsIn.dim, systemParamsIn.dim), dtype=np.complex128)
+    
+    cdef TrajectoryRecorder *recorder = new TrajectoryRecorder(0 if simType == 'unitary' else 1, systemParamsIn.dim, <complex *> rhoInC.data, observablePtrs, 
+                                                               decimation, byPixel, maxRecords, <double *> times.data, 
+                                                               <double *> records.data if observables is not None else NULL, 
+                                                               <complex *> records.data if observables is None else NULL)
+    
+    #Initialize the total unitary output memory to the identity
+    cdef np.ndarray totProp = np.eye(systemParamsIn.dim if simType == 'unitary' else systemParamsIn.dim**2, dtype=np.complex128)
+    evolve_propagator_CPP(deref(pulseSeq.thisPtr), deref(systemParams.thisPtr), 0 if simType == 'unitary' else 1, <complex *> totProp.data, recorder)
+    
+    numRecords = recorder.numRecords
+    del recorder
+    
+    return totProp, times[:numRecords], records[:numRecords]
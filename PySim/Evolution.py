@@ -32,6 +32,86 @@ def expm_eigen(matIn, mult):
     return np.dot(V, np.exp(mult*D).repeat(dim).reshape((dim, dim))*V.conj().T), D, V
 
     
+def total_Ham(pulseSequence, systemParams, timect, curTime):
+    '''
+    The total Hamiltonian (drift plus controls) for a time step of the pulse sequence at time curTime.
+    '''
+    #Initialize the Hamiltonian to the drift Hamiltonian
+    Htot = deepcopy(systemParams.Hnat)
+    
+    #Add each of the control Hamiltonians
+    for controlct, tmpControl in enumerate(pulseSequence.controlLines):
+        tmpPhase = 2*pi*tmpControl.freq*curTime + tmpControl.phase
+        if tmpControl.controlType == 'rotating':
+            tmpMat = cos(tmpPhase)*systemParams.controlHams[controlct]['inphase'].matrix + sin(tmpPhase)*systemParams.controlHams[controlct]['quadrature'].matrix
+        elif tmpControl.controlType == 'sinusoidal':
+            tmpMat = cos(tmpPhase)*systemParams.controlHams[controlct]['inphase'].matrix
+        else:
+            raise TypeError('Unknown control type.')
+        tmpMat *= pulseSequence.controlAmps[controlct,timect]
+        Htot += tmpMat
+    
+    return Htot
+
+def dissipator_superop(systemParams):
+    '''
+    The summed column-stacked super operator for the system's dissipators.
+    '''
+    supDis = np.zeros((systemParams.dim**2, systemParams.dim**2), dtype=np.complex128)
+    for tmpDis in systemParams.dissipators:
+        supDis += tmpDis.superOpColStack()
+    return supDis
+
+def sub_steps(pulseSequence):
+    '''
+    Generator over the sub-steps of a pulse sequence: yields (timect, curTime, subTimeStep) splitting each time step into pieces no longer than maxTimeStep.
+    '''
+    curTime = 0.0
+    for timect, timeStep in enumerate(pulseSequence.timeSteps):
+        tmpTime = 0.0 
+        #Loop over the sub-pixels if we have a finer discretization
+        while tmpTime < timeStep:
+            #Choose the minimum of the time left or the sub pixel timestep
+            subTimeStep = np.minimum(timeStep-tmpTime, pulseSequence.maxTimeStep)
+            yield timect, curTime, subTimeStep
+            
+            #Update the times
+            tmpTime += subTimeStep
+            curTime += subTimeStep
+
+def num_sub_steps(pulseSequence):
+    '''
+    Count the sub-steps sub_steps yields for a pulse sequence without walking them: each time step splits into ceil(timeStep/maxTimeStep) 
+    pieces and zero length steps have none.  Accumulating the sub-steps can leave a sliver of a time step when it is a multiple of maxTimeStep
+    so we allow one more for those and the count is an upper bound.
+    '''
+    timeSteps = np.asarray(pulseSequence.timeSteps, dtype=np.float64)
+    ratios = timeSteps[timeSteps > 0]/pulseSequence.maxTimeStep
+    slivers = (ratios > 1) & (np.abs(ratios - np.round(ratios)) <= 1e-9*ratios)
+    return int(np.sum(np.maximum(np.ceil(ratios), 1)) + np.sum(slivers))
+
+def step_propagator(pulseSequence, systemParams, timect, curTime, subTimeStep, supDis=None):
+    '''
+    The propagator for one sub-step: the unitary or, if the dissipator super operator is given, the Lindblad super operator propagator.
+    '''
+    Htot = total_Ham(pulseSequence, systemParams, timect, curTime)
+    
+    if supDis is None:
+        if pulseSequence.H_int is not None:
+            #Move the total Hamiltonian into the interaction frame
+            Htot.calc_interaction_frame(pulseSequence.H_int, curTime)
+            return expm_eigen(Htot.interactionMatrix,-1j*2*pi*subTimeStep)[0]
+        else:
+            return expm_eigen(Htot.matrix,-1j*2*pi*subTimeStep)[0]
+    else:
+        if pulseSequence.H_int is not None:
+            #Move the total Hamiltonian into the interaction frame
+            Htot.calc_interaction_frame(pulseSequence.H_int, curTime)
+            supHtot = Htot.superOpColStack(interactionMatrix=True)
+        else:
+            supHtot = Htot.superOpColStack()
+        return expm(subTimeStep*(1j*2*pi*supHtot + supDis))
+
 def evolution_unitary(pulseSequence, systemParams):
     '''
     Main function for evolving a state under unitary conditions
@@ -46,43 +126,9 @@ def evolution_unitary(pulseSequence, systemParams):
     
         totU = np.eye(systemParams.dim)
         
-        #Loop over each timestep in the sequence
-        curTime = 0.0
-        for timect, timeStep in enumerate(pulseSequence.timeSteps):
-            tmpTime = 0.0 
-            #Loop over the sub-pixels if we have a finer discretization
-            while tmpTime < timeStep:
-                #Choose the minimum of the time left or the sub pixel timestep
-                subTimeStep = np.minimum(timeStep-tmpTime, pulseSequence.maxTimeStep)
-    
-                #Initialize the Hamiltonian to the drift Hamiltonian
-                Htot = deepcopy(systemParams.Hnat)
-                
-                #Add each of the control Hamiltonians
-                for controlct, tmpControl in enumerate(pulseSequence.controlLines):
-                    tmpPhase = 2*pi*tmpControl.freq*curTime + tmpControl.phase
-                    if tmpControl.controlType == 'rotating':
-                        tmpMat = cos(tmpPhase)*systemParams.controlHams[controlct]['inphase'].matrix + sin(tmpPhase)*systemParams.controlHams[controlct]['quadrature'].matrix
-                    elif tmpControl.controlType == 'sinusoidal':
-                        tmpMat = cos(tmpPhase)*systemParams.controlHams[controlct]['inphase'].matrix
-                    else:
-                        raise TypeError('Unknown control type.')
-                    tmpMat *= pulseSequence.controlAmps[controlct,timect]
-                    Htot += tmpMat
-    
-                
-                if pulseSequence.H_int is not None:
-                    #Move the total Hamiltonian into the interaction frame
-                    Htot.calc_interaction_frame(pulseSequence.H_int, curTime)
-                    #Propagate the unitary
-                    totU = np.dot(expm_eigen(Htot.interactionMatrix,-1j*2*pi*subTimeStep)[0],totU)
-                else:
-                    #Propagate the unitary
-                    totU = np.dot(expm_eigen(Htot.matrix,-1j*2*pi*subTimeStep)[0],totU)
-                
-                #Update the times
-                tmpTime += subTimeStep
-                curTime += subTimeStep
+        #Loop over each sub-step in the sequence and propagate the unitary
+        for timect, curTime, subTimeStep in sub_steps(pulseSequence):
+            totU = np.dot(step_propagator(pulseSequence, systemParams, timect, curTime, subTimeStep), totU)
                 
         return totU
 
@@ -101,57 +147,93 @@ def evolution_lindblad(pulseSequence, systemParams, rhoIn):
         return PySim.CySim.Cy_evolution(pulseSequence, systemParams, 'lindblad')
     else:
 
-    
         #Setup the super operators for the dissipators
-        supDis = np.zeros((systemParams.dim**2, systemParams.dim**2), dtype=np.complex128)
-        for tmpDis in systemParams.dissipators:
-            supDis += tmpDis.superOpColStack()
+        supDis = dissipator_superop(systemParams)
             
         #Initialize the propagator
         totF = np.eye(systemParams.dim**2)
         
-        #Loop over each timestep in the sequence
-        curTime = 0.0
-        for timect, timeStep in enumerate(pulseSequence.timeSteps):
-            tmpTime = 0.0 
-            #Loop over the sub-pixels if we have a finer discretization
-            while tmpTime < timeStep:
-                #Choose the minimum of the time left or the sub pixel timestep
-                subTimeStep = np.minimum(timeStep-tmpTime, pulseSequence.maxTimeStep)
-    
-                #Initialize the Hamiltonian to the drift Hamiltonian
-                Htot = deepcopy(systemParams.Hnat)
-                
-                #Add each of the control Hamiltonians
-                for controlct, tmpControl in enumerate(pulseSequence.controlLines):
-                    tmpPhase = 2*pi*tmpControl.freq*curTime + tmpControl.phase
-                    if tmpControl.controlType == 'rotating':
-                        tmpMat = cos(tmpPhase)*systemParams.controlHams[controlct]['inphase'].matrix + sin(tmpPhase)*systemParams.controlHams[controlct]['quadrature'].matrix
-                    elif tmpControl.controlType == 'sinusoidal':
-                        tmpMat = cos(tmpPhase)*systemParams.controlHams[controlct]['inphase'].matrix
-                    else:
-                        raise TypeError('Unknown control type.')
-                    tmpMat *= pulseSequence.controlAmps[controlct,timect]
-                    Htot += tmpMat
-                   
-                if pulseSequence.H_int is not None:
-                    #Move the total Hamiltonian into the interaction frame
-                    Htot.calc_interaction_frame(pulseSequence.H_int, curTime)
-                    supHtot = Htot.superOpColStack(interactionMatrix=True)
-                else:
-                    supHtot = Htot.superOpColStack()
-                
-                
-                #Propagate the unitary
-                totF = np.dot(expm(subTimeStep*(1j*2*pi*supHtot + supDis)),totF)
-                
-                tmpTime += subTimeStep
-                curTime += subTimeStep
+        #Loop over each sub-step in the sequence and propagate the super operator
+        for timect, curTime, subTimeStep in sub_steps(pulseSequence):
+            totF = np.dot(step_propagator(pulseSequence, systemParams, timect, curTime, subTimeStep, supDis), totF)
                 
         return totF
 
+def evolution_trajectory(pulseSequence, systemParams, rhoIn, simType='unitary', observables=None, decimation=1, byPixel=False):
+    '''
+    Evolve through the pulse sequence once recording the expectation values of a stack of observables (or the state if there are none) at 
+    the start and then every decimation sub-steps or, with byPixel, every decimation time steps.  Returns the total propagator, the times 
+    of the records and the records (numRecords x numObservables expectation values or numRecords x dim x dim states).
+    '''
     
+    #Some error checking
+    assert pulseSequence.numControlLines==systemParams.numControlHams, 'Oops! We need the same number of control Hamiltonians as control lines.'
+    assert decimation >= 1, 'Oops! The decimation must be at least one.'
     
+    #Preallocate for the most records we could make 
+    numSteps = pulseSequence.numTimeSteps if byPixel else num_sub_steps(pulseSequence)
+    maxRecords = 1 + numSteps//decimation
     
+    if CPPBackEnd:
+        return PySim.CySim.Cy_evolution_trajectory(pulseSequence, systemParams, simType, rhoIn, observables, decimation, byPixel, maxRecords)
     
+    dim = systemParams.dim
+    times = np.zeros(maxRecords, dtype=np.float64)
+    if observables is not None:
+        records = np.zeros((maxRecords, len(observables)), dtype=np.float64)
+    else:
+        records = np.zeros((maxRecords, dim, dim), dtype=np.complex128)
+    
+    if simType == 'unitary':
+        supDis = None
+        totProp = np.eye(dim, dtype=np.complex128)
+    elif simType == 'lindblad':
+        supDis = dissipator_superop(systemParams)
+        totProp = np.eye(dim**2, dtype=np.complex128)
+    else:
+        raise NameError('Unknown simulation type.')
+    
+    def record(recordct, curTime):
+        if simType == 'unitary':
+            rho = np.dot(np.dot(totProp, rhoIn), totProp.conj().T)
+        else:
+            rho = np.dot(totProp, rhoIn.reshape((dim**2,1), order='F')).reshape((dim,dim), order='F')
+        times[recordct] = curTime
+        if observables is not None:
+            #Tr(O rho) as an elementwise product
+            records[recordct] = np.real(np.einsum('kij,ji->k', observables, rho))
+        else:
+            records[recordct] = rho
+    
+    record(0, 0.0)
+    numRecords = 1
+    stepct = 0
+    #The number of time steps we have moved past, recording at the end of every decimation-th one when byPixel
+    pixelct = 0
+    endTime = 0.0
+    for timect, curTime, subTimeStep in sub_steps(pulseSequence):
+        #Moving on to a new time step finishes those before it including any zero length ones without sub-steps
+        while byPixel and pixelct < timect:
+            pixelct += 1
+            if pixelct % decimation == 0:
+                record(numRecords, curTime)
+                numRecords += 1
+        
+        totProp = np.dot(step_propagator(pulseSequence, systemParams, timect, curTime, subTimeStep, supDis), totProp)
+        endTime = curTime + subTimeStep
+        
+        if not byPixel:
+            stepct += 1
+            if stepct % decimation == 0:
+                record(numRecords, endTime)
+                numRecords += 1
+    
+    #The last time steps finish with the sequence
+    while byPixel and pixelct < pulseSequence.numTimeSteps:
+        pixelct += 1
+        if pixelct % decimation == 0:
+            record(numRecords, endTime)
+            numRecords += 1
+    
+    return totProp, times[:numRecords], records[:numRecords]
 
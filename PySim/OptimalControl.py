@@ -10,12 +10,19 @@ Code for numerical optimal control.
 
 import numpy as np
 from numpy import sin,cos
-from copy import deepcopy
+from copy import copy, deepcopy
+from collections import OrderedDict
+import hashlib
+import multiprocessing
+import os
+import threading
+import time
 
 from scipy.constants import pi
-from scipy.linalg import expm
+from scipy.linalg import expm, expm_frechet
 from scipy.linalg import eigh
-from scipy.optimize import fmin_l_bfgs_b
+from scipy.optimize import fmin_l_bfgs_b, minimize, differential_evolution, Bounds
+from scipy.signal import fftconvolve
 
 import matplotlib.pyplot as plt
 
@@ -31,6 +38,14 @@ try:
 except ImportError:
     CPPBackEnd = False
 
+#Memoized interaction frame control Hamiltonians keyed by a hash of the problem (see calc_control_Hams)
+_controlHamsCache = OrderedDict()
+_controlHamsCacheLock = threading.Lock()
+_controlHamsCacheSize = 8
+
+#The system shared by the gate set worker processes (see optimize_gate_set)
+_gateSetSystemParams = None
+
 class PulseParams(PulseSequence):
     '''
     For now just a container for pulse optimization parameters.  Subclasses a PulseSequence as it has to define similar things.
@@ -40,13 +55,42 @@ class PulseParams(PulseSequence):
         self.numChannels = 0
         self.numPoints = 0
         self.startControlAmps = None  #Initial guess for the pulse
-        self.fTol = 1e-4    #optimization paramter: will exit when difference in fidelity is less than this. 
+        self.fTol = 1e-9    #optimization paramter: will exit when difference in fidelity is less than this. 
         self.maxfun = 15000
+        self.targetFidelity = None #Stop as soon as the fidelity reaches this
+        self.maxTime = None #Wall clock budget in seconds (checked after each iteration)
+        self.callback = None #Called after each iteration with the history record: returning True stops the optimization
+        self.checkpointFile = None #Periodically save the optimization state to this npz file and resume from it if it holds the same problem 
+        self.checkpointInterval = 10 #Number of iterations between checkpoints
         self.derivType = 'approx'
-        self.optimType = 'unitary' #uniary or state2state optimization
+        self.optimMethod = 'lbfgs' #lbfgs, newton (trust-region with exact Hessian-vector products for unitary goals), krotov (sequential pixel updates) or evolution (gradient free differential evolution)
+        self.popSize = 15 #Population size multiplier (candidates per optimization parameter) for the evolution optimizer
+        self.popTol = 0.01 #Evolution optimizer stops when the spread of the population's goodness is below this fraction of its mean
+        self.seed = None #Random seed for the evolution optimizer
+        self.optimType = 'unitary' #uniary, state2state or lindblad (state to state with the system dissipators) optimization
         self.Ugoal = None
+        self.subspace = None #Projector onto the computational subspace a unitary goal is defined on: only those propagator columns are evolved
+        self.subspaceBasis = None #Orthonormal basis (dim x k) for the subspace (set on optimize_pulse's internal copy)
         self.rhoStart = None
         self.rhoGoal = None
+        self.ensemble = [] #Optional system variants for robust optimization (see add_ensemble_member)
+        self.basis = None #Optimize coefficients of basis functions rather than pixels: fourier, chebyshev, slepian or a (numTimeSteps x numBasis) matrix
+        self.numBasis = 20 #Number of basis functions per control line for the built in bases
+        self.numGridLevels = 1 #Number of time grids for multigrid optimization: each coarser level merges pairs of time steps
+        self.filterControls = False #Pass the optimized drive through each control line's impulse response (bandwidth Gaussian or impulseResponse FIR)
+        self.driveAmps = None #The optimized drive before the channel filters (what to program into the hardware)
+    
+    def add_ensemble_member(self, systemParams, weight=1.0, ampScale=1.0):
+        '''
+        Add a system variant (e.g. a detuned Hnat) to optimize the average fidelity over.  ampScale scales the control amplitudes
+        the member sees to model drive amplitude drift.  If any members are added they replace the systemParams passed to optimize_pulse
+        in the fidelity so the nominal system should be added as a member too.
+        '''
+        tmpMember = {}
+        tmpMember['systemParams'] = systemParams
+        tmpMember['weight'] = weight
+        tmpMember['ampScale'] = ampScale
+        self.ensemble.append(tmpMember)
     
     @property
     def dim(self):
@@ -59,6 +103,63 @@ class PulseParams(PulseSequence):
                 return 0
                 
 
+class StopOptimization(Exception):
+    '''
+    Raised from the iteration callback to stop the optimizer early.
+    '''
+    pass
+
+
+class PropResults(object):
+    '''
+    Python version of the C++ PropResults for the second order optimization: holds the step propagators, their eigendecompositions and the 
+    forward and backward evolution for a pulse so the fidelity, gradient and Hessian-vector product evaluations at the same pulse share them.
+    '''
+    def __init__(self):
+        #The pulse the results are for
+        self.controlAmps = None
+        #The total Hamiltonian, unitary, eigenvalues and eigenvectors of each time step
+        self.totHams = None
+        self.Us = None
+        self.Ds = None
+        self.Vs = None
+        #The evolution before each time step (and the total unitary at the end) 
+        self.Uforward = None
+        #The reverse-time evolution from the goal back to each time step
+        self.Uback = None
+        #The trace overlap with the goal
+        self.overlap = None
+        #The first divided differences of each step's exponential in its eigenbasis
+        self.divDiffs = None
+        #The control Hamiltonians in each step's eigenbasis
+        self.eigenFrameControlHams = None
+        #Uforward*Uback^dagger in each step's eigenbasis
+        self.projMats = None
+        #The complex derivative of the overlap with respect to each control amplitude 
+        self.derivOverlaps = None
+
+
+class LindbladPropResults(object):
+    '''
+    Storage for the intermediate results of Lindbladian evolution during optimization.  We keep the eigendecomposition of each time step's superoperator 
+    generator so the expensive d^2 x d^2 factorizations are done once per pulse and shared between the fidelity and derivative evaluations.
+    '''
+    def __init__(self, numSteps, dim):
+        supDim = dim**2
+        #The pulse the results are for
+        self.controlAmps = None
+        #The generator (timestep*Lindbladian) for each step 
+        self.generators = np.zeros((numSteps, supDim, supDim), dtype=np.complex128)
+        #Eigendecomposition of the generators
+        self.eigVals = np.zeros((numSteps, supDim), dtype=np.complex128)
+        self.eigVecs = np.zeros((numSteps, supDim, supDim), dtype=np.complex128)
+        self.invEigVecs = np.zeros((numSteps, supDim, supDim), dtype=np.complex128)
+        #Steps where the eigenvectors are too ill-conditioned and we fall back to the block-triangular exponential 
+        self.useFrechet = np.zeros(numSteps, dtype=bool)
+        #The column-stacked density matrix before each step and at the end
+        self.rhoForward = np.zeros((numSteps+1, supDim), dtype=np.complex128)
+
+
 def create_random_pulse(numChannels, numPoints):
     '''
     Helper function to create smooth pulse starting point.
@@ -67,46 +168,217 @@ def create_random_pulse(numChannels, numPoints):
     return 2e6*np.ones((numChannels, numPoints))
 
 
+def calc_pulse_basis(optimParams):
+    '''
+    Helper function to create the (numTimeSteps x numBasis) matrix of basis functions for the parametrized (CRAB style) optimization.
+    The built in bases are scaled to unit peak so the coefficients are on the scale of the amplitudes.
+    '''
+    if isinstance(optimParams.basis, np.ndarray):
+        assert optimParams.basis.shape[0] == optimParams.numTimeSteps, 'Oops! The basis matrix needs a row for each time step.'
+        return optimParams.basis.astype(np.float64)
+    
+    #Evaluate the functions at the pixel centers on [0,1]
+    pixelCenters = (np.cumsum(optimParams.timeSteps) - 0.5*optimParams.timeSteps)/np.sum(optimParams.timeSteps)
+    if optimParams.basis == 'fourier':
+        #Sine series which goes to zero at the pulse edges
+        basisMat = np.sin(pi*np.outer(pixelCenters, np.arange(1, optimParams.numBasis+1)))
+    elif optimParams.basis == 'chebyshev':
+        basisMat = np.polynomial.chebyshev.chebvander(2*pixelCenters-1, optimParams.numBasis-1)
+    elif optimParams.basis == 'slepian':
+        #The discrete prolate spheroidal sequences are the most band-limited for the pulse length (assumes equal time steps)
+        from scipy.signal.windows import dpss
+        basisMat = dpss(optimParams.numTimeSteps, 0.5*(optimParams.numBasis+1), optimParams.numBasis).T
+    else:
+        raise NameError('Unknown pulse basis.  Currently handle "fourier", "chebyshev", "slepian" or a matrix.')
+    
+    return basisMat/np.max(np.abs(basisMat), axis=0)
+
+def calc_subspace_basis(projector):
+    '''
+    Helper function for an orthonormal basis (dim x k) of the range of a projector.  The columns are the standard basis vectors when the projector is diagonal.
+    '''
+    if np.count_nonzero(projector - np.diag(np.diag(projector))) == 0:
+        return np.eye(projector.shape[0], dtype=np.complex128)[:, np.abs(np.diag(projector)) > 0.5]
+    eigVals, eigVecs = eigh(projector)
+    return np.ascontiguousarray(eigVecs[:, eigVals > 0.5], dtype=np.complex128)
+
+def goal_columns(optimParams):
+    '''
+    Helper function for the columns of the goal unitary on the subspace we propagate (all of them if there is no subspace).
+    '''
+    return optimParams.Ugoal if optimParams.subspaceBasis is None else np.dot(optimParams.Ugoal, optimParams.subspaceBasis)
+
+def control_Hams_key(optimParams, systemParams):
+    '''
+    Hash of everything the interaction frame control Hamiltonians depend on: the system control Hamiltonians, the control lines, 
+    the time steps and the interaction frame.
+    '''
+    tmpHash = hashlib.sha1()
+    for tmpControlHam in systemParams.controlHams:
+        for tmpHam in [tmpControlHam['inphase'], tmpControlHam['quadrature']]:
+            tmpHash.update(b'None' if tmpHam is None else np.ascontiguousarray(tmpHam.matrix, dtype=np.complex128).tobytes())
+    for tmpControl in optimParams.controlLines:
+        tmpHash.update(repr((tmpControl.freq, tmpControl.phase, tmpControl.controlType)).encode())
+    tmpHash.update(np.ascontiguousarray(optimParams.timeSteps, dtype=np.float64).tobytes())
+    tmpHash.update(b'None' if optimParams.H_int is None else np.ascontiguousarray(optimParams.H_int.matrix, dtype=np.complex128).tobytes())
+    return tmpHash.hexdigest()
+
+def problem_key(optimParams, systemParams):
+    '''
+    Hash identifying an optimization problem for checkpointing: the control Hamiltonian key plus the drift, goal, dissipators, ensemble,
+    control limits and the optimization parametrization.
+    '''
+    def array_bytes(arrayIn):
+        return b'None' if arrayIn is None else np.ascontiguousarray(arrayIn).tobytes()
+    
+    tmpHash = hashlib.sha1(control_Hams_key(optimParams, systemParams).encode())
+    tmpHash.update(array_bytes(systemParams.Hnat.matrix))
+    for tmpMat in [optimParams.Ugoal, optimParams.rhoStart, optimParams.rhoGoal, optimParams.subspace]:
+        tmpHash.update(array_bytes(tmpMat))
+    for tmpDis in systemParams.dissipators:
+        tmpHash.update(array_bytes(tmpDis.matrix))
+    for tmpMember in optimParams.ensemble:
+        tmpHash.update(array_bytes(tmpMember['systemParams'].Hnat.matrix))
+        tmpHash.update(repr((tmpMember['weight'], tmpMember['ampScale'])).encode())
+    for tmpControl in optimParams.controlLines:
+        tmpHash.update(repr((tmpControl.maxAmp, tmpControl.bandwidth)).encode())
+        tmpHash.update(array_bytes(tmpControl.impulseResponse))
+    tmpHash.update(array_bytes(optimParams.basis) if isinstance(optimParams.basis, np.ndarray) else repr(optimParams.basis).encode())
+    tmpHash.update(repr((optimParams.optimType, optimParams.optimMethod, optimParams.derivType, optimParams.numBasis, optimParams.filterControls)).encode())
+    return tmpHash.hexdigest()
+
+def load_checkpoint(optimParams, problemKey):
+    '''
+    Load the checkpoint for the problem if there is one.  Returns None if the file is missing or holds a different problem.
+    '''
+    if optimParams.checkpointFile is None or not os.path.exists(optimParams.checkpointFile):
+        return None
+    with np.load(optimParams.checkpointFile) as tmpFile:
+        if str(tmpFile['problemKey']) != problemKey:
+            return None
+        return dict([(key, tmpFile[key]) for key in tmpFile.files])
+
+def save_checkpoint(optimParams, problemKey, params, sPairs, yPairs, numIterations):
+    '''
+    Write the optimization state to the checkpoint file.  We write to a temporary file and rename it so a preemption can't leave a partial checkpoint.
+    '''
+    tmpFileName = optimParams.checkpointFile + '.tmp'
+    with open(tmpFileName, 'wb') as tmpFile:
+        np.savez(tmpFile, problemKey=problemKey, params=params, sPairs=np.array(sPairs), yPairs=np.array(yPairs), numIterations=numIterations)
+    os.rename(tmpFileName, optimParams.checkpointFile)
+
+def calc_checkpoint_scaling(sPairs, yPairs):
+    '''
+    Diagonal scaling of the optimization parameters from the L-BFGS memory pairs in a checkpoint.  scipy's L-BFGS-B can't be seeded with
+    memory so we use the per-parameter curvature estimate (s.y/y.y) as a preconditioner instead.  Returns the square root of the estimate 
+    normalized to a median of one.
+    '''
+    numer = np.sum(sPairs*yPairs, axis=0)
+    denom = np.sum(yPairs**2, axis=0)
+    globalScale = np.sum(numer)/np.sum(denom) if np.sum(numer) > 0 else 1.0
+    #Fall back to the global estimate where the curvature isn't positive
+    goodCurvature = (numer > 0) & (denom > 0)
+    diagScale = globalScale*np.ones_like(numer)
+    diagScale[goodCurvature] = numer[goodCurvature]/denom[goodCurvature]
+    diagScale = np.sqrt(diagScale/np.median(diagScale))
+    return np.clip(diagScale, 1e-3, 1e3)
+
 def calc_control_Hams(optimParams, systemParams):
     '''
-    A helper function to calculate the control Hamiltonians in the interaction frame.  This only needs to be done once per opimization. 
+    A helper function to calculate the control Hamiltonians in the interaction frame.  This only needs to be done once per opimization.
+    The results are memoized on a hash of the problem so repeated optimizations skip it.  The returned array is shared so it is read-only. 
     '''
+    cacheKey = control_Hams_key(optimParams, systemParams)
+    with _controlHamsCacheLock:
+        if cacheKey in _controlHamsCache:
+            #Move it to the back of the eviction queue
+            controlHams = _controlHamsCache.pop(cacheKey)
+            _controlHamsCache[cacheKey] = controlHams
+            return controlHams
+    
     #We'll store them in a numControlHamsxnumTimeSteps array
     controlHams = np.zeros((systemParams.numControlHams, optimParams.numTimeSteps, systemParams.dim, systemParams.dim), dtype = np.complex128)
     
-    #Now loop over each timestep
-    curTime = 0.0
-    for timect, timeStep in enumerate(optimParams.timeSteps):
-        
-        #Loop over each of the control Hamiltonians
-        for controlct, tmpControl in enumerate(optimParams.controlLines):
-            tmpPhase = 2*pi*tmpControl.freq*curTime + tmpControl.phase
-            if tmpControl.controlType == 'rotating':
-                tmpHam = Hamiltonian(cos(tmpPhase)*systemParams.controlHams[controlct]['inphase'].matrix + sin(tmpPhase)*systemParams.controlHams[controlct]['quadrature'].matrix)
-            elif tmpControl.controlType == 'sinusoidal':
-                tmpHam = Hamiltonian(cos(tmpPhase)*systemParams.controlHams[controlct]['inphase'])
-            else:
-                raise KeyError('Unknown control type.')
+    #The phase of each control line at the start of each time step 
+    startTimes = np.hstack(([0.0], np.cumsum(optimParams.timeSteps)[:-1]))
+    freqs = np.array([tmpControl.freq for tmpControl in optimParams.controlLines], dtype=np.float64)
+    phases = np.array([tmpControl.phase for tmpControl in optimParams.controlLines], dtype=np.float64)
+    tmpPhases = 2*pi*np.outer(freqs, startTimes) + phases[:, np.newaxis]
+    
+    for controlct, tmpControl in enumerate(optimParams.controlLines):
+        if tmpControl.controlType == 'rotating':
+            controlHams[controlct] = np.cos(tmpPhases[controlct])[:, np.newaxis, np.newaxis]*systemParams.controlHams[controlct]['inphase'].matrix \
+                                     + np.sin(tmpPhases[controlct])[:, np.newaxis, np.newaxis]*systemParams.controlHams[controlct]['quadrature'].matrix
+        elif tmpControl.controlType == 'sinusoidal':
+            controlHams[controlct] = np.cos(tmpPhases[controlct])[:, np.newaxis, np.newaxis]*systemParams.controlHams[controlct]['inphase'].matrix
+        else:
+            raise KeyError('Unknown control type.')
+    
+    if optimParams.H_int is not None:
+        #Move into the interaction frame.  The frame transformation exp(i*2*pi*H_int*t) is diagonal in the eigenbasis of H_int so 
+        #with a single eigendecomposition the transformation of every control at every time step is elementwise.
+        H_intMat = optimParams.H_int.matrix
+        if np.count_nonzero(H_intMat - np.diag(np.diag(H_intMat))) == 0:
+            eigVals, eigVecs = np.diag(H_intMat).real, None
+        else:
+            eigVals, eigVecs = eigh(H_intMat)
+            controlHams = np.matmul(np.matmul(eigVecs.conj().T, controlHams), eigVecs)
+        framePhases = np.exp((1j*2*pi)*np.outer(startTimes, eigVals))
+        controlHams *= framePhases[np.newaxis, :, :, np.newaxis]*framePhases.conj()[np.newaxis, :, np.newaxis, :]
+        if eigVecs is not None:
+            controlHams = np.matmul(np.matmul(eigVecs, controlHams), eigVecs.conj().T)
+    
+    controlHams = np.ascontiguousarray(controlHams)
+    controlHams.setflags(write=False)
+    with _controlHamsCacheLock:
+        _controlHamsCache[cacheKey] = controlHams
+        while len(_controlHamsCache) > _controlHamsCacheSize:
+            _controlHamsCache.popitem(last=False)
+            
+    return controlHams
 
-            if optimParams.H_int is not None:
-                #Move the total Hamiltonian into the interaction frame
-                tmpHam.calc_interaction_frame(optimParams.H_int, curTime)
-                controlHams[controlct, timect] = tmpHam.interactionMatrix + optimParams.H_int.matrix
-            else:
-                #Just store the matrix
-                controlHams[controlct, timect] = tmpHam.matrix
+def same_control_Hams(systemParams1, systemParams2):
+    '''
+    Helper function to check whether two systems have identical control Hamiltonians so that their interaction frame versions can be shared.
+    '''
+    if systemParams1 is systemParams2:
+        return True
+    if systemParams1.numControlHams != systemParams2.numControlHams:
+        return False
+    for controlHam1, controlHam2 in zip(systemParams1.controlHams, systemParams2.controlHams):
+        for hamType in ['inphase', 'quadrature']:
+            if (controlHam1[hamType] is None) != (controlHam2[hamType] is None):
+                return False
+            if controlHam1[hamType] is not None and not np.array_equal(controlHam1[hamType].matrix, controlHam2[hamType].matrix):
+                return False
+    return True
 
-        #Update the times
-        curTime += timeStep
+def calc_ensemble_control_Hams(optimParams, ensembleSystems):
+    '''
+    Calculate the interaction frame control Hamiltonians for an ensemble of systems.  Members with identical control Hamiltonians share a single copy.
+    Returns a numUnique x numControlHams x numTimeSteps x dim x dim array and the index into it for each member.
+    '''
+    uniqueSystems = []
+    hamIndices = np.zeros(len(ensembleSystems), dtype=np.int64)
+    for memberct, tmpSys in enumerate(ensembleSystems):
+        for uniquect, uniqueSys in enumerate(uniqueSystems):
+            if same_control_Hams(tmpSys, uniqueSys):
+                hamIndices[memberct] = uniquect
+                break
+        else:
+            hamIndices[memberct] = len(uniqueSystems)
+            uniqueSystems.append(tmpSys)
             
-    return controlHams
+    controlHams = np.array([calc_control_Hams(optimParams, tmpSys) for tmpSys in uniqueSystems])
+    
+    return controlHams, hamIndices
 
 def evolution_unitary(optimParams, systemParams, controlHams):
     '''
-    Main function for evolving a state under unitary conditions
+    Main function for evolving a state under unitary conditions.  With a subspace only its columns of the total unitary are propagated. 
     '''
     
-    totU = np.eye(systemParams.dim)
+    totU = np.eye(systemParams.dim) if optimParams.subspaceBasis is None else optimParams.subspaceBasis
     timeStepUs = np.zeros((optimParams.timeSteps.size, systemParams.dim, systemParams.dim), dtype=np.complex128)
     Vs = np.zeros((optimParams.timeSteps.size, systemParams.dim, systemParams.dim), dtype=np.complex128)
     Ds = np.zeros((optimParams.timeSteps.size, systemParams.dim), dtype=np.float64)
@@ -138,6 +410,247 @@ def evolution_unitary(optimParams, systemParams, controlHams):
     return totU, timeStepUs, Vs, Ds, totHams
 
 
+def evolution_unitary_ensemble(optimParams, Hnats, controlHams, hamIndices, ampScales):
+    '''
+    Batched version of evolution_unitary over an ensemble of systems.  Hnats is a numMembers x dim x dim stack of drift Hamiltonians and controlHams
+    the unique interaction frame control Hamiltonians from calc_ensemble_control_Hams.  Everything is returned with a leading member index.
+    '''
+    numMembers, dim = Hnats.shape[:2]
+    numSteps = optimParams.numTimeSteps
+    
+    totU = np.tile(np.eye(dim, dtype=np.complex128), (numMembers,1,1))
+    timeStepUs = np.zeros((numMembers, numSteps, dim, dim), dtype=np.complex128)
+    Vs = np.zeros((numMembers, numSteps, dim, dim), dtype=np.complex128)
+    Ds = np.zeros((numMembers, numSteps, dim), dtype=np.float64)
+    totHams = np.zeros_like(timeStepUs)
+    
+    #Loop over each timestep in the sequence
+    curTime = 0.0
+    for timect, timeStep in enumerate(optimParams.timeSteps):
+        #Initialize the Hamiltonians to the drift Hamiltonians moving them into the interaction frame together 
+        if optimParams.H_int is not None:
+            transformMat = expm((1j*2*pi*curTime)*optimParams.H_int.matrix)
+            Htot = np.einsum('ij,mjk,lk->mil', transformMat, Hnats, transformMat.conj()) - optimParams.H_int.matrix
+        else:
+            Htot = np.copy(Hnats)
+        
+        #Add each of the control Hamiltonians with each member's amplitude scaling
+        Htot += np.einsum('mc,mcij->mij', np.outer(ampScales, optimParams.controlAmps[:,timect]), controlHams[hamIndices, :, timect])
+        
+        #Diagonalize all the members at once and propagate the unitaries
+        totHams[:,timect] = Htot
+        Ds[:,timect], Vs[:,timect] = np.linalg.eigh(Htot)
+        timeStepUs[:,timect] = np.einsum('mij,mj,mkj->mik', Vs[:,timect], np.exp(-1j*2*pi*timeStep*Ds[:,timect]), Vs[:,timect].conj())
+        totU = np.einsum('mij,mjk->mik', timeStepUs[:,timect], totU)
+        
+        #Update the times
+        curTime += timeStep
+        
+    return totU, timeStepUs, Vs, Ds, totHams
+
+def evolution_unitary_batch(optimParams, systemParams, controlHams, pulses):
+    '''
+    Batched version of evolution_unitary over a population of pulses (numCandidates x numControlHams x numTimeSteps).  All the candidates
+    are diagonalized together at each time step.  Returns a stack of the total unitaries (or their subspace columns) for the candidates.
+    '''
+    numCandidates = pulses.shape[0]
+    dim = systemParams.dim
+
+    startCols = np.eye(dim, dtype=np.complex128) if optimParams.subspaceBasis is None else optimParams.subspaceBasis
+    totU = np.tile(startCols, (numCandidates,1,1))
+
+    #Loop over each timestep in the sequence
+    curTime = 0.0
+    for timect, timeStep in enumerate(optimParams.timeSteps):
+        #The drift Hamiltonian in the interaction frame is the same for every candidate
+        if optimParams.H_int is not None:
+            transformMat = expm((1j*2*pi*curTime)*optimParams.H_int.matrix)
+            Hdrift = np.dot(np.dot(transformMat, systemParams.Hnat.matrix), transformMat.conj().T) - optimParams.H_int.matrix
+        else:
+            Hdrift = systemParams.Hnat.matrix
+
+        #Add each candidate's control Hamiltonians, diagonalize them all at once and propagate the unitaries
+        Htot = Hdrift + np.einsum('nc,cij->nij', pulses[:,:,timect], controlHams[:,timect])
+        Ds, Vs = np.linalg.eigh(Htot)
+        timeStepUs = np.matmul(Vs*np.exp(-1j*2*pi*timeStep*Ds)[:,np.newaxis,:], Vs.conj().transpose(0,2,1))
+        totU = np.matmul(timeStepUs, totU)
+
+        #Update the times
+        curTime += timeStep
+
+    return totU
+
+def evolution_lindblad(optimParams, systemParams, controlHams, supDis, propResults):
+    '''
+    Evolve the starting density matrix under Lindbladian dynamics storing the factorized step superoperators and forward states in propResults.  
+    Does nothing if propResults already holds the current pulse.
+    '''
+    if propResults.controlAmps is not None and np.array_equal(propResults.controlAmps, optimParams.controlAmps):
+        return
+    
+    #Column-stacked starting density matrix
+    propResults.rhoForward[0] = optimParams.rhoStart.flatten(order='F')
+    
+    #Loop over each timestep in the sequence
+    curTime = 0.0
+    for timect, timeStep in enumerate(optimParams.timeSteps):
+        #Initialize the Hamiltonian to the drift Hamiltonian
+        Htot = deepcopy(systemParams.Hnat)
+
+        if optimParams.H_int is not None:
+            #Move the total Hamiltonian into the interaction frame
+            Htot.calc_interaction_frame(optimParams.H_int, curTime)
+            Htot.matrix = np.copy(Htot.interactionMatrix)
+        
+        #Add each of the control Hamiltonians
+        for controlct in range(optimParams.numControlLines):
+            Htot += optimParams.controlAmps[controlct, timect]*controlHams[controlct, timect]
+        
+        propResults.generators[timect] = timeStep*(1j*2*pi*Htot.superOpColStack() + supDis)
+        
+        #Diagonalize the generator.  The Lindbladian is not normal so check the eigenvectors are well enough conditioned to invert. 
+        try:
+            eigVals, eigVecs = np.linalg.eig(propResults.generators[timect])
+            invEigVecs = np.linalg.inv(eigVecs)
+            wellConditioned = np.linalg.norm(eigVecs, 1)*np.linalg.norm(invEigVecs, 1) < 1e8
+        except np.linalg.LinAlgError:
+            wellConditioned = False
+        if wellConditioned:
+            propResults.useFrechet[timect] = False
+            propResults.eigVals[timect], propResults.eigVecs[timect], propResults.invEigVecs[timect] = eigVals, eigVecs, invEigVecs
+            propResults.rhoForward[timect+1] = np.dot(eigVecs, np.exp(eigVals)*np.dot(invEigVecs, propResults.rhoForward[timect]))
+        else:
+            propResults.useFrechet[timect] = True
+            propResults.rhoForward[timect+1] = np.dot(expm(propResults.generators[timect]), propResults.rhoForward[timect])
+        
+        #Update the times
+        curTime += timeStep
+    
+    propResults.controlAmps = np.copy(optimParams.controlAmps)
+    
+
+def evolution_unitary_sweeps(optimParams, systemParams, controlHams, propResults):
+    '''
+    Evolve the pulse and store the step propagators with the forward evolution and the backward evolution from the goal in propResults.
+    '''
+    totU, Us, Vs, Ds, totHams = evolution_unitary(optimParams, systemParams, controlHams)
+    propResults.totHams, propResults.Us, propResults.Ds, propResults.Vs = totHams, Us, Ds, Vs
+    calc_forward_backward(optimParams, propResults)
+    propResults.controlAmps = np.copy(optimParams.controlAmps)
+    
+def calc_forward_backward(optimParams, propResults):
+    '''
+    Helper function to calculate the forward and backward evolution from the step propagators in propResults.
+    '''
+    numSteps, dim = propResults.Ds.shape
+    Us = propResults.Us
+    
+    #The forward evolution up to each time step
+    Uforward = np.zeros((numSteps+1, dim, dim), dtype=np.complex128)
+    Uforward[0] = np.eye(dim, dtype=np.complex128)
+    for timect in range(numSteps):
+        Uforward[timect+1] = np.dot(Us[timect], Uforward[timect])
+    
+    #And the backwards evolution from the goal 
+    Uback = np.zeros_like(Us)
+    Uback[-1] = optimParams.Ugoal if optimParams.optimType == 'unitary' else np.eye(dim, dtype=np.complex128)
+    for timect in range(numSteps-2, -1, -1):
+        Uback[timect] = np.dot(Us[timect+1].conj().T, Uback[timect+1])
+    
+    propResults.Uforward, propResults.Uback = Uforward, Uback
+    
+def evolution_unitary_exact(optimParams, systemParams, controlHams, propResults):
+    '''
+    Evolve the pulse and do the forward and backward sweeps for the exact overlap derivatives storing everything in propResults. 
+    Does nothing if propResults already holds the current pulse.
+    '''
+    if propResults.controlAmps is not None and np.array_equal(propResults.controlAmps, optimParams.controlAmps):
+        return
+    
+    evolution_unitary_sweeps(optimParams, systemParams, controlHams, propResults)
+    Ds, Vs = propResults.Ds, propResults.Vs
+    Uforward, Uback = propResults.Uforward, propResults.Uback
+    
+    #The first divided differences of exp(-i*tau*x) on each step's eigenvalues give the exact step derivatives (see eval_derivs) 
+    taus = 2*pi*optimParams.timeSteps
+    expDs = np.exp(-1j*taus.reshape(-1,1)*Ds)
+    eigDiffs = Ds[:,:,np.newaxis] - Ds[:,np.newaxis,:]
+    degenerate = np.abs(eigDiffs) < 1e-10
+    divDiffs = np.where(degenerate, -1j*taus.reshape(-1,1,1)*expDs[:,:,np.newaxis], 
+                        (expDs[:,:,np.newaxis] - expDs[:,np.newaxis,:])/np.where(degenerate, 1, eigDiffs))
+    
+    #The overlap derivative for step j is trace(Uback_j^dagger dU_j Uforward_j) which we evaluate in the step eigenbasis
+    eigenFrameControlHams = np.einsum('tji,ctjk,tkl->ctil', Vs.conj(), controlHams, Vs)
+    projMats = np.einsum('tji,tjk,tlk,tlm->tim', Vs.conj(), Uforward[:-1], Uback.conj(), Vs)
+    derivOverlaps = np.einsum('tab,ctab,tba->ct', divDiffs, eigenFrameControlHams, projMats)
+    
+    propResults.overlap = np.sum(optimParams.Ugoal.conj()*Uforward[-1])
+    propResults.divDiffs = divDiffs
+    propResults.eigenFrameControlHams = eigenFrameControlHams
+    propResults.projMats = projMats
+    propResults.derivOverlaps = derivOverlaps
+    
+def second_divided_differences(eigVals, tau, divDiffs):
+    '''
+    Helper function for the second divided differences f[a,k,b] of f(x) = exp(-i*tau*x) on a set of eigenvalues given the first divided differences.
+    '''
+    lamA = eigVals.reshape(-1,1,1)
+    lamK = eigVals.reshape(1,-1,1)
+    lamB = eigVals.reshape(1,1,-1)
+    #f[a,k,b] = (f[a,k]-f[k,b])/(a-b) or by symmetry (f[k,a]-f[a,b])/(k-b) if a and b are degenerate or f''/2 if all three are
+    abDistinct = np.abs(lamA-lamB) > 1e-10
+    kbDistinct = np.abs(lamK-lamB) > 1e-10
+    abDiffs = (divDiffs[:,:,np.newaxis] - divDiffs[np.newaxis,:,:])/np.where(abDistinct, lamA-lamB, 1)
+    kbDiffs = (divDiffs[:,:,np.newaxis] - divDiffs[:,np.newaxis,:])/np.where(kbDistinct, lamK-lamB, 1)
+    allSame = -0.5*(tau**2)*np.exp(-1j*tau*lamA)*np.ones((1,eigVals.size,eigVals.size))
+    return np.where(abDistinct, abDiffs, np.where(kbDistinct, kbDiffs, allSame))
+
+def eval_hessp(optimParams, systemParams, controlHams, propResults, vecIn):
+    '''
+    Exact Hessian-vector product of the (negative) unitary fidelity.  We do a second tangent forward and backward sweep over the stored propagators
+    to get the directional derivative of each overlap derivative. 
+    '''
+    evolution_unitary_exact(optimParams, systemParams, controlHams, propResults)
+    
+    #Shorten some expressions
+    Us, Vs, Ds = propResults.Us, propResults.Vs, propResults.Ds
+    Uforward, Uback = propResults.Uforward, propResults.Uback
+    numControlHams, numSteps = propResults.derivOverlaps.shape
+    directions = vecIn.reshape((numControlHams, numSteps))
+    
+    #Directional derivative of the overlap
+    dirOverlap = np.sum(propResults.derivOverlaps*directions)
+    
+    #The change in each step's Hamiltonian (in its eigenframe) and unitary along the direction
+    dirHams = np.einsum('ct,ctij->tij', directions, propResults.eigenFrameControlHams)
+    dirUs = np.einsum('tij,tjk,tlk->til', Vs, propResults.divDiffs*dirHams, Vs.conj())
+    
+    #Tangent of the forward evolution
+    dirForward = np.zeros_like(Uforward)
+    for timect in range(numSteps):
+        dirForward[timect+1] = np.dot(Us[timect], dirForward[timect]) + np.dot(dirUs[timect], Uforward[timect])
+    
+    #Tangent of the backward evolution
+    dirBack = np.zeros_like(Uback)
+    for timect in range(numSteps-2, -1, -1):
+        dirBack[timect] = np.dot(Us[timect+1].conj().T, dirBack[timect+1]) + np.dot(dirUs[timect+1].conj().T, Uback[timect+1])
+    
+    #Now the directional derivatives of the overlap derivatives from the change in the forward and backward evolution and the second derivative of the step
+    dirDerivOverlaps = np.zeros_like(propResults.derivOverlaps)
+    for timect in range(numSteps):
+        tmpMat = np.dot(Uforward[timect], dirBack[timect].conj().T) + np.dot(dirForward[timect], Uback[timect].conj().T)
+        tmpMat = np.dot(Vs[timect].conj().T, np.dot(tmpMat, Vs[timect]))
+        secondDivDiffs = second_divided_differences(Ds[timect], 2*pi*optimParams.timeSteps[timect], propResults.divDiffs[timect])
+        for controlct in range(numControlHams):
+            eigenFrameControlHam = propResults.eigenFrameControlHams[controlct, timect]
+            secondDeriv = np.einsum('ak,kb,akb->ab', eigenFrameControlHam, dirHams[timect], secondDivDiffs) + \
+                            np.einsum('ak,kb,akb->ab', dirHams[timect], eigenFrameControlHam, secondDivDiffs)
+            dirDerivOverlaps[controlct, timect] = np.sum(propResults.divDiffs[timect]*eigenFrameControlHam*tmpMat.T) + np.sum(secondDeriv*propResults.projMats[timect].T)
+    
+    hessp = (2.0/optimParams.dimC2)*np.real(np.conj(dirOverlap)*propResults.derivOverlaps + np.conj(propResults.overlap)*dirDerivOverlaps)
+    
+    return -hessp.flatten()
+
 def eval_pulse(optimParams, systemParams, controlHams):
     '''
     Evaluate the fidelity of a pulse with respect to the goal unitary or state-to-state transformation
@@ -153,7 +666,7 @@ def eval_pulse(optimParams, systemParams, controlHams):
     
     #Use the trace fidelity to evaluate it
     if optimParams.optimType == 'unitary':
-        return -(np.abs(np.trace(np.dot(Usim.conj().T, optimParams.Ugoal)))**2)/optimParams.dimC2
+        return -(np.abs(np.sum(Usim.conj()*goal_columns(optimParams)))**2)/optimParams.dimC2
     elif optimParams.optimType == 'state2state':
         rhoOut = np.dot(np.dot(Usim, optimParams.rhoStart), Usim.conj().T)
         return -(np.abs(np.trace(np.dot(rhoOut, optimParams.rhoGoal))))**2
@@ -161,6 +674,121 @@ def eval_pulse(optimParams, systemParams, controlHams):
         raise KeyError('Unknown optimization type.  Currently handle "unitary" or "state2state"')
     
     
+def eval_pulse_ensemble(optimParams, Hnats, controlHams, hamIndices, weights, ampScales):
+    '''
+    Evaluate the weighted average fidelity of a pulse over an ensemble of systems (see evolution_unitary_ensemble for the arguments).
+    '''
+    Usims = evolution_unitary_ensemble(optimParams, Hnats, controlHams, hamIndices, ampScales)[0]
+    
+    if optimParams.optimType == 'unitary':
+        fidelities = (np.abs(np.einsum('ij,mij->m', optimParams.Ugoal.conj(), Usims))**2)/optimParams.dimC2
+    elif optimParams.optimType == 'state2state':
+        fidelities = np.abs(np.einsum('mij,jk,mlk,li->m', Usims, optimParams.rhoStart, Usims.conj(), optimParams.rhoGoal))**2
+    else:
+        raise KeyError('Unknown optimization type.  Currently handle "unitary" or "state2state"')
+    
+    return -np.sum(weights*fidelities)
+
+def eval_pulse_batch(optimParams, systemParams, controlHams, pulses):
+    '''
+    Evaluate the goodness of a population of pulses (numCandidates x numControlHams x numTimeSteps) in one batched evolution.
+    '''
+    Usims = evolution_unitary_batch(optimParams, systemParams, controlHams, pulses)
+
+    if optimParams.optimType == 'unitary':
+        fidelities = (np.abs(np.einsum('ij,nij->n', goal_columns(optimParams).conj(), Usims))**2)/optimParams.dimC2
+    elif optimParams.optimType == 'state2state':
+        fidelities = np.abs(np.einsum('nij,jk,nlk,li->n', Usims, optimParams.rhoStart, Usims.conj(), optimParams.rhoGoal))**2
+    else:
+        raise KeyError('Unknown optimization type.  Currently handle "unitary" or "state2state"')
+
+    return -fidelities
+
+def eval_derivs_ensemble(optimParams, Hnats, controlHams, hamIndices, weights, ampScales):
+    '''
+    Evaluate the derivatives of the weighted average fidelity over an ensemble of systems.
+    '''
+    Usteps, Vs, Ds, totHams = evolution_unitary_ensemble(optimParams, Hnats, controlHams, hamIndices, ampScales)[1:]
+    
+    #Sum up the members' derivatives with the chain rule factor from the amplitude scaling
+    derivs = np.zeros((controlHams.shape[1], optimParams.numTimeSteps), dtype=np.float64)
+    for memberct, hamIndex in enumerate(hamIndices):
+        derivs += weights[memberct]*ampScales[memberct]*calc_derivs(optimParams, controlHams[hamIndex], Usteps[memberct], Vs[memberct], Ds[memberct], totHams[memberct])
+    
+    return -derivs.flatten()
+
+def eval_pulse_lindblad(optimParams, systemParams, controlHams, supDis, propResults):
+    '''
+    Evaluate the state to state fidelity of a pulse under Lindbladian dynamics. 
+    '''
+    evolution_lindblad(optimParams, systemParams, controlHams, supDis, propResults)
+    
+    #Same overlap as state2state so the two agree in the closed system limit 
+    return -np.abs(np.vdot(optimParams.rhoGoal.flatten(order='F'), propResults.rhoForward[-1]))**2
+
+def eval_derivs_lindblad(optimParams, systemParams, controlHams, supDis, propResults):
+    '''
+    Evaluate the exact derivatives of the Lindbladian state to state fidelity.  The Frechet derivative of each step's exponential comes from 
+    the divided differences of the stored eigendecomposition or from the block-triangular exponential (expm_frechet) if that was ill-conditioned.
+    '''
+    evolution_lindblad(optimParams, systemParams, controlHams, supDis, propResults)
+    
+    numSteps = optimParams.numTimeSteps
+    numControlHams = controlHams.shape[0]
+    
+    costate = optimParams.rhoGoal.flatten(order='F')
+    curOverlap = np.vdot(costate, propResults.rhoForward[-1])
+    
+    #Step backwards through the pulse with the costate 
+    derivs = np.zeros((numControlHams, numSteps), dtype=np.float64)
+    for timect in reversed(range(numSteps)):
+        #Put the Hz to rad conversion in the timestep
+        tmpTimeStep = 2*pi*optimParams.timeSteps[timect]
+        rhoj = propResults.rhoForward[timect]
+        #Direction of the generator for each control
+        supControls = [1j*tmpTimeStep*Hamiltonian(controlHams[controlct, timect]).superOpColStack() for controlct in range(numControlHams)]
+        
+        if propResults.useFrechet[timect]:
+            for controlct in range(numControlHams):
+                dFj = expm_frechet(propResults.generators[timect], supControls[controlct], compute_expm=False)
+                derivs[controlct, timect] = 2*np.real(np.conj(curOverlap)*np.vdot(costate, np.dot(dFj, rhoj)))
+            costate = np.dot(expm(propResults.generators[timect]).conj().T, costate)
+        else:
+            eigVals = propResults.eigVals[timect]
+            eigVecs = propResults.eigVecs[timect]
+            invEigVecs = propResults.invEigVecs[timect]
+            expVals = np.exp(eigVals)
+            
+            #Divided differences of the exponential with the derivative on the (near) degenerate entries
+            eigDiffs = eigVals.reshape(-1,1) - eigVals.reshape(1,-1)
+            degenerate = np.abs(eigDiffs) < 1e-10
+            divDiffs = np.where(degenerate, np.exp(0.5*(eigVals.reshape(-1,1) + eigVals.reshape(1,-1))), 
+                                (expVals.reshape(-1,1) - expVals.reshape(1,-1))/np.where(degenerate, 1, eigDiffs))
+            
+            #The overlap derivative is trace(E*M) for generator direction E so we only need one d^6 product per step for all the controls  
+            costateEig = np.dot(eigVecs.conj().T, costate)
+            tmpMat = divDiffs*np.outer(costateEig.conj(), np.dot(invEigVecs, rhoj))
+            tmpMat = np.dot(np.dot(eigVecs, tmpMat.T), invEigVecs)
+            for controlct in range(numControlHams):
+                derivs[controlct, timect] = 2*np.real(np.conj(curOverlap)*np.sum(supControls[controlct]*tmpMat.T))
+            costate = np.dot(invEigVecs.conj().T, expVals.conj()*costateEig)
+    
+    return -derivs.flatten()
+
+def eval_pulse_exact(optimParams, systemParams, controlHams, propResults):
+    '''
+    Evaluate the unitary fidelity of a pulse through the stored propagator results.
+    '''
+    evolution_unitary_exact(optimParams, systemParams, controlHams, propResults)
+    return -(np.abs(propResults.overlap)**2)/optimParams.dimC2
+
+def eval_derivs_exact(optimParams, systemParams, controlHams, propResults):
+    '''
+    Evaluate the exact derivatives of the unitary fidelity through the stored propagator results (consistent with eval_hessp).
+    '''
+    evolution_unitary_exact(optimParams, systemParams, controlHams, propResults)
+    return -((2.0/optimParams.dimC2)*np.real(np.conj(propResults.overlap)*propResults.derivOverlaps)).flatten()
+
 def eval_derivs(optimParams, systemParams, controlHams):
     '''
     Evaluate the derivatives of each control parameter with respect to the goal unitary or state.
@@ -169,30 +797,41 @@ def eval_derivs(optimParams, systemParams, controlHams):
     
     #TODO: allow incoherent distributions
 
-    #Shorten some expressions
-    dim = systemParams.dim
-    
     #Calculate the unitaries associated with the pulse and the diagonalization 
     Usteps, Vs, Ds, totHams = evolution_unitary(optimParams, systemParams, controlHams)[1:]
     
+    return -calc_derivs(optimParams, controlHams, Usteps, Vs, Ds, totHams).flatten()
+
+
+def calc_derivs(optimParams, controlHams, Usteps, Vs, Ds, totHams):
+    '''
+    Calculate the derivatives of each control parameter from the time step propagators and diagonalizations returned by evolution_unitary.
+    '''
+    #Shorten some expressions
+    dim = Usteps.shape[1]
+    numControlHams = controlHams.shape[0]
+    
     #Calculate the forward evolution up to each time step
+    #For a unitary goal on a subspace we only need its columns of the forward evolution and the matching rows of the backward evolution
     numSteps = Usteps.shape[0]
+    startCols = optimParams.subspaceBasis if (optimParams.optimType == 'unitary' and optimParams.subspaceBasis is not None) else np.eye(dim, dtype=np.complex128)
+    numCols = startCols.shape[1]
 #    Uforward = np.zeros((optimParams.numTimeSteps+1, dim, dim), dtype=np.complex128)
 #    Uforward[0] = np.eye(dim, dtype=np.complex128)
 #    for ct in range(numSteps):
 #        Uforward[ct+1] = np.dot(Usteps[ct], Uforward[ct])
         
-    Uforward = np.zeros_like(Usteps, dtype=np.complex128)
-    Uforward[0] = Usteps[0]
+    Uforward = np.zeros((numSteps, dim, numCols), dtype=np.complex128)
+    Uforward[0] = np.dot(Usteps[0], startCols)
     for ct in range(1,numSteps):
         Uforward[ct] = np.dot(Usteps[ct], Uforward[ct-1])
     
     #And now the backwards evolution
-    Uback = np.zeros_like(Usteps, dtype=np.complex128)
+    Uback = np.zeros((numSteps, dim, numCols), dtype=np.complex128)
     if optimParams.optimType == 'unitary':
-        Uback[-1] = optimParams.Ugoal
+        Uback[-1] = goal_columns(optimParams)
     elif optimParams.optimType == 'state2state':
-        Uback[-1] = np.eye(systemParams.dim, dtype = np.complex128)
+        Uback[-1] = np.eye(dim, dtype = np.complex128)
     else:
         raise KeyError('Unknown optimization type.  Currently handle "unitary" or "state2state"')
     for ct in range(1,numSteps):
@@ -200,13 +839,15 @@ def eval_derivs(optimParams, systemParams, controlHams):
 
     #Now calculate the derivatives
     #We often use the identity that trace(A^\dagger*B) = np.sum(A.conj()*B) but it doesn't seem to be any faster
-    derivs = np.zeros((systemParams.numControlHams, numSteps), dtype=np.float64)
+    derivs = np.zeros((numControlHams, numSteps), dtype=np.float64)
     if optimParams.optimType == 'unitary':
-        curOverlap = np.sum(Uforward[-1].conj()*optimParams.Ugoal)
+        curOverlap = np.sum(Uforward[-1].conj()*Uback[-1])
         for timect in range(numSteps):
             #Put the Hz to rad conversion in the timestep
             tmpTimeStep = 2*pi*optimParams.timeSteps[timect]
-            for controlct in range(systemParams.numControlHams):
+            #The evolution before this time step
+            Ubefore = startCols if timect == 0 else Uforward[timect-1]
+            for controlct in range(numControlHams):
                 #See Machnes, S., Sander, U., Glaser, S. J., Fouquieres, P., Gruslys, A., Schirmer, S., & Schulte-Herbrueggen, T. (2010). Comparing, Optimising and Benchmarking Quantum Control Algorithms in a  Unifying Programming Framework. arXiv, quant-ph. Retrieved from http://arxiv.org/abs/1011.4874v2
                 if optimParams.derivType == 'exact':
                     #Exact method
@@ -219,27 +860,20 @@ def eval_derivs(optimParams, systemParams, controlHams):
                                 eigenFrameDeriv[rowct, colct] = -1j*tmpTimeStep*eigenFrameControlHam[rowct,colct]*np.exp(-1j*tmpTimeStep*Ds[timect][rowct])
                             else:
                                 eigenFrameDeriv[rowct, colct] = eigenFrameControlHam[rowct,colct]*((np.exp(-1j*tmpTimeStep*Ds[timect][rowct]) - np.exp(-1j*tmpTimeStep*Ds[timect][colct]))/diff)
-                    propFrameDeriv = np.dot(Vs[timect], np.dot(eigenFrameDeriv, Vs[timect].conj().T))
-                    dUjduk = propFrameDeriv
-                    if timect == 0:
-                        derivs[controlct, timect] =  (2.0/optimParams.dimC2)*np.real(np.sum(Uback[timect].conj()*dUjduk) * curOverlap)
-                    else:
-                        derivs[controlct, timect] =  (2.0/optimParams.dimC2)*np.real(np.sum(Uback[timect].conj()*np.dot(dUjduk, Uforward[timect-1])) * curOverlap)
+                    #Apply the derivative to the forward columns from the right so the products are dim x dim x numCols
+                    dUjdukForward = np.dot(Vs[timect], np.dot(eigenFrameDeriv, np.dot(Vs[timect].conj().T, Ubefore)))
+                    derivs[controlct, timect] =  (2.0/optimParams.dimC2)*np.real(np.sum(Uback[timect].conj()*dUjdukForward) * curOverlap)
     
                 elif optimParams.derivType == 'approx':
                     #Approximate method
-                    derivs[controlct, timect] = (2/optimParams.dimC2)*tmpTimeStep*np.imag(np.trace(np.dot(Uback[timect].conj().T, \
-                            np.dot(controlHams[controlct,timect], Uforward[timect]))) * curOverlap)
+                    derivs[controlct, timect] = (2/optimParams.dimC2)*tmpTimeStep*np.imag(np.sum(Uback[timect].conj()*np.dot(controlHams[controlct,timect], Uforward[timect])) * curOverlap)
 
                 elif optimParams.derivType == 'finiteDiff':
                     #Finite difference approach
                     tmpU1 = expm_eigen(totHams[timect] + 1e-6*controlHams[controlct,timect], -1j*tmpTimeStep)[0]
                     tmpU2 = expm_eigen(totHams[timect] - 1e-6*controlHams[controlct,timect], -1j*tmpTimeStep)[0]
                     dUjduk = (tmpU1-tmpU2)/2e-6
-                    if timect == 0:
-                        derivs[controlct, timect] =  (2.0/optimParams.dimC2)*np.real(np.sum(Uback[timect].conj()*dUjduk) * curOverlap)
-                    else:
-                        derivs[controlct, timect] =  (2.0/optimParams.dimC2)*np.real(np.sum(Uback[timect].conj()*np.dot(dUjduk, Uforward[timect-1])) * curOverlap)
+                    derivs[controlct, timect] =  (2.0/optimParams.dimC2)*np.real(np.sum(Uback[timect].conj()*np.dot(dUjduk, Ubefore)) * curOverlap)
                     
                 else:
                     raise NameError('Unknown derivative type for unitary search.')
@@ -252,18 +886,191 @@ def eval_derivs(optimParams, systemParams, controlHams):
                 tmpTimeStep = 2*pi*optimParams.timeSteps[timect]
                 rhoj = np.dot(np.dot(Uforward[timect], optimParams.rhoStart), Uforward[timect].conj().T)
                 lambdaj = np.dot(np.dot(Uback[timect], optimParams.rhoGoal), Uback[timect].conj().T)
-                for controlct in range(systemParams.numControlHams):
+                for controlct in range(numControlHams):
                     derivs[controlct, timect] = 2*tmpTimeStep*np.imag(np.sum(lambdaj.conj()*(np.dot(controlHams[controlct,timect], rhoj) - np.dot(rhoj, controlHams[controlct,timect])))*tmpMult)
         else:
             raise NameError('Unknown derivative type for state to state.')
                     
-    return -derivs.flatten()
+    return derivs
                     
         
+def optimize_krotov(optimParams, systemParams, controlHams, startPulse, ampBounds, callback=None):
+    '''
+    Krotov style sequential update optimization.  We sweep through the pixels updating each one from the gradient with the current forward
+    evolution (which already includes this sweep's updates) and the backward costate of the previous pulse.  The forward propagator is updated
+    incrementally with a single exponential per pixel.  Sweeps that lower the fidelity are rejected and retried with a smaller step so the 
+    fidelity increases monotonically.  The optional callback is called after each accepted sweep with the pulse (flattened), the goodness and 
+    the norm of the sweep's pixel gradients.  Returns the optimized pulse (flattened), the final goodness and the number of sweeps.   
+    '''
+    numControlHams, numSteps = startPulse.shape
+    taus = 2*pi*optimParams.timeSteps
+    
+    def calc_fidelity(Uout):
+        if optimParams.optimType == 'unitary':
+            return (np.abs(np.sum(optimParams.Ugoal.conj()*Uout))**2)/optimParams.dimC2
+        elif optimParams.optimType == 'state2state':
+            rhoOut = np.dot(np.dot(Uout, optimParams.rhoStart), Uout.conj().T)
+            return np.abs(np.sum(rhoOut.T*optimParams.rhoGoal))**2
+        else:
+            raise KeyError('Unknown optimization type.  Krotov currently handles "unitary" or "state2state"')
+    
+    #Propagate the starting pulse and pull out the drift part of each step's Hamiltonian 
+    curPulse = np.copy(startPulse)
+    optimParams.controlAmps = curPulse
+    propResults = PropResults()
+    evolution_unitary_sweeps(optimParams, systemParams, controlHams, propResults)
+    driftHams = propResults.totHams - np.einsum('ct,ctij->tij', curPulse, controlHams)
+    curFidelity = calc_fidelity(propResults.Uforward[-1])
+    
+    #Choose the first step size so the largest pixel update is a small fraction of the pulse
+    derivs = calc_derivs(optimParams, controlHams, propResults.Us, propResults.Vs, propResults.Ds, propResults.totHams)
+    stepSize = 0.1*max(np.max(np.abs(curPulse)), 1.0)/max(np.max(np.abs(derivs)), 1e-12)
+    minStepSize = 1e-12*stepSize
+    
+    numSweeps = 0
+    while numSweeps < optimParams.maxfun and stepSize > minStepSize:
+        #Overlap of the previous pulse for the costate
+        if optimParams.optimType == 'unitary':
+            curOverlap = np.sum(propResults.Uforward[-1].conj()*optimParams.Ugoal)
+        else:
+            rhoSim = np.dot(np.dot(propResults.Uforward[-1], optimParams.rhoStart), propResults.Uforward[-1].conj().T)
+            tmpMult = np.sum(rhoSim.T*optimParams.rhoGoal)
+        
+        newPulse = np.copy(curPulse)
+        newUs = np.zeros_like(propResults.Us)
+        newDs = np.zeros_like(propResults.Ds)
+        newVs = np.zeros_like(propResults.Vs)
+        newHams = np.zeros_like(propResults.totHams)
+        curU = np.eye(propResults.Ds.shape[1], dtype=np.complex128)
+        sweepGrads = np.zeros_like(curPulse)
+        for timect in range(numSteps):
+            #Forward evolution through this pixel with the previous amplitude
+            tmpU = np.dot(propResults.Us[timect], curU)
+            
+            #Gradient for this pixel (see the approximate derivatives in calc_derivs) 
+            if optimParams.optimType == 'unitary':
+                tmpMat = np.dot(tmpU, propResults.Uback[timect].conj().T)
+                grads = (2.0/optimParams.dimC2)*taus[timect]*np.imag(np.einsum('cij,ji->c', controlHams[:,timect], tmpMat)*curOverlap)
+            else:
+                rhoj = np.dot(np.dot(tmpU, optimParams.rhoStart), tmpU.conj().T)
+                lambdaj = np.dot(np.dot(propResults.Uback[timect], optimParams.rhoGoal), propResults.Uback[timect].conj().T)
+                grads = np.array([2*taus[timect]*np.imag(np.sum(lambdaj.conj()*(np.dot(controlHams[controlct,timect], rhoj) - np.dot(rhoj, controlHams[controlct,timect])))*tmpMult) 
+                                  for controlct in range(numControlHams)])
+            
+            #Update the pixel and the running forward propagator 
+            sweepGrads[:,timect] = grads
+            newPulse[:,timect] = np.clip(curPulse[:,timect] + stepSize*grads, -ampBounds[:,timect], ampBounds[:,timect])
+            newHams[timect] = driftHams[timect] + np.einsum('c,cij->ij', newPulse[:,timect], controlHams[:,timect])
+            newUs[timect], newDs[timect], newVs[timect] = expm_eigen(newHams[timect], -1j*taus[timect])
+            curU = np.dot(newUs[timect], curU)
+        numSweeps += 1
+        
+        newFidelity = calc_fidelity(curU)
+        if newFidelity > curFidelity:
+            #Accept the sweep and update the backward evolution for the next one
+            improvement = newFidelity - curFidelity
+            curPulse, curFidelity = newPulse, newFidelity
+            propResults.Us, propResults.Ds, propResults.Vs, propResults.totHams = newUs, newDs, newVs, newHams
+            calc_forward_backward(optimParams, propResults)
+            stepSize *= 1.5
+            if callback is not None:
+                callback(curPulse.flatten(), -curFidelity, np.linalg.norm(sweepGrads))
+            if improvement < optimParams.fTol:
+                break
+        else:
+            stepSize *= 0.5
+    
+    optimParams.controlAmps = curPulse
+    
+    return curPulse.flatten(), -curFidelity, numSweeps
+        
+def calc_bandwidth_filter(controlLine, timeStep):
+    '''
+    Helper function for the Gaussian impulse response of a finite bandwidth control line sampled at the time step.  
+    Returns the number of points on either side of the center and the normalized impulse response.
+    '''
+    if controlLine.bandwidth < np.inf:
+        #If the bandwidth is defined as the -3dB point and the frequency response is defined as exp(-(pi*f)**2/alpha then alpha = (pi*f_3dB)**2/log2
+        alpha = (np.pi*controlLine.bandwidth)**2/np.log(2)
+        #Then in the impulse response in the time domain is exp(-t^2*alpha) and we want to go out to 2.5sigma to ensure we start small
+        tmax = 2.5/np.sqrt(alpha)
+        #Number of points we need (assuming equal spacing)
+        numPts = int(np.ceil(tmax/timeStep))
+        #Define the Gaussian impulse response and normalize
+        impulseResponse = np.exp(-alpha*(timeStep*np.linspace(-numPts, numPts, 2*numPts+1))**2)
+        impulseResponse /= np.sum(impulseResponse)
+    else:
+        numPts = 0
+        impulseResponse = np.ones(1, dtype=np.float64)
+    
+    return numPts, impulseResponse
+
+def calc_channel_filter(controlLine, timeStep):
+    '''
+    Helper function for the impulse response of a control line for filtering in the loop.  Returns the FIR taps sampled at the time step 
+    and the delay in points of the output: the user supplied impulse response is taken as causal and the bandwidth Gaussian as centered.
+    '''
+    if controlLine.impulseResponse is not None:
+        return np.asarray(controlLine.impulseResponse, dtype=np.float64), 0
+    numPts, impulseResponse = calc_bandwidth_filter(controlLine, timeStep)
+    return impulseResponse, numPts
+
+def filter_pulse(pulseIn, channelFilters):
+    '''
+    Convolve each control line's pulse with its (taps, delay) channel filter keeping the pulse length. 
+    '''
+    numSteps = pulseIn.shape[1]
+    return np.array([fftconvolve(tmpAmps, taps)[delay:delay+numSteps] for tmpAmps, (taps, delay) in zip(pulseIn, channelFilters)])
+
+def filter_pulse_adjoint(gradIn, channelFilters):
+    '''
+    Adjoint of filter_pulse for pulling gradients back through the channel filters: correlation with the taps.
+    '''
+    numSteps = gradIn.shape[1]
+    return np.array([fftconvolve(tmpGrad, taps[::-1])[taps.size-1-delay:taps.size-1-delay+numSteps] for tmpGrad, (taps, delay) in zip(gradIn, channelFilters)])
+
+def coarsen_time_steps(timeSteps):
+    '''
+    Merge neighbouring pairs of time steps for the next coarser multigrid level (an odd last step is kept on its own).
+    '''
+    return np.add.reduceat(timeSteps, np.arange(0, timeSteps.size, 2))
+
+def coarsen_pulse(pulseIn, timeSteps):
+    '''
+    Time weighted average of the pulse over the pairs of time steps merged by coarsen_time_steps.
+    '''
+    groupStarts = np.arange(0, timeSteps.size, 2)
+    return np.add.reduceat(pulseIn*timeSteps, groupStarts, axis=1)/np.add.reduceat(timeSteps, groupStarts)
+
+def interpolate_pulse(pulseIn, timeStepsIn, timeStepsOut):
+    '''
+    Linearly interpolate a pulse between time grids using the pixel centers.  
+    '''
+    centersIn = np.cumsum(timeStepsIn) - 0.5*timeStepsIn
+    centersOut = np.cumsum(timeStepsOut) - 0.5*timeStepsOut
+    return np.array([np.interp(centersOut, centersIn, tmpAmps) for tmpAmps in pulseIn])
+
+def grid_supports_bandwidth(optimParams, timeSteps):
+    '''
+    Check whether a time grid has enough points for the bandwidth filtering of every control line.
+    '''
+    return all([timeSteps.size > 2*calc_bandwidth_filter(tmpControl, timeSteps[0])[0] for tmpControl in optimParams.controlLines])
+
 def optimize_pulse(optimParams, systemParams):
     '''
-    Main entry point for pulse optimization. 
+    Main entry point for pulse optimization.  The optimized pulse is left in optimParams.controlAmps.
+    The optimization works on internal rescaled copies so neither systemParams nor optimParams is modified besides the outputs (controlAmps, 
+    driveAmps and startControlAmps) and they can be shared by optimizations running in other threads.
+    The optimization stops early when optimParams.targetFidelity is reached, the optimParams.maxTime wall clock budget is used up
+    or optimParams.callback returns True. 
+    Returns a dictionary with the final fidelity (the negative of the optimizer's goodness), the number of iterations, the reason for stopping
+    and the history of the fidelity, gradient norm and elapsed time at each iteration. 
     '''
+    startTime = time.time()
+    
+    #Work on a copy so the derived settings below never leak onto the caller's parameters 
+    callerParams = optimParams
+    optimParams = copy(callerParams)
     
     #Create the initial pulse
     if optimParams.startControlAmps is None:
@@ -275,23 +1082,140 @@ def optimize_pulse(optimParams, systemParams):
     #We use this for normalizing the results
     optimParams.dimC2 = np.abs(np.trace(np.dot(optimParams.Ugoal.conj().T, optimParams.Ugoal)))**2 if optimParams.optimType == 'unitary' else 0
     
+    #If the goal is only defined on a subspace we just propagate its columns
+    if optimParams.subspace is not None:
+        assert optimParams.optimType == 'unitary', 'Oops! Subspace propagation only handles unitary goals.'
+        assert np.allclose(np.dot(optimParams.Ugoal, np.eye(optimParams.dim) - optimParams.subspace), 0), 'Oops! The goal unitary has to be zero outside the subspace.'
+        optimParams.subspaceBasis = calc_subspace_basis(optimParams.subspace)
+    else:
+        optimParams.subspaceBasis = None
+    
+    assert not (optimParams.ensemble and optimParams.optimType == 'lindblad'), 'Oops! Ensemble optimization only handles closed systems.'
+    assert optimParams.optimMethod != 'newton' or (optimParams.optimType == 'unitary' and not optimParams.ensemble), 'Oops! The Newton optimizer only handles a single system with a unitary goal.'
+    assert optimParams.optimMethod != 'krotov' or (optimParams.optimType in ['unitary', 'state2state'] and not optimParams.ensemble), 'Oops! The Krotov optimizer only handles a single closed system.'
+    assert optimParams.optimMethod != 'krotov' or optimParams.basis is None, 'Oops! The Krotov optimizer only updates pixels.'
+    assert optimParams.optimMethod != 'krotov' or not optimParams.filterControls, 'Oops! The Krotov optimizer only updates pixels.'
+    assert optimParams.numGridLevels == 1 or optimParams.basis is None, 'Oops! Multigrid optimization only coarsens pixels.'
+    assert optimParams.numGridLevels == 1 or not optimParams.filterControls or all([tmpControl.impulseResponse is None for tmpControl in optimParams.controlLines]), \
+        'Oops! FIR impulse responses are sampled at the time step so we cannot coarsen the time grid.'
+    
+    #Look for a checkpoint of this problem to resume from
+    problemKey = problem_key(optimParams, systemParams)
+    checkpoint = load_checkpoint(optimParams, problemKey)
+    
+    #Multigrid: solve on a coarser time grid first and interpolate the solution up for the starting pulse
+    #We stop coarsening when the grid gets too short for the bandwidth filtering or has only a few points
+    if optimParams.numGridLevels > 1 and checkpoint is None:
+        coarseTimeSteps = coarsen_time_steps(optimParams.timeSteps)
+        if coarseTimeSteps.size >= 4 and grid_supports_bandwidth(optimParams, coarseTimeSteps):
+            coarseParams = copy(optimParams)
+            coarseParams.timeSteps = coarseTimeSteps
+            coarseParams.numGridLevels -= 1
+            coarseParams.checkpointFile = None
+            coarseParams.startControlAmps = coarsen_pulse(curPulse, optimParams.timeSteps)
+            #The coarse levels come out of the same time budget
+            if optimParams.maxTime is not None:
+                coarseParams.maxTime = optimParams.maxTime - (time.time() - startTime)
+            optimize_pulse(coarseParams, systemParams)
+            #Warm start from the coarse drive rather than the filtered controls so the filters are only applied once
+            curPulse = interpolate_pulse(coarseParams.driveAmps, coarseTimeSteps, optimParams.timeSteps)
+    
     #Calculate the interaction frame Hamiltonians
-    controlHams_int = calc_control_Hams(optimParams, systemParams)
+    if optimParams.ensemble:
+        ensembleSystems = [tmpMember['systemParams'] for tmpMember in optimParams.ensemble]
+        controlHams_int, hamIndices = calc_ensemble_control_Hams(optimParams, ensembleSystems)
+    else:
+        controlHams_int = calc_control_Hams(optimParams, systemParams)
 
     #Rescale time to ensure the derivatives aren't limited by numerical accuracy
+    #We work on rescaled copies so the caller's system and pulse parameters are never modified and concurrent optimizations can share them
     pulseTime = np.sum(optimParams.timeSteps)
-    optimParams.timeSteps /= pulseTime
-    systemParams.Hnat.matrix *= pulseTime
-    if optimParams.H_int is not None:
-        optimParams.H_int.matrix *= pulseTime
+    optimParams.timeSteps = callerParams.timeSteps/pulseTime
+    if callerParams.H_int is not None:
+        optimParams.H_int = Hamiltonian(pulseTime*callerParams.H_int.matrix)
+    systemParams = copy(systemParams)
+    systemParams.Hnat = Hamiltonian(pulseTime*systemParams.Hnat.matrix)
     curPulse *= pulseTime
     
+    if optimParams.ensemble:
+        #Normalize the weights and rescale copies of the members' drift Hamiltonians
+        ensembleWeights = np.array([tmpMember['weight'] for tmpMember in optimParams.ensemble], dtype=np.float64)
+        ensembleWeights /= np.sum(ensembleWeights)
+        ensembleScales = np.array([tmpMember['ampScale'] for tmpMember in optimParams.ensemble], dtype=np.float64)
+        ensembleHnats = pulseTime*np.array([tmpSys.Hnat.matrix for tmpSys in ensembleSystems], dtype=np.complex128)
+    
     '''
     Create some helper functions for the goodness and derivative evaluation
     If we are using the C++ backend then we define some C classes to store C pointers to the data and control Hamiltonians and temporary propagator results
     which we can then pass to the evaluator functions.
+    The population optimizer evaluates a whole generation at once through tmpEvalPulseBatch where the backend can batch it.
     '''
-    if CPPBackEnd:
+    tmpEvalPulseBatch = None
+    if optimParams.optimMethod == 'newton':
+        #The second order optimization is only done in python.  All the evaluations at a pulse share one set of propagator results. 
+        propResults = PropResults()
+        
+        def tmpEvalPulse(pulseIn):
+            optimParams.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+            return eval_pulse_exact(optimParams, systemParams, controlHams_int, propResults)
+        
+        def tmpEvalDerivs(pulseIn):
+            optimParams.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+            return eval_derivs_exact(optimParams, systemParams, controlHams_int, propResults)
+        
+        def tmpEvalHessp(pulseIn, vecIn):
+            optimParams.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+            return eval_hessp(optimParams, systemParams, controlHams_int, propResults, vecIn)
+    
+    elif optimParams.optimType == 'lindblad':
+        #The open system optimization is only done in python.  The (rescaled) dissipators are summed into a single superoperator.
+        supDis = np.zeros((systemParams.dim**2, systemParams.dim**2), dtype=np.complex128)
+        for tmpDis in systemParams.dissipators:
+            supDis += pulseTime*tmpDis.superOpColStack()
+        lindbladPropResults = LindbladPropResults(optimParams.numTimeSteps, systemParams.dim)
+        
+        def tmpEvalPulse(pulseIn):
+            optimParams.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+            return eval_pulse_lindblad(optimParams, systemParams, controlHams_int, supDis, lindbladPropResults)
+        
+        def tmpEvalDerivs(pulseIn):
+            optimParams.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+            return eval_derivs_lindblad(optimParams, systemParams, controlHams_int, supDis, lindbladPropResults)
+    
+    elif CPPBackEnd and optimParams.ensemble:
+        #Each member gets its own C++ system and propagator storage but members share the interaction frame control Hamiltonians
+        #The C++ evaluators then run over the members in parallel
+        optimParams_CPP = PySim.CySim.PyOptimParams(optimParams)
+        uniqueControlHams_CPP = [PySim.CySim.PyControlHams_int(tmpHams) for tmpHams in controlHams_int]
+        memberSystems = []
+        for tmpSys, tmpHnat in zip(ensembleSystems, ensembleHnats):
+            memberSys = copy(tmpSys)
+            memberSys.Hnat = Hamiltonian(tmpHnat)
+            memberSystems.append(memberSys)
+        ensemble_CPP = PySim.CySim.PyEnsemble([PySim.CySim.PySystemParams(memberSys, ampScale) for memberSys, ampScale in zip(memberSystems, ensembleScales)],
+                                              [uniqueControlHams_CPP[hamIndex] for hamIndex in hamIndices],
+                                              [PySim.CySim.PyPropResults(optimParams.numTimeSteps, systemParams.dim) for _ in memberSystems],
+                                              ensembleWeights)
+        
+        def tmpEvalPulse(pulseIn):
+            optimParams_CPP.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+            return PySim.CySim.Cy_eval_pulse_ensemble(optimParams_CPP, ensemble_CPP)
+        
+        def tmpEvalDerivs(pulseIn):
+            optimParams_CPP.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+            return PySim.CySim.Cy_eval_derivs_ensemble(optimParams_CPP, ensemble_CPP)
+    
+    elif optimParams.ensemble:
+        
+        def tmpEvalPulse(pulseIn):
+            optimParams.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+            return eval_pulse_ensemble(optimParams, ensembleHnats, controlHams_int, hamIndices, ensembleWeights, ensembleScales)
+        
+        def tmpEvalDerivs(pulseIn):
+            optimParams.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+            return eval_derivs_ensemble(optimParams, ensembleHnats, controlHams_int, hamIndices, ensembleWeights, ensembleScales)
+        
+    elif CPPBackEnd:
         controlHams_int_CPP = PySim.CySim.PyControlHams_int(controlHams_int)
         optimParams_CPP = PySim.CySim.PyOptimParams(optimParams)
         systemParams_CPP = PySim.CySim.PySystemParams(systemParams)
@@ -301,14 +1225,24 @@ def optimize_pulse(optimParams, systemParams):
             optimParams_CPP.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
             return PySim.CySim.Cy_eval_pulse(optimParams_CPP, systemParams_CPP, controlHams_int_CPP, propResults_CPP)
         
+        if optimParams.optimMethod == 'evolution':
+            #One set of propagator storage per C++ thread which the candidates are spread over
+            propResultsPool_CPP = PySim.CySim.PyPropResultsPool(optimParams.numTimeSteps, systemParams.dim)
+            
+            def tmpEvalPulseBatch(pulsesIn):
+                return PySim.CySim.Cy_eval_pulse_batch(optimParams_CPP, systemParams_CPP, controlHams_int_CPP, propResultsPool_CPP, pulsesIn)
+        
         def tmpEvalDerivs(pulseIn):
-            optimParams.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+            optimParams_CPP.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
             return PySim.CySim.Cy_eval_derivs(optimParams_CPP, systemParams_CPP, controlHams_int_CPP, propResults_CPP)
     else:
     
         def tmpEvalPulse(pulseIn):
             optimParams.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
             return eval_pulse(optimParams, systemParams, controlHams_int)
+        
+        def tmpEvalPulseBatch(pulsesIn):
+            return eval_pulse_batch(optimParams, systemParams, controlHams_int, pulsesIn.reshape((-1, optimParams.numControlLines, optimParams.numTimeSteps)))
             
         def tmpEvalDerivs(pulseIn):
             optimParams.controlAmps = pulseIn.reshape((optimParams.numControlLines, optimParams.numTimeSteps))
@@ -331,50 +1265,345 @@ def optimize_pulse(optimParams, systemParams):
             
             return eval_derivs(optimParams, systemParams, controlHams_int)
     
+    #Otherwise evaluate the population one candidate at a time
+    if tmpEvalPulseBatch is None:
+        scalarEvalPulse = tmpEvalPulse
+        
+        def tmpEvalPulseBatch(pulsesIn):
+            return np.array([scalarEvalPulse(pulseIn) for pulseIn in pulsesIn])
+    
     #We can use these to take into account power limits and to squeeze the pulse down to zero and the start and finish for finite bandwidth concerns
     #We'll use a Gaussian filter to achieve a ramp up and ramp down on the pulse edges 
     #Setup bounds at the maximum drive frequency
+    #If the channel filters are in the loop then they take care of the bandwidth and the bounds are just on the unfiltered drive
     timeStep = pulseTime*optimParams.timeSteps[0]
     tmpBounds = np.inf*np.ones_like(curPulse, dtype=np.float64)
     for controlct, tmpControl in enumerate(optimParams.controlLines):
-        if tmpControl.bandwidth < np.inf:
-            #If the bandwidth is defined as the -3dB point and the frequency response is defined as exp(-(pi*f)**2/alpha then alpha = (pi*f_3dB)**2/log2
-            alpha = (np.pi*tmpControl.bandwidth)**2/np.log(2)
-            #Then in the impulse response in the time domain is exp(-t^2*alpha) and we want to go out to 2.5sigma to ensure we start small
-            tmax = 2.5/np.sqrt(alpha)
-            #Number of points we need (assuming equal spacing)
-            numPts = np.ceil(tmax/timeStep)
-            #Make sure we have enough points in the pulse (this could be handled more gracefully)
-            assert optimParams.numTimeSteps > 2*numPts, 'Error: unable to handle such a short pulse with the channel bandwidth.  Need at least {0} points for filtering.'.format(2*numPts+1)
-            #Define the Gaussian impulse response and normalize
-            impulseResponse = np.exp(-alpha*(timeStep*np.linspace(-numPts, numPts, 2*numPts+1))**2)
-            impulseResponse /= np.sum(impulseResponse)
-        else:
-            numPts = 0
-            impulseResponse = np.ones(1, dtype=np.float64)
-
+        if optimParams.filterControls:
+            tmpBounds[controlct] = tmpControl.maxAmp
+            continue
+        numPts, impulseResponse = calc_bandwidth_filter(tmpControl, timeStep)
+        #Make sure we have enough points in the pulse (this could be handled more gracefully)
+        assert optimParams.numTimeSteps > 2*numPts, 'Error: unable to handle such a short pulse with the channel bandwidth.  Need at least {0} points for filtering.'.format(2*numPts+1)
         tmpBounds[controlct] = tmpControl.maxAmp*np.convolve(impulseResponse, np.ones(optimParams.numTimeSteps-2*numPts))
 
     tmpBounds *= pulseTime
     bounds = [(-x, x) for x in tmpBounds.flatten()]
+    
+    #The optimizer may work with parameters other than the pixel amplitudes.  We keep chains of linear maps with their adjoints to pull
+    #the pixel gradients back: from the optimization parameters to the bounded drive (the basis expansion) and from the drive to the
+    #amplitudes the system sees (the channel filters).  
+    paramTransforms = []
+    channelTransforms = []
+    startParams = curPulse
+    if optimParams.basis is not None:
+        basisMat = calc_pulse_basis(optimParams)
+        paramTransforms.append((lambda paramsIn: np.dot(paramsIn, basisMat.T), lambda gradIn: np.dot(gradIn, basisMat)))
+        #Least squares fit of the starting pulse 
+        startParams = np.linalg.lstsq(basisMat, curPulse.T, rcond=None)[0].T
+    if optimParams.filterControls:
+        channelFilters = [calc_channel_filter(tmpControl, timeStep) for tmpControl in optimParams.controlLines]
+        channelTransforms.append((lambda pulseIn: filter_pulse(pulseIn, channelFilters), lambda gradIn: filter_pulse_adjoint(gradIn, channelFilters)))
+    
+    def apply_transforms(transforms, pulseIn):
+        for forwardMap, _ in transforms:
+            pulseIn = forwardMap(pulseIn)
+        return pulseIn
+    
+    def apply_adjoints(transforms, gradIn):
+        for _, adjointMap in reversed(transforms):
+            gradIn = adjointMap(gradIn)
+        return gradIn
+    
+    if paramTransforms or channelTransforms:
+        paramShape = startParams.shape
+        pulseShape = curPulse.shape
+        
+        #If the parameters are unbounded the drive amplitude bounds become a quadratic penalty on the excess
+        penaltyWeight = 100.0 if paramTransforms else 0.0
+        pixelBounds = tmpBounds
+        pixelEvalPulse, pixelEvalDerivs, pixelEvalPulseBatch = tmpEvalPulse, tmpEvalDerivs, tmpEvalPulseBatch
+        
+        def tmpEvalPulse(paramsIn):
+            drivePulse = apply_transforms(paramTransforms, paramsIn.reshape(paramShape))
+            excessAmps = np.maximum(np.abs(drivePulse) - pixelBounds, 0)
+            return pixelEvalPulse(apply_transforms(channelTransforms, drivePulse).flatten()) + penaltyWeight*np.sum(excessAmps**2)
         
+        def tmpEvalPulseBatch(paramsIn):
+            drivePulses = [apply_transforms(paramTransforms, tmpParams.reshape(paramShape)) for tmpParams in paramsIn]
+            penalties = np.array([penaltyWeight*np.sum(np.maximum(np.abs(drivePulse) - pixelBounds, 0)**2) for drivePulse in drivePulses])
+            return pixelEvalPulseBatch(np.array([apply_transforms(channelTransforms, drivePulse).flatten() for drivePulse in drivePulses])) + penalties
+        
+        def tmpEvalDerivs(paramsIn):
+            drivePulse = apply_transforms(paramTransforms, paramsIn.reshape(paramShape))
+            excessAmps = np.maximum(np.abs(drivePulse) - pixelBounds, 0)
+            driveDerivs = apply_adjoints(channelTransforms, pixelEvalDerivs(apply_transforms(channelTransforms, drivePulse).flatten()).reshape(pulseShape))
+            return apply_adjoints(paramTransforms, driveDerivs + 2*penaltyWeight*np.sign(drivePulse)*excessAmps).flatten()
+        
+        if optimParams.optimMethod == 'newton':
+            pixelEvalHessp = tmpEvalHessp
+            
+            def tmpEvalHessp(paramsIn, vecIn):
+                drivePulse = apply_transforms(paramTransforms, paramsIn.reshape(paramShape))
+                driveVec = apply_transforms(paramTransforms, vecIn.reshape(paramShape))
+                tmpProduct = pixelEvalHessp(apply_transforms(channelTransforms, drivePulse).flatten(), apply_transforms(channelTransforms, driveVec).flatten())
+                driveProduct = apply_adjoints(channelTransforms, tmpProduct.reshape(pulseShape))
+                return apply_adjoints(paramTransforms, driveProduct + 2*penaltyWeight*(np.abs(drivePulse) > pixelBounds)*driveVec).flatten()
+        
+        if paramTransforms:
+            tmpBounds = np.inf*np.ones_like(startParams, dtype=np.float64)
+            bounds = [(None, None)]*startParams.size
+    
+    #Resume from the checkpoint
+    numPrevIterations = 0
+    sPairs, yPairs = [], []
+    if checkpoint is not None:
+        startParams = checkpoint['params'].reshape(startParams.shape)
+        numPrevIterations = int(checkpoint['numIterations'])
+        sPairs, yPairs = list(checkpoint['sPairs']), list(checkpoint['yPairs'])
+        
+    #Keep the last evaluations so the iteration callback can look up the goodness and gradient at the current point
+    lastEval = {'params':None, 'goodness':None, 'derivParams':None, 'derivs':None}
+    innerEvalPulse, innerEvalDerivs, innerEvalPulseBatch = tmpEvalPulse, tmpEvalDerivs, tmpEvalPulseBatch
+    
+    def tmpEvalPulse(paramsIn):
+        lastEval['goodness'] = innerEvalPulse(paramsIn)
+        lastEval['params'] = np.copy(paramsIn)
+        return lastEval['goodness']
+    
+    def tmpEvalPulseBatch(paramsIn):
+        #Keep the best of the population which is usually the iterate passed to the callback
+        goodnesses = innerEvalPulseBatch(paramsIn)
+        bestct = np.argmin(goodnesses)
+        lastEval['goodness'], lastEval['params'] = goodnesses[bestct], np.copy(paramsIn[bestct])
+        return goodnesses
+    
+    def tmpEvalDerivs(paramsIn):
+        lastEval['derivs'] = innerEvalDerivs(paramsIn)
+        lastEval['derivParams'] = np.copy(paramsIn)
+        return lastEval['derivs']
+    
+    #Record the convergence history after each iteration, save checkpoints and check the stopping rules
+    history = {'fidelity':[], 'gradNorm':[], 'time':[]}
+    lastIterate = {'params':startParams.flatten(), 'goodness':None, 'derivs':None}
+    
+    def record_iteration(paramsIn, goodness=None, gradNorm=None):
+        if goodness is None:
+            goodness = lastEval['goodness'] if np.array_equal(lastEval['params'], paramsIn) else innerEvalPulse(paramsIn)
+        #Krotov passes its own gradient norm and has no gradient for the memory pairs
+        derivs = None
+        if gradNorm is None:
+            derivs = lastEval['derivs'] if np.array_equal(lastEval['derivParams'], paramsIn) else innerEvalDerivs(paramsIn)
+            gradNorm = np.linalg.norm(derivs)
+        
+        #Keep the last few L-BFGS style memory pairs for the checkpoint 
+        if derivs is not None and lastIterate['derivs'] is not None:
+            sPairs.append(paramsIn - lastIterate['params'])
+            yPairs.append(derivs - lastIterate['derivs'])
+            del sPairs[:-10], yPairs[:-10]
+        lastIterate['params'], lastIterate['goodness'], lastIterate['derivs'] = np.copy(paramsIn), goodness, derivs
+        history['fidelity'].append(-goodness)
+        history['gradNorm'].append(gradNorm)
+        history['time'].append(time.time() - startTime)
+        numIterations = numPrevIterations + len(history['time'])
+        
+        if optimParams.checkpointFile is not None and numIterations % optimParams.checkpointInterval == 0:
+            save_checkpoint(optimParams, problemKey, paramsIn, sPairs, yPairs, numIterations)
+        
+        if optimParams.targetFidelity is not None and -goodness >= optimParams.targetFidelity:
+            raise StopOptimization('targetFidelity')
+        if optimParams.maxTime is not None and history['time'][-1] >= optimParams.maxTime:
+            raise StopOptimization('maxTime')
+        if optimParams.callback is not None and optimParams.callback({'iteration':numIterations, 'fidelity':-goodness, 'gradNorm':gradNorm, 'time':history['time'][-1]}):
+            raise StopOptimization('callback')
+    
+    #On resuming use the checkpoint's memory pairs to precondition the optimizer with a diagonal change of variables 
+    if sPairs and optimParams.optimMethod not in ['krotov', 'evolution']:
+        paramScale = calc_checkpoint_scaling(np.array(sPairs), np.array(yPairs))
+        unscaledEvalPulse, unscaledEvalDerivs = tmpEvalPulse, tmpEvalDerivs
+        unscaledRecordIteration = record_iteration
+        
+        def tmpEvalPulse(paramsIn):
+            return unscaledEvalPulse(paramScale*paramsIn)
+        
+        def tmpEvalDerivs(paramsIn):
+            return paramScale*unscaledEvalDerivs(paramScale*paramsIn)
+        
+        if optimParams.optimMethod == 'newton':
+            unscaledEvalHessp = tmpEvalHessp
+            
+            def tmpEvalHessp(paramsIn, vecIn):
+                return paramScale*unscaledEvalHessp(paramScale*paramsIn, paramScale*vecIn)
+        
+        def record_iteration(paramsIn, goodness=None, gradNorm=None):
+            unscaledRecordIteration(paramScale*paramsIn, goodness, gradNorm)
+        
+        startParams = startParams.flatten()/paramScale
+        tmpBounds = tmpBounds.flatten()/paramScale
+        bounds = [(-x, x) if np.isfinite(x) else (None, None) for x in tmpBounds]
+    else:
+        paramScale = 1.0
+    
     #Call the scipy minimizer
-    optimResults = fmin_l_bfgs_b(tmpEvalPulse, curPulse.flatten(), fprime=tmpEvalDerivs, bounds=bounds, iprint=0, maxfun=optimParams.maxfun)
+    try:
+        if optimParams.optimMethod == 'newton':
+            #Trust-region Newton-CG driven by the exact Hessian-vector products with the amplitude bounds handled by the interior point method
+            optimResults = minimize(tmpEvalPulse, startParams.flatten(), method='trust-constr', jac=tmpEvalDerivs, hessp=tmpEvalHessp, 
+                                    bounds=Bounds(-tmpBounds.flatten(), tmpBounds.flatten()), options={'maxiter':optimParams.maxfun}, 
+                                    callback=lambda paramsIn, state: record_iteration(paramsIn, state.fun))
+            optimResults = (optimResults.x, optimResults.fun, 'maxfun' if optimResults.status == 0 else 'converged')
+        elif optimParams.optimMethod == 'krotov':
+            optimResults = optimize_krotov(optimParams, systemParams, controlHams_int, startParams, tmpBounds, callback=record_iteration)
+            optimResults = (optimResults[0], optimResults[1], 'maxfun' if optimResults[2] >= optimParams.maxfun else 'converged')
+        elif optimParams.optimMethod == 'evolution':
+            #Gradient free differential evolution.  scipy hands us the whole population (parameters x candidates) each generation. 
+            #The search box needs finite bounds so for basis coefficients we use each control line's largest drive bound.
+            if paramTransforms:
+                searchBounds = np.max(pixelBounds, axis=1)[:, np.newaxis]*np.ones(paramShape)
+            else:
+                searchBounds = tmpBounds
+            assert np.all(np.isfinite(searchBounds)), 'Oops! The evolution optimizer needs a finite maxAmp for each control line.'
+            #maxfun is a budget of fidelity evaluations so convert it to generations of the whole population
+            numGenerations = max(1, optimParams.maxfun//(optimParams.popSize*searchBounds.size))
+            optimResults = differential_evolution(lambda paramsIn: tmpEvalPulseBatch(paramsIn.T), list(zip(-searchBounds.flatten(), searchBounds.flatten())), 
+                                                  x0=np.clip(startParams.flatten(), -searchBounds.flatten(), searchBounds.flatten()), 
+                                                  maxiter=numGenerations, popsize=optimParams.popSize, tol=optimParams.popTol, seed=optimParams.seed, polish=False,
+                                                  vectorized=True, updating='deferred', 
+                                                  callback=lambda paramsIn, convergence=None: record_iteration(paramsIn, gradNorm=np.nan))
+            optimResults = (optimResults.x, optimResults.fun, 'converged' if optimResults.success else 'maxfun')
+        elif optimParams.optimMethod == 'lbfgs':
+            #Convert the fidelity tolerance to the relative reduction factor of L-BFGS-B 
+            optimResults = fmin_l_bfgs_b(tmpEvalPulse, startParams.flatten(), fprime=tmpEvalDerivs, bounds=bounds, iprint=0, maxfun=optimParams.maxfun, 
+                                         factr=optimParams.fTol/np.finfo(np.float64).eps, callback=record_iteration)
+            optimResults = (optimResults[0], optimResults[1], {0:'converged', 1:'maxfun', 2:'abnormal'}[optimResults[2]['warnflag']])
+        else:
+            raise NameError('Unknown optimization method.  Currently handle "lbfgs", "newton", "krotov" or "evolution"')
+    except StopOptimization as stopReason:
+        optimResults = (lastIterate['params']/paramScale, lastIterate['goodness'], stopReason.args[0])
+    
+    #Map back from the preconditioned variables and save the final state
+    optimResults = (paramScale*optimResults[0],) + tuple(optimResults[1:])
+    if optimParams.checkpointFile is not None:
+        save_checkpoint(optimParams, problemKey, optimResults[0], sPairs, yPairs, numPrevIterations + len(history['time']))
     
     #Reshape the optimized pulse from a 1D vector
-    foundPulse = optimResults[0].reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+    if paramTransforms:
+        #The penalty only approximately enforces the drive bounds so clip any small excess
+        drivePulse = apply_transforms(paramTransforms, optimResults[0].reshape(paramShape))
+        drivePulse = np.clip(drivePulse, -pixelBounds, pixelBounds)
+    else:
+        drivePulse = optimResults[0].reshape((optimParams.numControlLines, optimParams.numTimeSteps))
+    foundPulse = apply_transforms(channelTransforms, drivePulse)
    
-#    #Rescale time
-    optimParams.timeSteps *= pulseTime
-    systemParams.Hnat.matrix /= pulseTime
-    if optimParams.H_int is not None:
-        optimParams.H_int.matrix /= pulseTime
+    #Rescale time (without channel transforms the found pulse is the drive itself so don't divide in place)
     curPulse /= pulseTime
-    foundPulse /= pulseTime
+    foundPulse = foundPulse/pulseTime
+    drivePulse = drivePulse/pulseTime
    
-    optimParams.startControlAmps = curPulse
-    optimParams.controlAmps = foundPulse
-        
+    callerParams.startControlAmps = curPulse
+    callerParams.controlAmps = foundPulse
+    callerParams.driveAmps = drivePulse
+    
+    return {'fidelity':-optimResults[1], 'numIterations':numPrevIterations + len(history['time']), 'stopReason':optimResults[2], 
+            'history':dict([(key, np.array(value)) for key, value in history.items()])}
+
+def optimize_pulse_sweep(optimParams, systemParams, pulseTimes, targetFidelity=None, timeTol=None):
+    '''
+    Optimize the pulse for a range of durations warm starting each from the previous optimum.  optimParams.timeSteps sets the shape of the 
+    time grid which is stretched to each duration and the previous drive is resampled onto it with the amplitudes scaled to keep the pulse area.
+    If a target fidelity is given we stop at the first duration which meets it and then bisect down to the shortest duration within timeTol 
+    (default 1% of the duration).  Returns a list sorted by duration of dictionaries with the duration, fidelity, pulse, drive (before the channel filters), number of iterations 
+    and wall time. 
+    '''
+    relTimeSteps = optimParams.timeSteps/np.sum(optimParams.timeSteps)
+    
+    def run_duration(pulseTime, prevResult):
+        tmpParams = copy(optimParams)
+        tmpParams.timeSteps = pulseTime*relTimeSteps
+        if prevResult is not None:
+            tmpParams.startControlAmps = (prevResult['duration']/pulseTime)*interpolate_pulse(prevResult['drive'], prevResult['duration']*relTimeSteps, tmpParams.timeSteps)
+        startTime = time.time()
+        tmpResult = optimize_pulse(tmpParams, systemParams)
+        return {'duration':pulseTime, 'fidelity':tmpResult['fidelity'], 'pulse':tmpParams.controlAmps, 'drive':tmpParams.driveAmps, 'numIterations':tmpResult['numIterations'], 
+                'wallTime':time.time()-startTime}
+    
+    results = []
+    prevResult = None
+    for pulseTime in np.sort(pulseTimes):
+        prevResult = run_duration(pulseTime, prevResult)
+        results.append(prevResult)
+        if targetFidelity is not None and prevResult['fidelity'] >= targetFidelity:
+            break
+    
+    #Bisect between the last failing and the first passing durations warm starting from the shortest passing pulse 
+    if targetFidelity is not None and len(results) > 1 and results[-1]['fidelity'] >= targetFidelity:
+        failResult, passResult = results[-2], results[-1]
+        if timeTol is None:
+            timeTol = 0.01*passResult['duration']
+        while passResult['duration'] - failResult['duration'] > timeTol:
+            tmpResult = run_duration(0.5*(passResult['duration'] + failResult['duration']), passResult)
+            results.append(tmpResult)
+            if tmpResult['fidelity'] >= targetFidelity:
+                passResult = tmpResult
+            else:
+                failResult = tmpResult
+    
+    return sorted(results, key=lambda tmpResult: tmpResult['duration'])
+
+def _init_gate_set_worker(systemParams, controlHamsList):
+    '''
+    Initializer for the gate set worker processes: keep the system and seed the control Hamiltonian cache with the precomputed interaction frame tensors.
+    '''
+    global _gateSetSystemParams, _controlHamsCacheSize
+    _gateSetSystemParams = systemParams
+    with _controlHamsCacheLock:
+        _controlHamsCacheSize = max(_controlHamsCacheSize, len(controlHamsList))
+        for cacheKey, controlHams in controlHamsList:
+            controlHams.setflags(write=False)
+            _controlHamsCache[cacheKey] = controlHams
+
+def _optimize_gate(optimParams):
+    '''
+    Optimize one gate of a gate set against the worker's shared system and send back the results.
+    '''
+    result = optimize_pulse(optimParams, _gateSetSystemParams)
+    return result, optimParams.controlAmps, optimParams.driveAmps, optimParams.startControlAmps
+
+def optimize_gate_set(gateParams, systemParams, numWorkers=None):
+    '''
+    Optimize several gates (a list of PulseParams each with its own goal and time steps) for the same system.  The interaction frame control 
+    Hamiltonians are calculated once for each distinct time grid and broadcast with the system to each worker process once.  The gates are 
+    then spread over the workers longest first.  With numWorkers=1 the gates are optimized in this process.  The gate PulseParams are sent to 
+    the workers so they can't have a lambda callback.  Each gate's optimized pulse is left in its controlAmps and the list of optimize_pulse 
+    result dictionaries is returned in the same order.
+    '''
+    if numWorkers is None:
+        numWorkers = min(multiprocessing.cpu_count(), len(gateParams))
+    
+    if numWorkers <= 1:
+        return [optimize_pulse(tmpParams, systemParams) for tmpParams in gateParams]
+    
+    #Precompute the interaction frame control Hamiltonians once for each distinct time grid and frame 
+    controlHamsDict = OrderedDict()
+    for tmpParams in gateParams:
+        cacheKey = control_Hams_key(tmpParams, systemParams)
+        if cacheKey not in controlHamsDict:
+            controlHamsDict[cacheKey] = calc_control_Hams(tmpParams, systemParams)
+    
+    #Dispatch the longest gates first so the workers finish together
+    gateOrder = sorted(range(len(gateParams)), key=lambda gatect: -gateParams[gatect].numTimeSteps)
+    pool = multiprocessing.Pool(numWorkers, initializer=_init_gate_set_worker, initargs=(systemParams, list(controlHamsDict.items())))
+    try:
+        tmpResults = pool.map(_optimize_gate, [gateParams[gatect] for gatect in gateOrder], 1)
+    finally:
+        pool.close()
+        pool.join()
     
+    results = [None]*len(gateParams)
+    for gatect, (result, controlAmps, driveAmps, startControlAmps) in zip(gateOrder, tmpResults):
+        gateParams[gatect].controlAmps = controlAmps
+        gateParams[gatect].driveAmps = driveAmps
+        gateParams[gatect].startControlAmps = startControlAmps
+        results[gatect] = result
     
-    
\ No newline at end of file
+    return results
@@ -6,77 +6,796 @@ Created on Nov 6, 2011
 
 import numpy as np
 
+import os
+import shutil
+import tempfile
+import uuid
+import warnings
+import hashlib
+import heapq
 import multiprocessing
+import Evolution
 from functools import partial 
 
-import time
-
 from progressbar import Percentage, Bar, ProgressBar, ETA
 
-from Evolution import evolution_unitary, evolution_lindblad
+from Evolution import evolution_unitary, evolution_lindblad, evolution_trajectory, sub_steps, step_propagator, dissipator_superop
+
+#The system shared by the simulation pool worker processes (see SimulationPool)
+_workerSystemParams = None
+#The (store id, ResultStore) a worker is writing into so it only maps the arrays once per stack (see _record_in_worker).  The mappings are
+#held until the worker's next stack so a removed scratch store's memory is only given back then
+_workerStore = None
 
-def simulate_sequence(pulseSeq=None, systemParams=None, rhoIn=None, simType='unitary'):
+def simulate_sequence(pulseSeq=None, systemParams=None, rhoIn=None, simType='unitary', cache=None):
     '''
-    Simulate a single pulse sequence and return the expectation value of the measurement.
+    Simulate a single pulse sequence and return the expectation value of the measurement (an array of them if the system has a stack of
+    measurement operators).  rhoIn can be a stack of input states (numStates x dim x dim) which all share the one propagation.
+    Given a ResultCache the result is looked up there first and stored there after simulating.
     '''
+    if cache is not None:
+        cacheKey = cache.key(pulseSeq, systemParams, rhoIn, simType)
+        result = cache.get(cacheKey)
+        if result is None:
+            result = simulate_sequence(pulseSeq, systemParams, rhoIn, simType)
+            cache.put(cacheKey, result)
+        return result
+    
     if simType == 'unitary':
         totProp = evolution_unitary(pulseSeq, systemParams)
-        if rhoIn is not None:
+    elif simType == 'lindblad':
+        totProp = evolution_lindblad(pulseSeq, systemParams, rhoIn)
+    else:
+        raise NameError('Unknown simulation type.')
+    
+    return apply_propagator(totProp, systemParams, rhoIn, simType)
+
+def simulate_trajectory(pulseSeq, systemParams, rhoIn, simType='unitary', observables=None, decimation=1, byPixel=False):
+    '''
+    Simulate a single pulse sequence recording the time evolution in the one pass: the expectation values of a stack of observables (the
+    measurement by default; pass 'state' for the state itself) at the start and every decimation sub-steps, or every decimation time steps 
+    with byPixel.  Returns the record times and the records.
+    '''
+    if observables is None:
+        observables = systemParams.measurement if np.ndim(systemParams.measurement) == 3 else [systemParams.measurement]
+    elif isinstance(observables, str) and observables == 'state':
+        observables = None
+    if observables is not None:
+        observables = np.array(observables, dtype=np.complex128)
+    totProp, times, records = evolution_trajectory(pulseSeq, systemParams, rhoIn, simType, observables, decimation, byPixel)
+    return times, records
+
+def apply_propagator(totProp, systemParams, rhoIn, simType='unitary'):
+    '''
+    Apply a sequence's total propagator to the input state, or to each of a stack of input states (numStates x dim x dim).  Returns the 
+    measurement expectation value(s), the propagator and the output state(s).
+    '''
+    dim = systemParams.dim
+    if simType == 'unitary':
+        if rhoIn is None:
+            rhoOut = None
+        elif rhoIn.ndim == 2:
             rhoOut = np.dot(np.dot(totProp,rhoIn), totProp.conj().transpose())
         else:
-            rhoOut = None
+            rhoOut = np.einsum('ij,njk,lk->nil', totProp, rhoIn, totProp.conj())
     elif simType == 'lindblad':
-        totProp = evolution_lindblad(pulseSeq, systemParams, rhoIn)
-        #Reshape, propagate and reshape again the density matrix
-        rhoOut = (np.dot(totProp, rhoIn.reshape((systemParams.dim**2,1), order='F'))).reshape((systemParams.dim,systemParams.dim), order='F')
+        if rhoIn.ndim == 2:
+            #Reshape, propagate and reshape again the density matrix
+            rhoOut = (np.dot(totProp, rhoIn.reshape((dim**2,1), order='F'))).reshape((dim,dim), order='F')
+        else:
+            #Column-stack all the density matrices at once (transposing and flattening each is the column stacking) 
+            rhoVecs = rhoIn.transpose((0,2,1)).reshape((rhoIn.shape[0], dim**2))
+            rhoOut = np.dot(rhoVecs, totProp.T).reshape((rhoIn.shape[0], dim, dim)).transpose((0,2,1))
     else:
         raise NameError('Unknown simulation type.')
     
-    #Return the expectation value of the measurement operator the unitary and the rhouut
-    if systemParams.measurement is not None:    
-        measOut =  np.real(np.trace(np.dot(systemParams.measurement, rhoOut)))
+    #Return the expectation value of the measurement operator(s) the unitary and the rhouut
+    if systemParams.measurement is not None and rhoOut is not None:    
+        measOut = expectation_values(systemParams.measurement, rhoOut)
     else:
         measOut = None
     
     #Return everything
     return measOut, totProp, rhoOut
+
+def expectation_values(measurement, rho):
+    '''
+    Expectation value Tr(O rho) of a measurement operator, or an array of them for a stack of operators (numMeasurements x dim x dim).  
+    For a stack of states (numStates x dim x dim) the leading axis of the result runs over the states.
+    We only need the diagonal of the product so we take the elementwise product with the transpose: O(dim**2) per operator.
+    '''
+    measurement = np.asarray(measurement)
+    if measurement.ndim == 2 and rho.ndim == 2:
+        return np.real(np.sum(measurement*rho.T))
+    elif measurement.ndim == 2:
+        return np.real(np.einsum('ij,...ji->...', measurement, rho))
+    else:
+        return np.real(np.einsum('kij,...ji->...k', measurement, rho))
+
+def pauli_basis(dim):
+    '''
+    The Pauli operators (tensor products of I, X, Y and Z) for a system of qubits as a dim**2 x dim x dim stack.
+    '''
+    numQubits = int(np.round(np.log2(dim)))
+    assert 2**numQubits == dim, 'Oops! The Pauli basis needs a system of qubits.'
+    singlePaulis = np.array([[[1,0],[0,1]], [[0,1],[1,0]], [[0,-1j],[1j,0]], [[1,0],[0,-1]]], dtype=np.complex128)
+    paulis = np.ones((1,1,1), dtype=np.complex128)
+    for qubitct in range(numQubits):
+        paulis = np.array([np.kron(tmpPauli, singlePauli) for tmpPauli in paulis for singlePauli in singlePaulis])
+    return paulis
+
+def process_matrix(totProp, simType='unitary', representation='ptm'):
+    '''
+    The process a sequence's total propagator applies: 'superop' for the column-stacked super operator, 'choi' for the (unnormalized) Choi 
+    matrix sum_ij |i><j| (x) E(|i><j|) or 'ptm' for the Pauli transfer matrix R_kl = Tr(P_k E(P_l))/dim of a system of qubits.
+    '''
+    if simType == 'unitary':
+        dim = totProp.shape[0]
+        superOp = np.kron(totProp.conj(), totProp)
+    elif simType == 'lindblad':
+        dim = int(np.round(np.sqrt(totProp.shape[0])))
+        superOp = totProp
+    else:
+        raise NameError('Unknown simulation type.')
     
-def simulate_sequence_stack(pulseSeqs, systemParams, rhoIn, simType='unitary'):
+    if representation == 'superop':
+        return superOp
+    elif representation == 'choi':
+        #Reshuffle the super operator: column (i,j) of the super operator is the column-stacked E(|i><j|)
+        return superOp.reshape((dim,dim,dim,dim), order='F').transpose((2,0,3,1)).reshape((dim**2,dim**2))
+    elif representation == 'ptm':
+        paulis = pauli_basis(dim)
+        #Tr(P_k X) is the row-major flattened P_k dotted into the column-stacked X
+        pauliVecs = paulis.transpose((0,2,1)).reshape((dim**2, dim**2))
+        return np.real(np.dot(paulis.reshape((dim**2, dim**2)), np.dot(superOp, pauliVecs.T)))/dim
+    else:
+        raise NameError('Unknown process representation.')
+
+def simulate_process(pulseSeq, systemParams, simType='unitary', representation='ptm'):
     '''
-    Helper function to simulate a series of pusle sequences with parallelization over multiple cores and progress bar output.
+    Simulate a single pulse sequence and return the process it applies (see process_matrix) from the one propagation.
+    '''
+    if simType == 'unitary':
+        totProp = evolution_unitary(pulseSeq, systemParams)
+    elif simType == 'lindblad':
+        totProp = evolution_lindblad(pulseSeq, systemParams, None)
+    else:
+        raise NameError('Unknown simulation type.')
+    return process_matrix(totProp, simType, representation)
+
+def frame_key(pulseSeq):
+    '''
+    Hash of everything besides the pixels that sets a pulse sequence's step propagators: the control lines, maxTimeStep and the interaction frame.
+    Sequences with the same key and the same leading pixels share the propagator of those pixels.
+    '''
+    tmpHash = hashlib.sha1()
+    for tmpControl in pulseSeq.controlLines:
+        tmpHash.update(repr((tmpControl.freq, tmpControl.phase, tmpControl.controlType)).encode())
+    tmpHash.update(repr(pulseSeq.maxTimeStep).encode())
+    tmpHash.update(b'None' if pulseSeq.H_int is None else np.ascontiguousarray(pulseSeq.H_int.matrix, dtype=np.complex128).tobytes())
+    return tmpHash.hexdigest()
+
+def build_prefix_trie(pulseSeqs):
+    '''
+    Put the sub-steps of a family of pulse sequences with the same frame_key into a trie keyed on their length and control amplitudes.  Returns
+    for each node its children (a dictionary from the step key to the child node), the (sequence index, timect, curTime, subTimeStep) of the 
+    sub-step taking us into it and the sequences ending there.  Node 0 is the root and a child always comes after its parent.
+    '''
+    children = [{}]
+    nodeSteps = [None]
+    seqEnds = [[]]
+    for seqct, pulseSeq in enumerate(pulseSeqs):
+        curNode = 0
+        for timect, curTime, subTimeStep in sub_steps(pulseSeq):
+            stepKey = (float(subTimeStep), np.ascontiguousarray(pulseSeq.controlAmps[:,timect], dtype=np.float64).tobytes())
+            if stepKey not in children[curNode]:
+                children[curNode][stepKey] = len(children)
+                children.append({})
+                nodeSteps.append((seqct, timect, curTime, subTimeStep))
+                seqEnds.append([])
+            curNode = children[curNode][stepKey]
+        seqEnds[curNode].append(seqct)
+    return children, nodeSteps, seqEnds
+
+def split_prefix_tree(pulseSeqs, numParts):
+    '''
+    Split a family of pulse sequences with the same frame_key into groups for separate simulate_prefix_tree calls so a single large sweep can 
+    run on several workers.  We repeatedly break the most expensive group at its next branch point into the subtrees below it until there are 
+    numParts groups.  Each subtree repeats the prefix above its branch point and a chain of sequences (a pure length sweep) can't be broken 
+    up, as its longest sequence costs the same either way.  Returns lists of indices into pulseSeqs.
+    '''
+    children, nodeSteps, seqEnds = build_prefix_trie(pulseSeqs)
+    
+    #The number of sub-steps down to each node and below it
+    depths = np.zeros(len(children), dtype=np.int64)
+    for curNode in range(len(children)):
+        for childNode in children[curNode].values():
+            depths[childNode] = depths[curNode] + 1
+    subtreeSizes = np.ones(len(children), dtype=np.int64)
+    for curNode in reversed(range(len(children))):
+        for childNode in children[curNode].values():
+            subtreeSizes[curNode] += subtreeSizes[childNode]
+    
+    def descend(curNode, seqs):
+        #Follow the trunk down to the next branch point picking up the sequences ending along the way
+        seqs = seqs + seqEnds[curNode]
+        while len(children[curNode]) == 1:
+            curNode = next(iter(children[curNode].values()))
+            seqs = seqs + seqEnds[curNode]
+        return curNode, seqs
+    
+    #A heap of (-cost, tie breaker, branch point, sequences ending above or at it) with the cost the sub-steps including the repeated prefix
+    rootNode, rootSeqs = descend(0, [])
+    parts = [(-subtreeSizes[0], 0, rootNode, rootSeqs)]
+    partct = 1
+    while len(parts) < numParts:
+        negCost, tieBreaker, curNode, seqs = parts[0]
+        #The most expensive group is a chain so it sets the time whatever we do with the rest
+        if not children[curNode]:
+            break
+        heapq.heappop(parts)
+        #Sequences ending at or above the branch point are cheap to tack on to the first subtree
+        for childct, childNode in enumerate(children[curNode].values()):
+            branchNode, branchSeqs = descend(childNode, seqs if childct == 0 else [])
+            heapq.heappush(parts, (-(depths[childNode] + subtreeSizes[childNode]), partct, branchNode, branchSeqs))
+            partct += 1
+    
+    #Gather the sequences below each branch point
+    groups = []
+    for negCost, tieBreaker, curNode, seqs in sorted(parts):
+        seqs = list(seqs)
+        nodeStack = list(children[curNode].values())
+        while nodeStack:
+            tmpNode = nodeStack.pop()
+            seqs.extend(seqEnds[tmpNode])
+            nodeStack.extend(children[tmpNode].values())
+        groups.append(sorted(seqs))
+    return groups
+
+def simulate_prefix_tree(pulseSeqs, systemParams, rhoIn, simType='unitary', outputs='all'):
+    '''
+    Simulate a family of pulse sequences with the same frame_key, propagating each shared prefix only once.  The sub-steps of the sequences are 
+    put into a trie keyed on their length and control amplitudes which we walk depth first; the propagator at a branch point is held until all 
+    its branches are done.  A sweep of sequence lengths then costs about the same as the longest sequence.  Returns the results (see 
+    select_outputs) in sequence order.
+    '''
+    children, nodeSteps, seqEnds = build_prefix_trie(pulseSeqs)
+    
+    supDis = dissipator_superop(systemParams) if simType == 'lindblad' else None
+    propDim = systemParams.dim if simType == 'unitary' else systemParams.dim**2
+    
+    #Walk the trie depth first keeping the parent's propagator on the stack for each branch still to do
+    results = [None]*len(pulseSeqs)
+    nodeStack = [(0, np.eye(propDim, dtype=np.complex128))]
+    while nodeStack:
+        curNode, totProp = nodeStack.pop()
+        if curNode != 0:
+            seqct, timect, curTime, subTimeStep = nodeSteps[curNode]
+            totProp = np.dot(step_propagator(pulseSeqs[seqct], systemParams, timect, curTime, subTimeStep, supDis), totProp)
+        for seqct in seqEnds[curNode]:
+            results[seqct] = select_outputs(apply_propagator(totProp, systemParams, rhoIn, simType), outputs)
+        for childNode in children[curNode].values():
+            nodeStack.append((childNode, totProp))
+    
+    return results
+    
+def _init_worker(systemParams):
+    '''
+    Initializer for the simulation pool worker processes: keep the system so tasks only need to send the pulse sequences.
+    '''
+    global _workerSystemParams
+    _workerSystemParams = systemParams
+
+def select_outputs(result, outputs):
+    '''
+    Pick the requested outputs out of a simulate_sequence result: 'all' for the (measOut, totProp, rhoOut) tuple, 'measurement' for measOut 
+    or 'rhoOut' for rhoOut.
+    '''
+    if outputs == 'all':
+        return result
+    elif outputs == 'measurement':
+        return result[0]
+    elif outputs == 'rhoOut':
+        return result[2]
+    else:
+        raise NameError('Unknown simulation outputs.')
+
+def _record_in_worker(chunkResults, storeArgs):
+    '''
+    Write a chunk's results straight into the result store described by storeArgs, if there is one, so only the indices go back to the parent.
+    storeArgs is the (store id, directory, outputs) of a store the parent has already opened: the worker attaches to its arrays on the first 
+    chunk of the stack and keeps them mapped for the rest.
+    '''
+    global _workerStore
+    if storeArgs is None:
+        return chunkResults
+    storeId, directory, outputs = storeArgs
+    if _workerStore is None or _workerStore[0] != storeId:
+        _workerStore = (storeId, ResultStore.attach(directory, outputs))
+    store = _workerStore[1]
+    for seqct, tmpResult in chunkResults:
+        store.record(seqct, tmpResult)
+    return [(seqct, None) for seqct, tmpResult in chunkResults]
+
+def _simulate_chunk_in_worker(chunk, rhoIn, simType, outputs, cache=None, storeArgs=None):
+    '''
+    Simulate a chunk of (index, pulse sequence) pairs in a worker process against the system it was initialized with.
+    Only the requested outputs are sent back or written to the store.
     '''
+    return _record_in_worker([(seqct, select_outputs(simulate_sequence(pulseSeq, _workerSystemParams, rhoIn, simType, cache), outputs)) for seqct, pulseSeq in chunk], storeArgs)
+
+def _simulate_prefix_tree_in_worker(chunk, rhoIn, simType, outputs, cache=None, storeArgs=None):
+    '''
+    Simulate a chunk of (index, pulse sequence) pairs sharing a frame as a prefix tree in a worker process (see simulate_prefix_tree).
+    With a cache only the sequences missing from it go into the tree.  The tree always uses the Python step propagators so its cache entries
+    are keyed as Python results whatever the backend.
+    '''
+    if cache is None:
+        seqIndices = [seqct for seqct, pulseSeq in chunk]
+        return _record_in_worker(list(zip(seqIndices, simulate_prefix_tree([pulseSeq for seqct, pulseSeq in chunk], _workerSystemParams, rhoIn, simType, outputs))), storeArgs)
     
-    #Setup a partial function that only takes the sequence
-    partial_simulate_sequence = partial(simulate_sequence, systemParams=systemParams, rhoIn=rhoIn, simType=simType)
+    chunkResults = []
+    missing = []
+    for seqct, pulseSeq in chunk:
+        cacheKey = cache.key(pulseSeq, _workerSystemParams, rhoIn, simType, 'python')
+        result = cache.get(cacheKey)
+        if result is None:
+            missing.append((seqct, pulseSeq, cacheKey))
+        else:
+            chunkResults.append((seqct, select_outputs(result, outputs)))
+    treeResults = simulate_prefix_tree([pulseSeq for seqct, pulseSeq, cacheKey in missing], _workerSystemParams, rhoIn, simType)
+    for (seqct, pulseSeq, cacheKey), result in zip(missing, treeResults):
+        cache.put(cacheKey, result)
+        chunkResults.append((seqct, select_outputs(result, outputs)))
+    return _record_in_worker(chunkResults, storeArgs)
 
-    #Setup a pool of worker threads
-    pool = multiprocessing.Pool()
+def sequence_cost(pulseSeq, systemParams, simType='unitary'):
+    '''
+    Estimate the relative cost of simulating a pulse sequence: the number of sub-steps under maxTimeStep times the cost of a propagator 
+    exponential (dim**3 for unitary and dim**6 for lindblad).  One extra step accounts for the fixed per-sequence overhead.
+    '''
+    timeSteps = np.asarray(pulseSeq.timeSteps, dtype=np.float64)
+    #Zero length time steps take no sub-steps (and would give 0/0 with a zero maxTimeStep)
+    positiveSteps = timeSteps[timeSteps > 0]
+    numSubSteps = np.sum(np.maximum(np.ceil(positiveSteps/pulseSeq.maxTimeStep), 1))
+    propDim = systemParams.dim if simType == 'unitary' else systemParams.dim**2
+    return (1+numSubSteps)*float(propDim)**3
+
+def schedule_chunks(costs, numWorkers, chunksPerWorker=4):
+    '''
+    Group sequence indices into chunks for the workers.  Sequences are taken most expensive first and a chunk is closed once it reaches 
+    1/(numWorkers*chunksPerWorker) of the total cost, so expensive sequences go out on their own at the start and the cheap ones are 
+    batched together at the end where they fill in around the stragglers.
+    '''
+    costs = np.asarray(costs, dtype=np.float64)
+    targetCost = np.sum(costs)/(numWorkers*chunksPerWorker)
+    chunks = []
+    curChunk = []
+    curCost = 0.0
+    for seqct in np.argsort(-costs, kind='mergesort'):
+        curChunk.append(seqct)
+        curCost += costs[seqct]
+        if curCost >= targetCost:
+            chunks.append(curChunk)
+            curChunk = []
+            curCost = 0.0
+    if curChunk:
+        chunks.append(curChunk)
+    return chunks
+
+def simulation_key(pulseSeq, systemParams, rhoIn, simType='unitary', version=None, backend=None):
+    '''
+    Canonical hash of everything that sets a simulate_sequence result: the system matrices, the pulse sequence, the input state, the 
+    simulation type and the backend ('cpp' or 'python', by default the one simulate_sequence uses).  The array shapes go in with the bytes 
+    so e.g. a stack of one input state and the state itself differ.
+    '''
+    if backend is None:
+        backend = 'cpp' if Evolution.CPPBackEnd else 'python'
+    def array_bytes(arrayIn):
+        return b'None' if arrayIn is None else repr(np.shape(arrayIn)).encode() + np.ascontiguousarray(arrayIn, dtype=np.complex128).tobytes()
     
-    #Map all the pulse sequences into a results list in parallel
-    results = pool.map_async(partial_simulate_sequence, pulseSeqs, 1)
+    tmpHash = hashlib.sha1(repr((version, simType, backend)).encode())
+    tmpHash.update(array_bytes(systemParams.Hnat.matrix))
+    for tmpControlHam in systemParams.controlHams:
+        for tmpHam in [tmpControlHam['inphase'], tmpControlHam['quadrature']]:
+            tmpHash.update(array_bytes(None if tmpHam is None else tmpHam.matrix))
+    for tmpDis in systemParams.dissipators:
+        tmpHash.update(array_bytes(tmpDis.matrix))
+    tmpHash.update(array_bytes(systemParams.measurement))
+    for tmpControl in pulseSeq.controlLines:
+        tmpHash.update(repr((tmpControl.freq, tmpControl.phase, tmpControl.controlType)).encode())
+    tmpHash.update(repr(np.shape(pulseSeq.controlAmps)).encode() + np.ascontiguousarray(pulseSeq.controlAmps, dtype=np.float64).tobytes())
+    tmpHash.update(repr(np.shape(pulseSeq.timeSteps)).encode() + np.ascontiguousarray(pulseSeq.timeSteps, dtype=np.float64).tobytes())
+    tmpHash.update(repr(pulseSeq.maxTimeStep).encode())
+    tmpHash.update(array_bytes(None if pulseSeq.H_int is None else pulseSeq.H_int.matrix))
+    tmpHash.update(array_bytes(rhoIn))
+    return tmpHash.hexdigest()
+
+def stack_key(pulseSeqs, systemParams, rhoIn, simType='unitary'):
+    '''
+    Hash identifying a whole sequence stack (see simulation_key).
+    '''
+    tmpHash = hashlib.sha1()
+    for pulseSeq in pulseSeqs:
+        tmpHash.update(simulation_key(pulseSeq, systemParams, rhoIn, simType).encode())
+    return tmpHash.hexdigest()
+
+class ResultCache(object):
+    '''
+    Persistent content-addressed cache of simulate_sequence results.  Each result is an .npz file in the cache directory named by a hash of 
+    everything that sets it: the system matrices, the pulse sequence, the input state, the simulation type and the backend.  Files are written 
+    under a temporary name and renamed into place so several processes can share a cache.  When the cache grows past maxSize bytes the least 
+    recently used entries are removed.  Each cache object keeps a running estimate of the size from what it has written so the directory is
+    only scanned when the estimate passes maxSize; entries written by other processes are picked up at the next scan.
+    '''
+    #Bump to invalidate old entries when the simulation results change
+    version = 1
     
-    #Close the pool to new jobs 
-    pool.close()
+    def __init__(self, directory, maxSize=1e9):
+        self.directory = directory
+        self.maxSize = maxSize
+        #Running estimate of the cache size in bytes (None until we first scan the directory)
+        self.cacheSize = None
+        if not os.path.exists(directory):
+            os.makedirs(directory)
     
-    numSeqs = len(pulseSeqs)
-    pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=numSeqs).start()
-  
-    while True:
-        if not results.ready():
-            pbar.update(numSeqs-results._number_left)
-            time.sleep(0.1)
+    def key(self, pulseSeq, systemParams, rhoIn, simType='unitary', backend=None):
+        '''
+        Canonical hash of a simulation for this cache version (see simulation_key).
+        '''
+        return simulation_key(pulseSeq, systemParams, rhoIn, simType, self.version, backend)
+    
+    def get(self, cacheKey):
+        '''
+        The cached (measOut, totProp, rhoOut) for a key or None if there isn't one.
+        '''
+        fileName = os.path.join(self.directory, cacheKey + '.npz')
+        try:
+            with np.load(fileName) as tmpFile:
+                result = tuple([tmpFile[name] if name in tmpFile.files else None for name in ['measOut', 'totProp', 'rhoOut']])
+            #Mark the entry as recently used
+            os.utime(fileName, None)
+        except (IOError, OSError):
+            #Missing or evicted by another process 
+            return None
+        #A single measurement comes back as a float and a stack of them as an array
+        if result[0] is not None and result[0].ndim == 0:
+            result = (float(result[0]),) + result[1:]
+        return result
+    
+    def put(self, cacheKey, result):
+        '''
+        Store a simulate_sequence result.
+        '''
+        fileName = os.path.join(self.directory, cacheKey + '.npz')
+        tmpFileName = '{0}.{1}.tmp'.format(fileName, os.getpid())
+        with open(tmpFileName, 'wb') as tmpFile:
+            np.savez(tmpFile, **dict([(name, value) for name, value in zip(['measOut', 'totProp', 'rhoOut'], result) if value is not None]))
+        os.rename(tmpFileName, fileName)
+        if self.cacheSize is None:
+            self.evict()
         else:
-            break
+            self.cacheSize += os.path.getsize(fileName)
+            if self.cacheSize > self.maxSize:
+                self.evict()
+        
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache is under maxSize and reset the running size estimate.
+        '''
+        entries = []
+        for fileName in os.listdir(self.directory):
+            if fileName.endswith('.npz'):
+                try:
+                    fileStat = os.stat(os.path.join(self.directory, fileName))
+                except OSError:
+                    continue
+                entries.append((fileStat.st_mtime, fileStat.st_size, fileName))
+        totSize = sum([entry[1] for entry in entries])
+        for mtime, fileSize, fileName in sorted(entries):
+            if totSize <= self.maxSize:
+                break
+            try:
+                os.remove(os.path.join(self.directory, fileName))
+            except OSError:
+                #Already removed by another process
+                pass
+            totSize -= fileSize
+        self.cacheSize = totSize
+
+class ResultStore(object):
+    '''
+    On-disk store for the results of a sequence stack: memory-mapped .npy arrays in a directory holding the measurements, output states and 
+    (for outputs='all') propagators along with a flag for each sequence that is done.  Opening an existing store for the same stack picks up 
+    where it left off so a restarted sweep only simulates the missing sequences.  Load a finished store for plotting with ResultStore.load.
+    measShape is the shape of each sequence's measurement: () for a single measurement operator or (numMeasurements,) for a stack, with a
+    leading (numStates,) for a stack of input states, which stateShape then holds.  A measShape or stateShape of None means the stack produces 
+    no measurements (no measurement operator) or no output states (a unitary simulation without an input state) and those arrays are left out.
+    Given a stackKey (see stack_key) the store also checks it holds results for the same stack and starts afresh if not.  Workers writing 
+    into a store opened by the parent use ResultStore.attach instead.
+    '''
+    def __init__(self, directory, numSeqs, dim, simType='unitary', outputs='all', measShape=(), stateShape=(), stackKey=None):
+        self.directory = directory
+        self.outputs = outputs
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        
+        assert outputs != 'measurement' or measShape is not None, 'Oops! There are no measurements to store.'
+        assert outputs != 'rhoOut' or stateShape is not None, 'Oops! There are no output states to store.'
+        
+        propDim = dim if simType == 'unitary' else dim**2
+        shapes = {'done':((numSeqs,), np.bool_)}
+        if measShape is not None and outputs in ('all', 'measurement'):
+            shapes['measurements'] = ((numSeqs,)+tuple(measShape), np.float64)
+        if stateShape is not None and outputs in ('all', 'rhoOut'):
+            shapes['rhos'] = ((numSeqs,)+tuple(stateShape)+(dim, dim), np.complex128)
+        if outputs == 'all':
+            shapes['props'] = ((numSeqs, propDim, propDim), np.complex128)
+        
+        #Open the existing arrays if they match the stack otherwise start afresh
+        self.arrays = {}
+        recreated = False
+        for name, (shape, dtype) in shapes.items():
+            fileName = os.path.join(directory, name + '.npy')
+            tmpArray = np.load(fileName, mmap_mode='r+') if os.path.exists(fileName) else None
+            if tmpArray is None or tmpArray.shape != shape or tmpArray.dtype != dtype:
+                tmpArray = np.lib.format.open_memmap(fileName, mode='w+', dtype=dtype, shape=shape)
+                recreated = True
+            self.arrays[name] = tmpArray
+        #Drop any arrays left from a stack producing other outputs so they are not loaded as ours
+        for fileName in os.listdir(directory):
+            if fileName.endswith('.npy') and fileName[:-4] not in shapes:
+                os.remove(os.path.join(directory, fileName))
+        #A store left from a different stack has nothing we can use
+        keyFileName = os.path.join(directory, 'stackKey.txt')
+        if stackKey is not None:
+            if not os.path.exists(keyFileName) or open(keyFileName).read() != stackKey:
+                recreated = True
+        
+        #If any of the arrays had to be recreated then none of the sequences can be trusted as done
+        if recreated:
+            self.arrays['done'][:] = False
+            self.arrays['done'].flush()
+        
+        if stackKey is not None and recreated:
+            with open(keyFileName, 'w') as keyFile:
+                keyFile.write(stackKey)
+            
+    @property
+    def done(self):
+        return self.arrays['done']
+    
+    def record(self, seqct, result):
+        '''
+        Write a result (as selected by the store's outputs) for a sequence and mark it done.  Outputs the store has no array for must be None.
+        '''
+        if self.outputs == 'measurement':
+            result = (result, None, None)
+        elif self.outputs == 'rhoOut':
+            result = (None, None, result)
+        for name, tmpResult in zip(('measurements', 'props', 'rhos'), result):
+            if name in self.arrays:
+                self.arrays[name][seqct] = tmpResult
+            else:
+                assert tmpResult is None, 'Oops! The result store has no room for the {0}.'.format(name)
+        self.arrays['done'][seqct] = True
+        
+    def flush(self):
+        '''
+        Flush the arrays to disk.  The done flags go last so they never get ahead of the data.
+        '''
+        for name, tmpArray in self.arrays.items():
+            if name != 'done':
+                tmpArray.flush()
+        self.arrays['done'].flush()
+        
+    def results(self):
+        '''
+        The stored results in the same form simulate_sequence_stack returns them, with None for outputs the stack doesn't produce.
+        '''
+        if self.outputs == 'measurement':
+            return self.arrays['measurements']
+        elif self.outputs == 'rhoOut':
+            return self.arrays['rhos']
+        else:
+            return self.arrays.get('measurements'), self.arrays['props'], self.arrays.get('rhos')
     
-    pbar.finish()
+    @classmethod
+    def attach(cls, directory, outputs='all'):
+        '''
+        Map the arrays of an existing store for writing without any of the checks or clean up of opening it, for the workers writing into
+        a store the parent has opened.
+        '''
+        store = cls.__new__(cls)
+        store.directory = directory
+        store.outputs = outputs
+        store.arrays = ResultStore.load(directory, 'r+')
+        return store
     
-    tmpResults = results.get()
+    @staticmethod
+    def load(directory, mmapMode='r'):
+        '''
+        Lazily load the arrays of a store (read-only by default).  Returns a dictionary of memory-mapped arrays keyed by 'done', 'measurements' 
+        and, if they were stored, 'rhos' and 'props'.
+        '''
+        return dict([(fileName[:-4], np.load(os.path.join(directory, fileName), mmap_mode=mmapMode)) for fileName in os.listdir(directory) if fileName.endswith('.npy')])
+
+class SimulationPool(object):
+    '''
+    A reusable pool of worker processes for simulating pulse sequences against one system.  The system is sent to each worker once when the pool
+    is created so each simulate_sequence_stack call only sends the pulse sequences.  Changes to the system after the pool is created are not seen
+    by the workers.  Use it as a context manager or call close() when finished.
+    '''
+    def __init__(self, systemParams, numWorkers=None):
+        self.systemParams = systemParams
+        self.numWorkers = numWorkers if numWorkers is not None else multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(self.numWorkers, initializer=_init_worker, initargs=(systemParams,))
+        
+    def _iter_chunks(self, pulseSeqs, seqIndices, rhoIn, simType, outputs, sharePrefixes, cache, storeArgs=None):
+        '''
+        Dispatch the sequences at seqIndices to the workers and yield each chunk's list of (index, result) pairs as it finishes.
+        '''
+        costs = dict([(seqct, sequence_cost(pulseSeqs[seqct], self.systemParams, simType)) for seqct in seqIndices])
+        if sharePrefixes:
+            #Setup a partial function that only takes the group
+            partial_simulate_chunk = partial(_simulate_prefix_tree_in_worker, rhoIn=rhoIn, simType=simType, outputs=outputs, cache=cache, storeArgs=storeArgs)
+            
+            #A group costs about as much as its longest sequence so dispatch the groups in that order
+            groups = {}
+            for seqct in seqIndices:
+                groups.setdefault(frame_key(pulseSeqs[seqct]), []).append(seqct)
+            #Break the groups holding more than their share of the work into subtrees for several workers
+            groupCosts = [max([costs[seqct] for seqct in tmpGroup]) for tmpGroup in groups.values()]
+            chunks = []
+            for tmpGroup, groupCost in zip(groups.values(), groupCosts):
+                numParts = int(round(self.numWorkers*groupCost/sum(groupCosts)))
+                if numParts > 1:
+                    chunks.extend([[tmpGroup[tmpct] for tmpct in tmpPart] for tmpPart in split_prefix_tree([pulseSeqs[seqct] for seqct in tmpGroup], numParts)])
+                else:
+                    chunks.append(tmpGroup)
+            chunks = sorted(chunks, key=lambda tmpChunk: max([costs[seqct] for seqct in tmpChunk]), reverse=True)
+        else:
+            #Setup a partial function that only takes the chunk
+            partial_simulate_chunk = partial(_simulate_chunk_in_worker, rhoIn=rhoIn, simType=simType, outputs=outputs, cache=cache, storeArgs=storeArgs)
+            
+            #Batch the sequences into chunks by estimated cost with the expensive ones dispatched first 
+            chunks = [[seqIndices[tmpct] for tmpct in tmpChunk] for tmpChunk in schedule_chunks([costs[seqct] for seqct in seqIndices], self.numWorkers)]
+        
+        for chunkResults in self.pool.imap_unordered(partial_simulate_chunk, [[(seqct, pulseSeqs[seqct]) for seqct in tmpChunk] for tmpChunk in chunks]):
+            yield chunkResults
+        
+    def iter_sequence_stack(self, pulseSeqs, rhoIn, simType='unitary', ordered=True, outputs='all', sharePrefixes=False, cache=None):
+        '''
+        Generator yielding (index, result) pairs as the pulse sequences finish on the pool, where the result is selected by outputs (see 
+        select_outputs).  With ordered=True the results come out in sequence order; results finished ahead of their turn are held until then.
+        With sharePrefixes=True the sequences are grouped by frame_key and each group is simulated as one prefix tree on a worker (see 
+        simulate_prefix_tree), with large groups broken into subtrees for several workers (see split_prefix_tree).  The prefix trees use the 
+        Python step propagators.
+        Given a ResultCache the workers look each sequence up there and store the ones they simulate.
+        '''
+        heldResults = {}
+        nextSeq = 0
+        for chunkResults in self._iter_chunks(pulseSeqs, list(range(len(pulseSeqs))), rhoIn, simType, outputs, sharePrefixes, cache):
+            for seqct, tmpResult in chunkResults:
+                if not ordered:
+                    yield seqct, tmpResult
+                    continue
+                heldResults[seqct] = tmpResult
+                while nextSeq in heldResults:
+                    yield nextSeq, heldResults.pop(nextSeq)
+                    nextSeq += 1
+        
+    def simulate_sequence_stack(self, pulseSeqs, rhoIn, simType='unitary', outputs='all', storeDir=None, sharePrefixes=False, cache=None, sharedOutputs=False):
+        '''
+        Simulate a series of pulse sequences on the pool (see simulate_sequence_stack).
+        '''
+        numSeqs = len(pulseSeqs)
+        
+        #The workers write straight into a result store: either the one asked for or a scratch one in shared memory
+        if sharedOutputs and storeDir is None:
+            if not os.path.isdir('/dev/shm'):
+                warnings.warn('There is no /dev/shm for the shared outputs so they go through a temporary directory on disk.')
+            sharedDir = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        else:
+            sharedDir = None
+        if storeDir is not None or sharedDir is not None:
+            #Size the arrays to what the stack produces: no output states for a unitary simulation without an input state and no measurements without either
+            stateShape = np.shape(rhoIn)[:-2] if rhoIn is not None else None
+            measShape = stateShape+np.shape(self.systemParams.measurement)[:-2] if rhoIn is not None and self.systemParams.measurement is not None else None
+            store = ResultStore(storeDir if storeDir is not None else sharedDir, numSeqs, self.systemParams.dim, simType, outputs, measShape, stateShape, 
+                                stackKey=stack_key(pulseSeqs, self.systemParams, rhoIn, simType))
+            #A fresh id for each stack so the workers never write through mappings left from an earlier store in the same directory
+            storeArgs = (uuid.uuid4().hex, store.directory, outputs)
+            #Only the sequences not already done need simulating
+            seqIndices = list(np.flatnonzero(~store.done))
+        else:
+            storeArgs = None
+            store = None
+            seqIndices = list(range(numSeqs))
+        
+        pbar = ProgressBar(widgets=[Percentage(), Bar(), ETA()], maxval=numSeqs).start()
+        
+        #Put the results back in sequence order as they come in
+        tmpResults = [None]*numSeqs
+        numDone = numSeqs-len(seqIndices)
+        try:
+            for chunkResults in self._iter_chunks(pulseSeqs, seqIndices, rhoIn, simType, outputs, sharePrefixes, cache, storeArgs):
+                for seqct, tmpResult in chunkResults:
+                    tmpResults[seqct] = tmpResult
+                numDone += len(chunkResults)
+                pbar.update(numDone)
+        finally:
+            #Our views of a scratch store stay valid after its files are gone
+            if sharedDir is not None:
+                shutil.rmtree(sharedDir)
+        
+        pbar.finish()
+        
+        if store is not None:
+            store.flush()
+            return store.results()
+        
+        if outputs == 'measurement':
+            return np.array(tmpResults, dtype=np.float64)
+        elif outputs == 'rhoOut':
+            return tmpResults
+                
+        #Extract the measurement results into a numpy array. 
+        measResults = np.array([tmpResult[0] for tmpResult in tmpResults], dtype=np.float64)
+        
+        props = [tmpResult[1] for tmpResult in tmpResults]
             
-    #Extract the measurement results into a numpy array. 
-    measResults = np.array([tmpResult[0] for tmpResult in tmpResults], dtype=np.float64)
+        rhos = [tmpResult[2] for tmpResult in tmpResults]
+        
+        return measResults, props, rhos
     
-    props = [tmpResult[1] for tmpResult in tmpResults]
+    def close(self):
+        '''
+        Shut down the worker processes.
+        '''
+        self.pool.close()
+        self.pool.join()
         
-    rhos = [tmpResult[2] for tmpResult in tmpResults]
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+    
+def iter_sequence_stack(pulseSeqs, systemParams, rhoIn, simType='unitary', ordered=True, outputs='all', pool=None, sharePrefixes=False, cache=None):
+    '''
+    Generator version of simulate_sequence_stack yielding (index, result) pairs as the sequences finish (see SimulationPool.iter_sequence_stack).
+    Without a pool the temporary workers are shut down once the generator is exhausted or closed.
+    '''
+    if pool is not None:
+        assert pool.systemParams is systemParams, 'Oops! The simulation pool was created for a different system.'
+        for tmpResult in pool.iter_sequence_stack(pulseSeqs, rhoIn, simType, ordered, outputs, sharePrefixes, cache):
+            yield tmpResult
+        return
+    
+    with SimulationPool(systemParams) as tmpPool:
+        for tmpResult in tmpPool.iter_sequence_stack(pulseSeqs, rhoIn, simType, ordered, outputs, sharePrefixes, cache):
+            yield tmpResult
+    
+def simulate_sequence_stack(pulseSeqs, systemParams, rhoIn, simType='unitary', pool=None, outputs='all', storeDir=None, sharePrefixes=False, cache=None, sharedOutputs=False):
+    '''
+    Helper function to simulate a series of pusle sequences with parallelization over multiple cores and progress bar output.
+    Pass a SimulationPool for the system to reuse its workers rather than starting a new set for this call.
+    By default returns the measurement results, propagators and output states; outputs='measurement' returns only the array of measurement 
+    results and outputs='rhoOut' only the list of output states, so the propagators are never sent back from the workers.
+    Given a storeDir the results are written to a ResultStore there as they finish and returned as memory-mapped arrays; sequences the store 
+    already has from an earlier (e.g. interrupted) run of the same stack are skipped.
+    Set sharePrefixes for families of sequences with common leading pixels (length sweeps, shared preparations) to propagate each common 
+    prefix once (see simulate_prefix_tree).  The prefix trees always use the Python step propagators, so with the C++ backend sharing 
+    prefixes only pays off when it saves more than the C++ speed up.
+    Given a ResultCache, sequences simulated before are read from it rather than simulated again.
+    With sharedOutputs (or a storeDir) the workers write their results directly into memory-mapped arrays rather than sending them back 
+    through the pool; for sharedOutputs these live in shared memory (/dev/shm) and are returned as arrays in place of the lists.
+    '''
+    if pool is not None:
+        assert pool.systemParams is systemParams, 'Oops! The simulation pool was created for a different system.'
+        return pool.simulate_sequence_stack(pulseSeqs, rhoIn, simType, outputs, storeDir, sharePrefixes, cache, sharedOutputs)
     
-    return measResults, props, rhos
\ No newline at end of file
+    #Setup a pool of worker processes for just this stack
+    with SimulationPool(systemParams) as tmpPool:
+        return tmpPool.simulate_sequence_stack(pulseSeqs, rhoIn, simType, outputs, storeDir, sharePrefixes, cache, sharedOutputs)
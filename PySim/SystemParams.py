@@ -24,6 +24,7 @@ class SystemParams(object):
         self.subSystems = []
         self.interactions = []
         self.Hnat = None
+        #The measurement operator or a stack of them (numMeasurements x dim x dim)
         self.measurement = None
         
     def add_control_ham(self, inphase = None, quadrature = None):
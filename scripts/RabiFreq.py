@@ -48,9 +48,10 @@ for tmpFreq in freqs:
         pulseSeqs.append(tmpPulseSeq)
 
 
-allResults = simulate_sequence_stack(pulseSeqs, systemParams, rhoIn, simType='unitary')
+#Only the measurements are needed and they go to disk as they finish so an interrupted sweep can be restarted
+measResults = simulate_sequence_stack(pulseSeqs, systemParams, rhoIn, simType='unitary', outputs='measurement', storeDir='RabiFreqResults')
 
-measResults = np.reshape(allResults[0], (pulseAmps.size, freqs.size), order='F')
+measResults = np.reshape(np.array(measResults), (pulseAmps.size, freqs.size), order='F')
 
 measResults -= np.tile(np.mean(measResults, axis=0), (pulseAmps.size,1))
 plt.imshow(measResults, cmap=cm.gray, aspect='auto', interpolation='none', extent=[freqs[0]/1e9, freqs[1]/1e9, pulseAmps[-1], pulseAmps[0]], vmin=-0.02, vmax=0.02)
@@ -9,8 +9,8 @@ A simple script for looking at excited state preparation in qutrits with an eye
 from PySim.SystemParams import SystemParams
 from PySim.QuantumSystems import SCQubit, Hamiltonian, Dissipator
 from PySim.PulseSequence import PulseSequence
-from PySim.Simulation import simulate_sequence_stack, simulate_sequence
-from PySim.OptimalControl import optimize_pulse, PulseParams
+from PySim.Simulation import simulate_sequence_stack, simulate_sequence, SimulationPool
+from PySim.OptimalControl import optimize_pulse_sweep, PulseParams
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -38,6 +38,9 @@ We'll vary the Rabi power (but always keep the time to a calibrated pi pulse.  W
 where we have a balance between selectivity and T1 decay
 '''
 
+#Share one set of workers between the three pulse shape sweeps
+simPool = SimulationPool(systemParams)
+
 pulseSeqs = []
 pulseTimes = 1e-9*np.arange(4,100, 2)
 rhoIn = qubit.levelProjector(0)
@@ -52,7 +55,7 @@ for pulseTime in pulseTimes:
     
     pulseSeqs.append(tmpPulseSeq)
 
-SquareResults = simulate_sequence_stack(pulseSeqs, systemParams, rhoIn, simType='lindblad')[0]
+SquareResults = simulate_sequence_stack(pulseSeqs, systemParams, rhoIn, simType='lindblad', pool=simPool)[0]
 
 plt.figure()
 plt.plot(pulseTimes*1e9,SquareResults)
@@ -77,7 +80,7 @@ for ct,pulseTime in enumerate(pulseTimes):
 
     pulseSeqs.append(tmpPulseSeq)
 
-GaussResults = simulate_sequence_stack(pulseSeqs, systemParams, rhoIn, simType='lindblad')[0]
+GaussResults = simulate_sequence_stack(pulseSeqs, systemParams, rhoIn, simType='lindblad', pool=simPool)[0]
 
 plt.plot(pulseTimes*1e9,GaussResults)
 
@@ -102,28 +105,33 @@ for ct,pulseTime in enumerate(pulseTimes):
 
     pulseSeqs.append(tmpPulseSeq)
 
-DRAGResults = simulate_sequence_stack(pulseSeqs, systemParams, rhoIn, simType='lindblad')[0]
+DRAGResults = simulate_sequence_stack(pulseSeqs, systemParams, rhoIn, simType='lindblad', pool=simPool)[0]
 
 plt.plot(pulseTimes*1e9,DRAGResults)
 
+simPool.close()
+
 
 '''State to State Optimal Control'''
 numSteps = 100
 pulseTimes = 1e-9*np.arange(3,25,3)
 results = np.zeros_like(pulseTimes)
-for ct, pulseTime in enumerate(pulseTimes): 
-    pulseParams = PulseParams()
-    pulseParams.timeSteps = (pulseTime/numSteps)*np.ones(numSteps)
-    pulseParams.rhoStart = qubit.levelProjector(0)
-    pulseParams.rhoGoal = qubit.levelProjector(1)
-    pulseParams.add_control_line(freq=0, phase=0)
-    pulseParams.add_control_line(freq=0, phase=-pi/2)
-    pulseParams.type = 'state2state'
-
-    #Call the optimization    
-    optimize_pulse(pulseParams, systemParams)
-
+pulseParams = PulseParams()
+pulseParams.timeSteps = np.ones(numSteps)
+pulseParams.rhoStart = qubit.levelProjector(0)
+pulseParams.rhoGoal = qubit.levelProjector(1)
+pulseParams.add_control_line(freq=0, phase=0)
+pulseParams.add_control_line(freq=0, phase=-pi/2)
+#Optimize directly against the T1 decay
+pulseParams.optimType = 'lindblad'
+
+#Call the optimization for each pulse time warm starting from the previous one
+sweepResults = optimize_pulse_sweep(pulseParams, systemParams, pulseTimes)
+
+for ct, tmpResult in enumerate(sweepResults): 
     #Now test the optimized pulse and make sure it puts all the population in the excited state
+    pulseParams.timeSteps = (tmpResult['duration']/numSteps)*np.ones(numSteps)
+    pulseParams.controlAmps = tmpResult['pulse']
     results[ct] = simulate_sequence(pulseParams, systemParams, pulseParams.rhoStart, simType='lindblad')[0]
     
 plt.plot(pulseTimes*1e9,results,'*')    
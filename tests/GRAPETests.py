@@ -4,15 +4,21 @@ Created on Nov 27, 2011
 @author: cryan
 '''
 import unittest
+import os
+import shutil
+import tempfile
+import threading
 
 from PySim.SystemParams import SystemParams
 from PySim.Simulation import simulate_sequence
-from PySim.QuantumSystems import SCQubit, Hamiltonian
-from PySim.OptimalControl import optimize_pulse, PulseParams
+from PySim.QuantumSystems import SCQubit, Hamiltonian, Dissipator
+from PySim.OptimalControl import optimize_pulse, optimize_pulse_sweep, optimize_gate_set, PulseParams, calc_control_Hams, eval_pulse, eval_derivs, coarsen_time_steps, coarsen_pulse, interpolate_pulse
 
 import numpy as np
 import matplotlib.pyplot as plt
 
+from copy import copy, deepcopy
+
 
 class Test(unittest.TestCase):
 
@@ -56,6 +62,562 @@ class Test(unittest.TestCase):
         assert result > 0.99
         
         
+    def testStoppingRules(self):
+        '''
+        Check the target fidelity and callback stopping rules and the convergence history.
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -100e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 1e-9*np.ones(30)
+        pulseParams.rhoStart = Q1.levelProjector(0)
+        pulseParams.rhoGoal = Q1.levelProjector(1)
+        pulseParams.add_control_line(freq=-Q1.omega)
+        pulseParams.H_int = Hamiltonian(Q1.omega*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'state2state'
+        
+        #Stop once we are good enough
+        pulseParams.targetFidelity = 0.9
+        result = optimize_pulse(pulseParams, systemParams)
+        assert result['stopReason'] == 'targetFidelity'
+        assert 0.9 <= result['fidelity'] < 1 - 1e-6
+        assert result['history']['fidelity'].size == result['numIterations']
+        assert np.all(np.diff(result['history']['time']) >= 0)
+        
+        #Or after a couple of iterations
+        pulseParams.targetFidelity = None
+        pulseParams.startControlAmps = None
+        pulseParams.callback = lambda record: record['iteration'] >= 2
+        result = optimize_pulse(pulseParams, systemParams)
+        assert result['stopReason'] == 'callback'
+        assert result['numIterations'] == 2
+        
+    def testCheckpoint(self):
+        '''
+        Interrupt an optimization and check a second run resumes from the checkpoint.
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -100e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 1e-9*np.ones(30)
+        pulseParams.rhoStart = Q1.levelProjector(0)
+        pulseParams.rhoGoal = Q1.levelProjector(1)
+        pulseParams.add_control_line(freq=-Q1.omega)
+        pulseParams.H_int = Hamiltonian(Q1.omega*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'state2state'
+        
+        tmpDir = tempfile.mkdtemp()
+        try:
+            pulseParams.checkpointFile = os.path.join(tmpDir, 'checkpoint.npz')
+            pulseParams.checkpointInterval = 2
+            
+            #Stop after a few iterations as if we were preempted
+            pulseParams.callback = lambda record: record['iteration'] >= 3
+            result = optimize_pulse(pulseParams, systemParams)
+            assert result['stopReason'] == 'callback'
+            assert os.path.exists(pulseParams.checkpointFile)
+            
+            #Resume and carry on to convergence 
+            pulseParams.callback = None
+            pulseParams.startControlAmps = None
+            result = optimize_pulse(pulseParams, systemParams)
+            assert result['numIterations'] > 3
+            assert result['history']['fidelity'].size == result['numIterations'] - 3
+            assert result['fidelity'] > 0.99
+            
+            #A different problem ignores the checkpoint 
+            pulseParams.rhoGoal = Q1.levelProjector(2)
+            pulseParams.startControlAmps = None
+            pulseParams.maxfun = 1
+            result = optimize_pulse(pulseParams, systemParams)
+            assert result['numIterations'] <= 1
+        finally:
+            shutil.rmtree(tmpDir)
+        
+    def testPulseSweep(self):
+        '''
+        Sweep the duration of an amplitude limited inversion and find the shortest pulse which reaches the target fidelity.
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -100e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 1e-9*np.ones(20)
+        pulseParams.rhoStart = Q1.levelProjector(0)
+        pulseParams.rhoGoal = Q1.levelProjector(1)
+        pulseParams.add_control_line(freq=-Q1.omega, maxAmp=50e6)
+        pulseParams.H_int = Hamiltonian(Q1.omega*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'state2state'
+        pulseParams.startControlAmps = 25e6*np.ones((1,20))
+        
+        #A pi pulse at 50MHz takes at least 10ns so the 4 and 8ns pulses should fail
+        results = optimize_pulse_sweep(pulseParams, systemParams, 1e-9*np.array([16, 4, 8, 32]), targetFidelity=0.99, timeTol=0.5e-9)
+        
+        durations = [tmpResult['duration'] for tmpResult in results]
+        assert durations == sorted(durations)
+        assert 32e-9 not in durations
+        passing = [tmpResult for tmpResult in results if tmpResult['fidelity'] >= 0.99]
+        assert 10e-9 < passing[0]['duration'] < 16e-9
+        assert passing[0]['duration'] - max([tmpResult['duration'] for tmpResult in results if tmpResult['fidelity'] < 0.99]) <= 0.5e-9
+        assert passing[0]['pulse'].shape == (1, 20)
+        assert np.all(np.abs(passing[0]['pulse']) <= 50e6*(1+1e-6))
+        
+    def testGateSet(self):
+        '''
+        Optimize X180 and X90 gates on two time grids together against one system.
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -150e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        
+        gateParams = []
+        for Ugoal, numPoints, rotation in [(Q1.pauliX, 30, 0.5), ((np.diag([1,1,0]) - 1j*Q1.pauliX)/np.sqrt(2), 20, 0.25)]:
+            pulseParams = PulseParams()
+            pulseParams.timeSteps = 0.5e-9*np.ones(numPoints)
+            pulseParams.Ugoal = Ugoal
+            pulseParams.add_control_line(freq=-Q1.omega, maxAmp=200e6)
+            pulseParams.add_control_line(freq=-Q1.omega, phase=-np.pi/2, maxAmp=200e6)
+            pulseParams.H_int = Hamiltonian((Q1.omega)*np.diag(np.arange(Q1.dim)))
+            pulseParams.optimType = 'unitary'
+            tmpGauss = np.exp(-np.linspace(-2,2,numPoints)**2)
+            tmpScale = rotation/(np.sum(pulseParams.timeSteps*tmpGauss))
+            pulseParams.startControlAmps = np.vstack((tmpScale*tmpGauss, np.zeros(numPoints)))
+            gateParams.append(pulseParams)
+        
+        results = optimize_gate_set(gateParams, systemParams, numWorkers=2)
+        
+        assert len(results) == 2
+        for pulseParams, result in zip(gateParams, results):
+            assert result['fidelity'] > 0.999
+            assert pulseParams.controlAmps.shape == (2, pulseParams.numTimeSteps)
+            Usim = simulate_sequence(pulseParams, systemParams, simType='unitary')[1]
+            assert np.abs(np.trace(np.dot(Usim.conj().T, pulseParams.Ugoal)))**2/np.abs(np.trace(np.dot(pulseParams.Ugoal.conj().T, pulseParams.Ugoal)))**2 > 0.999
+        
+    def testConcurrentOptimizations(self):
+        '''
+        Run two inversions in threads against one shared system and check the system and the pulse parameters besides the outputs are left untouched. 
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -100e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.measurement = Q1.levelProjector(1)
+        systemParams.create_full_Ham()
+        origHnat = np.copy(systemParams.Hnat.matrix)
+        
+        allParams = []
+        for numPoints in [30, 40]:
+            pulseParams = PulseParams()
+            pulseParams.timeSteps = 1e-9*np.ones(numPoints)
+            pulseParams.rhoStart = Q1.levelProjector(0)
+            pulseParams.rhoGoal = Q1.levelProjector(1)
+            pulseParams.add_control_line(freq=-Q1.omega)
+            pulseParams.H_int = Hamiltonian(Q1.omega*np.diag(np.arange(Q1.dim)))
+            pulseParams.optimType = 'state2state'
+            allParams.append(pulseParams)
+        origParams = [dict(pulseParams.__dict__) for pulseParams in allParams]
+        
+        threads = [threading.Thread(target=optimize_pulse, args=(pulseParams, systemParams)) for pulseParams in allParams]
+        for tmpThread in threads:
+            tmpThread.start()
+        for tmpThread in threads:
+            tmpThread.join()
+        
+        assert np.array_equal(systemParams.Hnat.matrix, origHnat)
+        for pulseParams, origDict in zip(allParams, origParams):
+            #Nothing besides the outputs is added or replaced
+            assert set(pulseParams.__dict__.keys()) == set(origDict.keys())
+            for key, value in origDict.items():
+                if key not in ['controlAmps', 'driveAmps', 'startControlAmps']:
+                    assert pulseParams.__dict__[key] is value, key
+            assert np.allclose(np.sum(pulseParams.timeSteps), 1e-9*pulseParams.numTimeSteps)
+            result = simulate_sequence(pulseParams, systemParams, pulseParams.rhoStart, simType='unitary')[0]
+            assert result > 0.99
+        
+    def testRobustInversion(self):
+        '''
+        Optimize the inversion over an ensemble of qubit detunings and drive amplitude errors and check each member is inverted. 
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -100e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        systemParams.measurement = Q1.levelProjector(1)
+        
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 1e-9*np.ones(30)
+        pulseParams.rhoStart = Q1.levelProjector(0)
+        pulseParams.rhoGoal = Q1.levelProjector(1)
+        pulseParams.add_control_line(freq=-Q1.omega)
+        pulseParams.H_int = Hamiltonian(Q1.omega*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'state2state'
+        
+        #Detuned copies of the system with +/-5% drive amplitude errors
+        members = []
+        for detuning in [-2e6, 0, 2e6]:
+            tmpSystem = deepcopy(systemParams)
+            tmpSystem.Hnat = Hamiltonian(systemParams.Hnat.matrix + detuning*Q1.numberOp)
+            for ampScale in [0.95, 1.05]:
+                pulseParams.add_ensemble_member(tmpSystem, ampScale=ampScale)
+                members.append((tmpSystem, ampScale))
+        
+        optimize_pulse(pulseParams, systemParams)
+        
+        #Each member should be inverted
+        optimAmps = pulseParams.controlAmps
+        for tmpSystem, ampScale in members:
+            pulseParams.controlAmps = ampScale*optimAmps
+            result = simulate_sequence(pulseParams, tmpSystem, pulseParams.rhoStart, simType='unitary')[0]
+            assert result > 0.98
+        
+    def testLindbladInversion(self):
+        '''
+        Optimize the excited state preparation directly against T1 decay and check it beats a closed system optimized pulse.
+        '''
+        Q1 = SCQubit(3, 0e9, -100e6, name='Q1', T1=50e-9)
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        systemParams.measurement = Q1.levelProjector(1)
+        systemParams.dissipators = [Dissipator(Q1.T1Dissipator)]
+        
+        results = {}
+        for optimType in ['state2state', 'lindblad']:
+            pulseParams = PulseParams()
+            pulseParams.timeSteps = 0.25e-9*np.ones(24)
+            pulseParams.rhoStart = Q1.levelProjector(0)
+            pulseParams.rhoGoal = Q1.levelProjector(1)
+            pulseParams.add_control_line(freq=0, phase=0)
+            pulseParams.add_control_line(freq=0, phase=-np.pi/2)
+            pulseParams.optimType = optimType
+            pulseParams.startControlAmps = np.vstack((1e8*np.ones(24), np.zeros(24)))
+            
+            optimize_pulse(pulseParams, systemParams)
+            
+            results[optimType] = simulate_sequence(pulseParams, systemParams, pulseParams.rhoStart, simType='lindblad')[0]
+
+        assert results['lindblad'] > 0.95
+        assert results['lindblad'] > results['state2state']
+        
+    def testNewton(self):
+        '''
+        Use the trust-region Newton optimizer with exact Hessian-vector products to find a high fidelity unitary inversion with amplitude bounds. 
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -150e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        
+        numPoints = 30
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 0.5e-9*np.ones(numPoints)
+        pulseParams.rhoStart = Q1.levelProjector(0)
+        pulseParams.Ugoal = Q1.pauliX
+        pulseParams.add_control_line(freq=-Q1.omega, maxAmp=200e6)
+        pulseParams.add_control_line(freq=-Q1.omega, phase=-np.pi/2, maxAmp=200e6)
+        pulseParams.H_int = Hamiltonian((Q1.omega)*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'unitary'
+        pulseParams.optimMethod = 'newton'
+        
+        #Start with a Gaussian
+        tmpGauss = np.exp(-np.linspace(-2,2,numPoints)**2)
+        tmpScale = 0.5/(np.sum(pulseParams.timeSteps*tmpGauss))
+        pulseParams.startControlAmps = np.vstack((tmpScale*tmpGauss, np.zeros(numPoints)))
+        
+        optimize_pulse(pulseParams, systemParams)
+        
+        assert np.all(np.abs(pulseParams.controlAmps) <= 200e6*(1+1e-6))
+        result = simulate_sequence(pulseParams, systemParams, pulseParams.rhoStart, simType='unitary')
+        assert np.abs(np.trace(np.dot(result[1].conj().T, pulseParams.Ugoal)))**2/4 > 0.9999
+        
+    def testSubspace(self):
+        '''
+        Optimize a qubit inversion on a three level SCQubit propagating only the computational subspace and check it agrees with the full propagation. 
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -150e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        
+        numPoints = 30
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 0.5e-9*np.ones(numPoints)
+        pulseParams.Ugoal = Q1.pauliX
+        pulseParams.subspace = np.diag([1,1,0])
+        pulseParams.add_control_line(freq=-Q1.omega, maxAmp=200e6)
+        pulseParams.add_control_line(freq=-Q1.omega, phase=-np.pi/2, maxAmp=200e6)
+        pulseParams.H_int = Hamiltonian((Q1.omega)*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'unitary'
+        pulseParams.derivType = 'exact'
+        
+        #Start with a Gaussian
+        tmpGauss = np.exp(-np.linspace(-2,2,numPoints)**2)
+        tmpScale = 0.5/(np.sum(pulseParams.timeSteps*tmpGauss))
+        pulseParams.startControlAmps = np.vstack((tmpScale*tmpGauss, np.zeros(numPoints)))
+        
+        optimize_pulse(pulseParams, systemParams)
+        
+        #The basis is only set on the optimizer's internal copy
+        assert pulseParams.subspaceBasis is None
+        result = simulate_sequence(pulseParams, systemParams, simType='unitary')
+        assert np.abs(np.trace(np.dot(result[1].conj().T, pulseParams.Ugoal)))**2/4 > 0.999
+        
+        #The subspace fidelity and derivatives at the starting pulse match the full propagation
+        controlHams = calc_control_Hams(pulseParams, systemParams)
+        pulseParams.controlAmps = pulseParams.startControlAmps
+        pulseParams.dimC2 = 4
+        for derivType in ['exact', 'approx']:
+            pulseParams.derivType = derivType
+            pulseParams.subspaceBasis = np.eye(3)[:, :2]
+            subspaceResults = (eval_pulse(pulseParams, systemParams, controlHams), eval_derivs(pulseParams, systemParams, controlHams))
+            pulseParams.subspaceBasis = None
+            fullResults = (eval_pulse(pulseParams, systemParams, controlHams), eval_derivs(pulseParams, systemParams, controlHams))
+            assert np.allclose(subspaceResults[0], fullResults[0])
+            assert np.allclose(subspaceResults[1], fullResults[1], atol=1e-6*np.max(np.abs(fullResults[1])))
+        
+    def testKrotov(self):
+        '''
+        Use the Krotov sequential update optimizer to find a unitary inversion with amplitude bounds. 
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -150e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        
+        numPoints = 30
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 0.5e-9*np.ones(numPoints)
+        pulseParams.rhoStart = Q1.levelProjector(0)
+        pulseParams.Ugoal = Q1.pauliX
+        pulseParams.add_control_line(freq=-Q1.omega, maxAmp=200e6)
+        pulseParams.add_control_line(freq=-Q1.omega, phase=-np.pi/2, maxAmp=200e6)
+        pulseParams.H_int = Hamiltonian((Q1.omega)*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'unitary'
+        pulseParams.optimMethod = 'krotov'
+        
+        #Start with a Gaussian
+        tmpGauss = np.exp(-np.linspace(-2,2,numPoints)**2)
+        tmpScale = 0.5/(np.sum(pulseParams.timeSteps*tmpGauss))
+        pulseParams.startControlAmps = np.vstack((tmpScale*tmpGauss, np.zeros(numPoints)))
+        
+        optimize_pulse(pulseParams, systemParams)
+        
+        assert np.all(np.abs(pulseParams.controlAmps) <= 200e6*(1+1e-6))
+        result = simulate_sequence(pulseParams, systemParams, pulseParams.rhoStart, simType='unitary')
+        assert np.abs(np.trace(np.dot(result[1].conj().T, pulseParams.Ugoal)))**2/4 > 0.999
+        
+    def testBasis(self):
+        '''
+        Optimize the coefficients of a few Fourier basis functions rather than the pixels for a unitary inversion. 
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -150e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        
+        numPoints = 100
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 0.15e-9*np.ones(numPoints)
+        pulseParams.rhoStart = Q1.levelProjector(0)
+        pulseParams.Ugoal = Q1.pauliX
+        pulseParams.add_control_line(freq=-Q1.omega, maxAmp=200e6)
+        pulseParams.add_control_line(freq=-Q1.omega, phase=-np.pi/2, maxAmp=200e6)
+        pulseParams.H_int = Hamiltonian((Q1.omega)*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'unitary'
+        pulseParams.basis = 'fourier'
+        pulseParams.numBasis = 8
+        
+        #Start with a Gaussian
+        tmpGauss = np.exp(-np.linspace(-2,2,numPoints)**2)
+        tmpScale = 0.5/(np.sum(pulseParams.timeSteps*tmpGauss))
+        pulseParams.startControlAmps = np.vstack((tmpScale*tmpGauss, np.zeros(numPoints)))
+        
+        optimize_pulse(pulseParams, systemParams)
+        
+        #The pulse should be a combination of the basis functions
+        basisMat = np.sin(np.pi*np.outer(np.arange(0.5, numPoints)/numPoints, np.arange(1, 9)))
+        fitCoeffs = np.linalg.lstsq(basisMat, pulseParams.controlAmps.T, rcond=None)[0]
+        assert np.allclose(np.dot(basisMat, fitCoeffs), pulseParams.controlAmps.T, atol=1e-3*200e6)
+        
+        assert np.all(np.abs(pulseParams.controlAmps) <= 200e6*(1+1e-6))
+        result = simulate_sequence(pulseParams, systemParams, pulseParams.rhoStart, simType='unitary')
+        assert np.abs(np.trace(np.dot(result[1].conj().T, pulseParams.Ugoal)))**2/4 > 0.999
+        
+    def testEvolution(self):
+        '''
+        Use the gradient free differential evolution optimizer over a few basis coefficients to prepare the excited state.
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -100e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.measurement = Q1.levelProjector(1)
+        systemParams.create_full_Ham()
+
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 1e-9*np.ones(40)
+        pulseParams.rhoStart = Q1.levelProjector(0)
+        pulseParams.rhoGoal = Q1.levelProjector(1)
+        pulseParams.add_control_line(freq=-Q1.omega, maxAmp=100e6)
+        pulseParams.H_int = Hamiltonian(Q1.omega*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'state2state'
+        pulseParams.optimMethod = 'evolution'
+        pulseParams.basis = 'fourier'
+        pulseParams.numBasis = 4
+        pulseParams.targetFidelity = 0.99
+        pulseParams.maxfun = 20000
+        pulseParams.seed = 1
+
+        result = optimize_pulse(pulseParams, systemParams)
+
+        assert result['stopReason'] == 'targetFidelity'
+        assert np.all(np.abs(pulseParams.controlAmps) <= 100e6*(1+1e-6))
+        result = simulate_sequence(pulseParams, systemParams, pulseParams.rhoStart, simType='unitary')[0]
+        assert result > 0.98
+
+    def testMultigrid(self):
+        '''
+        Use coarse-to-fine multigrid optimization for a bandwidth limited unitary inversion.
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -150e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        
+        numPoints = 120
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 0.125e-9*np.ones(numPoints)
+        pulseParams.rhoStart = Q1.levelProjector(0)
+        pulseParams.Ugoal = Q1.pauliX
+        pulseParams.add_control_line(freq=-Q1.omega, bandwidth=300e6, maxAmp=200e6)
+        pulseParams.add_control_line(freq=-Q1.omega, phase=-np.pi/2, bandwidth=300e6, maxAmp=200e6)
+        pulseParams.H_int = Hamiltonian((Q1.omega)*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'unitary'
+        pulseParams.numGridLevels = 3
+        
+        #Start with a Gaussian
+        tmpGauss = np.exp(-np.linspace(-2,2,numPoints)**2)
+        tmpScale = 0.5/(np.sum(pulseParams.timeSteps*tmpGauss))
+        pulseParams.startControlAmps = np.vstack((tmpScale*tmpGauss, np.zeros(numPoints)))
+        
+        optimize_pulse(pulseParams, systemParams)
+        
+        assert pulseParams.controlAmps.shape == (2, numPoints)
+        result = simulate_sequence(pulseParams, systemParams, pulseParams.rhoStart, simType='unitary')
+        assert np.abs(np.trace(np.dot(result[1].conj().T, pulseParams.Ugoal)))**2/4 > 0.999
+
+    def testMultigridFiltered(self):
+        '''
+        Multigrid optimization through the bandwidth filters: the coarse levels should warm start the drive so the filters are applied only once.
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -150e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+
+        numPoints = 120
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 0.125e-9*np.ones(numPoints)
+        pulseParams.rhoStart = Q1.levelProjector(0)
+        pulseParams.Ugoal = Q1.pauliX
+        pulseParams.add_control_line(freq=-Q1.omega, bandwidth=300e6, maxAmp=200e6)
+        pulseParams.add_control_line(freq=-Q1.omega, phase=-np.pi/2, bandwidth=300e6, maxAmp=200e6)
+        pulseParams.H_int = Hamiltonian((Q1.omega)*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'unitary'
+        pulseParams.filterControls = True
+        pulseParams.numGridLevels = 3
+
+        #Start with a Gaussian
+        tmpGauss = np.exp(-np.linspace(-2,2,numPoints)**2)
+        tmpScale = 0.5/(np.sum(pulseParams.timeSteps*tmpGauss))
+        pulseParams.startControlAmps = np.vstack((tmpScale*tmpGauss, np.zeros(numPoints)))
+
+        #Solving directly on the coarse grid gives the drive the finer level should start from
+        coarseParams = copy(pulseParams)
+        coarseParams.timeSteps = coarsen_time_steps(pulseParams.timeSteps)
+        coarseParams.startControlAmps = coarsen_pulse(pulseParams.startControlAmps, pulseParams.timeSteps)
+        coarseParams.numGridLevels = 2
+        optimize_pulse(coarseParams, systemParams)
+
+        optimize_pulse(pulseParams, systemParams)
+
+        #The start pulse of the fine level is the interpolated coarse drive not the filtered controls
+        assert np.allclose(pulseParams.startControlAmps, interpolate_pulse(coarseParams.driveAmps, coarseParams.timeSteps, pulseParams.timeSteps))
+        assert not np.allclose(pulseParams.startControlAmps, interpolate_pulse(coarseParams.controlAmps, coarseParams.timeSteps, pulseParams.timeSteps))
+        assert pulseParams.controlAmps.shape == (2, numPoints)
+        result = simulate_sequence(pulseParams, systemParams, pulseParams.rhoStart, simType='unitary')
+        assert np.abs(np.trace(np.dot(result[1].conj().T, pulseParams.Ugoal)))**2/4 > 0.999
+
+    def testFilteredControls(self):
+        '''
+        Optimize a unitary inversion through a causal FIR channel filter and check the system sees the filtered drive. 
+        '''
+        Q1 = SCQubit(3, 4.987456e9, -150e6, name='Q1')
+        systemParams = SystemParams()
+        systemParams.add_sub_system(Q1)
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.add_control_ham(inphase = Hamiltonian(0.5*(Q1.loweringOp + Q1.raisingOp)), quadrature = Hamiltonian(0.5*(-1j*Q1.loweringOp + 1j*Q1.raisingOp)))
+        systemParams.create_full_Ham()
+        
+        #An exponential decay over a few time steps
+        impulseResponse = np.exp(-np.arange(8)/2.0)
+        impulseResponse /= np.sum(impulseResponse)
+        
+        numPoints = 60
+        pulseParams = PulseParams()
+        pulseParams.timeSteps = 0.25e-9*np.ones(numPoints)
+        pulseParams.rhoStart = Q1.levelProjector(0)
+        pulseParams.Ugoal = Q1.pauliX
+        pulseParams.add_control_line(freq=-Q1.omega, maxAmp=60e6, impulseResponse=impulseResponse)
+        pulseParams.add_control_line(freq=-Q1.omega, phase=-np.pi/2, maxAmp=60e6, impulseResponse=impulseResponse)
+        pulseParams.H_int = Hamiltonian((Q1.omega)*np.diag(np.arange(Q1.dim)))
+        pulseParams.optimType = 'unitary'
+        pulseParams.filterControls = True
+        
+        #Start with a Gaussian
+        tmpGauss = np.exp(-np.linspace(-2,2,numPoints)**2)
+        tmpScale = 0.5/(np.sum(pulseParams.timeSteps*tmpGauss))
+        pulseParams.startControlAmps = np.vstack((tmpScale*tmpGauss, np.zeros(numPoints)))
+        
+        optimize_pulse(pulseParams, systemParams)
+        
+        #The bounds are on the drive and the control amplitudes are the filtered drive
+        assert np.all(np.abs(pulseParams.driveAmps) <= 60e6*(1+1e-6))
+        for controlct in range(2):
+            assert np.allclose(np.convolve(pulseParams.driveAmps[controlct], impulseResponse)[:numPoints], pulseParams.controlAmps[controlct], atol=1e-6*60e6)
+        
+        result = simulate_sequence(pulseParams, systemParams, pulseParams.rhoStart, simType='unitary')
+        assert np.abs(np.trace(np.dot(result[1].conj().T, pulseParams.Ugoal)))**2/4 > 0.999
+        
     def testDRAG(self):
         '''
         Try a unitary inversion pulse on a three level SCQuibt and see if we get something close to DRAG
@@ -5,6 +5,9 @@ Created on Nov 7, 2011
 '''
 
 import unittest
+import os
+import shutil
+import tempfile
 
 import numpy as np
 
@@ -14,8 +17,9 @@ import matplotlib.pyplot as plt
 
 from PySim.SystemParams import SystemParams
 from PySim.PulseSequence import PulseSequence
-from PySim.Simulation import simulate_sequence_stack, simulate_sequence
+from PySim.Simulation import simulate_sequence_stack, simulate_sequence, simulate_trajectory, simulate_process, iter_sequence_stack, SimulationPool, ResultStore, ResultCache, sequence_cost, schedule_chunks, simulate_prefix_tree, split_prefix_tree
 from PySim.QuantumSystems import SCQubit, Hamiltonian, Dissipator
+from PySim.Evolution import sub_steps, num_sub_steps
 
 
 class SingleQubit(unittest.TestCase):
@@ -36,6 +40,18 @@ class SingleQubit(unittest.TestCase):
         
         #Define the initial state as the ground state
         self.rhoIn = self.qubit.levelProjector(0)
+        
+        #A Rabi stack of single square pulses in the rotating frame, one for each pulse length
+        self.rabiSeqs = []
+        for pulseLength in self.pulseLengths:
+            tmpPulseSeq = PulseSequence()
+            tmpPulseSeq.add_control_line(freq=0e9, phase=0)
+            tmpPulseSeq.controlAmps = self.rabiFreq*np.array([[1]], dtype=np.float64)
+            tmpPulseSeq.timeSteps = np.array([pulseLength])
+            tmpPulseSeq.maxTimeStep = pulseLength
+            tmpPulseSeq.H_int = None
+            
+            self.rabiSeqs.append(tmpPulseSeq)
 
     def tearDown(self):
         pass
@@ -46,17 +62,7 @@ class SingleQubit(unittest.TestCase):
         Test Rabi oscillations in the rotating frame, i.e. with zero drift Hamiltonian drive frequency of zero.
         '''
         
-        #Setup the pulseSequences
-        pulseSeqs = []
-        for pulseLength in self.pulseLengths:
-            tmpPulseSeq = PulseSequence()
-            tmpPulseSeq.add_control_line(freq=0e9, phase=0)
-            tmpPulseSeq.controlAmps = self.rabiFreq*np.array([[1]], dtype=np.float64)
-            tmpPulseSeq.timeSteps = np.array([pulseLength])
-            tmpPulseSeq.maxTimeStep = pulseLength
-            tmpPulseSeq.H_int = None
-            
-            pulseSeqs.append(tmpPulseSeq)
+        pulseSeqs = self.rabiSeqs
         
         results = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, simType='unitary')[0]
         expectedResults = np.cos(2*pi*self.rabiFreq*self.pulseLengths)
@@ -72,6 +78,300 @@ class SingleQubit(unittest.TestCase):
 
         np.testing.assert_allclose(results, expectedResults , atol = 1e-4)
 
+    def testMultipleMeasurements(self):
+        '''
+        Test measuring a stack of observables on Rabi oscillations.
+        '''
+        self.systemParams.measurement = np.array([self.qubit.pauliZ, self.qubit.pauliX, self.qubit.levelProjector(0)])
+        pulseSeqs = self.rabiSeqs
+        
+        results = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, simType='unitary')[0]
+        self.assertEqual(results.shape, (len(pulseSeqs), 3))
+        expectedResults = np.cos(2*pi*self.rabiFreq*self.pulseLengths)
+        np.testing.assert_allclose(results[:,0], expectedResults, atol = 1e-4)
+        np.testing.assert_allclose(results[:,1], 0, atol = 1e-4)
+        np.testing.assert_allclose(results[:,2], 0.5*(1+expectedResults), atol = 1e-4)
+        
+        #The measurement array fits in a result store too
+        with SimulationPool(self.systemParams, 2) as simPool:
+            sharedResults = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, pool=simPool, outputs='measurement', sharedOutputs=True)
+        np.testing.assert_allclose(sharedResults, results, atol = 1e-12)
+
+    def testMultipleInputStates(self):
+        '''
+        Test a stack of input states sharing one propagation and the process matrices of a pi pulse.
+        '''
+        tmpPulseSeq = PulseSequence()
+        tmpPulseSeq.add_control_line(freq=0e9, phase=0)
+        tmpPulseSeq.controlAmps = self.rabiFreq*np.array([[1]], dtype=np.float64)
+        tmpPulseSeq.timeSteps = np.array([30e-9])
+        tmpPulseSeq.maxTimeStep = 30e-9
+        tmpPulseSeq.H_int = None
+        
+        rhoIns = np.array([self.qubit.levelProjector(0), self.qubit.levelProjector(1)])
+        expectedResults = np.cos(2*pi*self.rabiFreq*30e-9)*np.array([1,-1])
+        np.testing.assert_allclose(simulate_sequence(tmpPulseSeq, self.systemParams, rhoIns, 'unitary')[0], expectedResults, atol = 1e-4)
+        self.systemParams.dissipators = [Dissipator(self.qubit.T1Dissipator)]
+        measOut, totProp, rhoOut = simulate_sequence(tmpPulseSeq, self.systemParams, rhoIns, 'lindblad')
+        self.assertEqual(rhoOut.shape, (2,2,2))
+        for rhoIn, tmpRhoOut in zip(rhoIns, rhoOut):
+            np.testing.assert_allclose(tmpRhoOut, simulate_sequence(tmpPulseSeq, self.systemParams, rhoIn, 'lindblad')[2], atol = 1e-12)
+        
+        #A pi pulse about X flips Y and Z
+        tmpPulseSeq.timeSteps = np.array([50e-9])
+        tmpPulseSeq.maxTimeStep = 50e-9
+        np.testing.assert_allclose(simulate_process(tmpPulseSeq, self.systemParams, 'unitary', 'ptm'), np.diag([1,1,-1,-1]), atol = 1e-4)
+        choi = simulate_process(tmpPulseSeq, self.systemParams, 'unitary', 'choi')
+        np.testing.assert_allclose(np.linalg.eigvalsh(choi), [0,0,0,2], atol = 1e-8)
+        
+        #With T1 the process is still trace preserving
+        ptm = simulate_process(tmpPulseSeq, self.systemParams, 'lindblad', 'ptm')
+        np.testing.assert_allclose(ptm[0], [1,0,0,0], atol = 1e-8)
+        choi = simulate_process(tmpPulseSeq, self.systemParams, 'lindblad', 'choi')
+        np.testing.assert_allclose(np.einsum('iaja->ij', choi.reshape((2,2,2,2))), np.eye(2), atol = 1e-8)
+
+    def testTrajectory(self):
+        '''
+        Test recording the Rabi oscillations in a single pass through the longest pulse.
+        '''
+        tmpPulseSeq = PulseSequence()
+        tmpPulseSeq.add_control_line(freq=0e9, phase=0)
+        tmpPulseSeq.controlAmps = self.rabiFreq*np.array([[1]], dtype=np.float64)
+        tmpPulseSeq.timeSteps = np.array([100e-9])
+        tmpPulseSeq.maxTimeStep = 1e-9
+        tmpPulseSeq.H_int = None
+        
+        times, results = simulate_trajectory(tmpPulseSeq, self.systemParams, self.rhoIn, decimation=5)
+        self.assertEqual(results.shape, (21,1))
+        np.testing.assert_allclose(times, 5e-9*np.arange(21), atol = 1e-12)
+        np.testing.assert_allclose(results[:,0], np.cos(2*pi*self.rabiFreq*times), atol = 1e-4)
+        
+        #Record the populations of both levels by time step under T1
+        self.systemParams.dissipators = [Dissipator(self.qubit.T1Dissipator)]
+        tmpPulseSeq.controlAmps = self.rabiFreq*np.array([[1, 0, 1]], dtype=np.float64)
+        tmpPulseSeq.timeSteps = np.array([25e-9, 50e-9, 25e-9])
+        times, results = simulate_trajectory(tmpPulseSeq, self.systemParams, self.rhoIn, 'lindblad', [self.qubit.levelProjector(0), self.qubit.levelProjector(1)], byPixel=True)
+        np.testing.assert_allclose(times, [0, 25e-9, 75e-9, 100e-9], atol = 1e-12)
+        np.testing.assert_allclose(np.sum(results, axis=1), 1, atol = 1e-8)
+        times, states = simulate_trajectory(tmpPulseSeq, self.systemParams, self.rhoIn, 'lindblad', 'state', byPixel=True)
+        np.testing.assert_allclose(states[-1], simulate_sequence(tmpPulseSeq, self.systemParams, self.rhoIn, 'lindblad')[2], atol = 1e-8)
+        np.testing.assert_allclose(np.real(states[:,1,1]), results[:,1], atol = 1e-8)
+        
+        #A zero length time step still gets its record by time step and the sub-step count covers the sub-steps
+        tmpPulseSeq.controlAmps = self.rabiFreq*np.array([[1, 0, 1]], dtype=np.float64)
+        tmpPulseSeq.timeSteps = np.array([25e-9, 0, 25e-9])
+        times, results = simulate_trajectory(tmpPulseSeq, self.systemParams, self.rhoIn, 'lindblad', byPixel=True)
+        np.testing.assert_allclose(times, [0, 25e-9, 25e-9, 50e-9], atol = 1e-12)
+        self.assertTrue(50 <= len(list(sub_steps(tmpPulseSeq))) <= num_sub_steps(tmpPulseSeq) <= 52)
+
+    def testSimulationPool(self):
+        '''
+        Test reusing one simulation pool for several stacks on the same system.
+        '''
+        pulseSeqs = self.rabiSeqs
+        
+        expectedResults = np.cos(2*pi*self.rabiFreq*self.pulseLengths)
+        with SimulationPool(self.systemParams, 2) as simPool:
+            resultsUnitary = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, simType='unitary', pool=simPool)[0]
+            resultsReversed = simPool.simulate_sequence_stack(pulseSeqs[::-1], self.rhoIn, simType='unitary')[0]
+        
+        np.testing.assert_allclose(resultsUnitary, expectedResults, atol = 1e-4)
+        np.testing.assert_allclose(resultsReversed, expectedResults[::-1], atol = 1e-4)
+
+    def testIterSequenceStack(self):
+        '''
+        Test streaming the results of a Rabi stack in order, out of order and with only the measurements or output states.
+        '''
+        pulseSeqs = self.rabiSeqs
+        
+        expectedResults = np.cos(2*pi*self.rabiFreq*self.pulseLengths)
+        with SimulationPool(self.systemParams, 2) as simPool:
+            orderedResults = list(iter_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, ordered=True, outputs='measurement', pool=simPool))
+            unorderedResults = sorted(simPool.iter_sequence_stack(pulseSeqs, self.rhoIn, ordered=False, outputs='measurement'))
+            rhos = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, pool=simPool, outputs='rhoOut')
+        
+        self.assertEqual([tmpResult[0] for tmpResult in orderedResults], list(range(len(pulseSeqs))))
+        np.testing.assert_allclose([tmpResult[1] for tmpResult in orderedResults], expectedResults, atol = 1e-4)
+        np.testing.assert_allclose([tmpResult[1] for tmpResult in unorderedResults], expectedResults, atol = 1e-4)
+        np.testing.assert_allclose([np.real(np.trace(np.dot(self.systemParams.measurement, tmpRho))) for tmpRho in rhos], expectedResults, atol = 1e-4)
+
+    def testResultStore(self):
+        '''
+        Test writing a Rabi stack to a result store, resuming a partially done store and loading it back.
+        '''
+        pulseSeqs = self.rabiSeqs
+        
+        expectedResults = np.cos(2*pi*self.rabiFreq*self.pulseLengths)
+        tmpDir = tempfile.mkdtemp()
+        try:
+            storeDir = os.path.join(tmpDir, 'rabi')
+            results = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, storeDir=storeDir)
+            np.testing.assert_allclose(results[0], expectedResults, atol = 1e-4)
+            
+            #Knock out half the results and check a second run only fills those back in 
+            store = ResultStore(storeDir, len(pulseSeqs), self.systemParams.dim)
+            store.done[::2] = False
+            store.arrays['measurements'][::2] = 0
+            store.arrays['measurements'][1::2] = 2
+            store.flush()
+            del store
+            results = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, storeDir=storeDir)
+            np.testing.assert_allclose(results[0][::2], expectedResults[::2], atol = 1e-4)
+            np.testing.assert_allclose(results[0][1::2], 2)
+            del results
+            
+            storedArrays = ResultStore.load(storeDir)
+            self.assertTrue(np.all(storedArrays['done']))
+            self.assertEqual(storedArrays['props'].shape, (len(pulseSeqs), 2, 2))
+            del storedArrays
+            
+            #A different stack of the same size in the same directory starts afresh
+            for tmpPulseSeq in pulseSeqs:
+                tmpPulseSeq.controlAmps = 0.5*tmpPulseSeq.controlAmps
+            results = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, storeDir=storeDir)
+            np.testing.assert_allclose(results[0], np.cos(pi*self.rabiFreq*self.pulseLengths), atol = 1e-4)
+            del results
+            
+            #Without an input state there are only propagators to store
+            measurements, props, rhos = simulate_sequence_stack(pulseSeqs, self.systemParams, None, storeDir=storeDir)
+            self.assertIsNone(measurements)
+            self.assertIsNone(rhos)
+            np.testing.assert_allclose([np.abs(tmpProp[0,0])**2 for tmpProp in props], np.cos(0.5*pi*self.rabiFreq*self.pulseLengths)**2, atol = 1e-4)
+            del props
+            self.assertEqual(sorted(ResultStore.load(storeDir).keys()), ['done', 'props'])
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testPrefixSharing(self):
+        '''
+        Test simulating a length sweep and a shared preparation as prefix trees matches simulating each sequence on its own.
+        '''
+        self.systemParams.dissipators = [Dissipator(self.qubit.T1Dissipator)]
+        numSteps = 20
+        pulseShape = np.sin(np.linspace(0,pi,numSteps))
+        pulseSeqs = []
+        #A length sweep of truncated shaped pulses
+        for numPixels in range(0,numSteps+1,4):
+            tmpPulseSeq = PulseSequence()
+            tmpPulseSeq.add_control_line(freq=0e9, phase=0)
+            tmpPulseSeq.controlAmps = self.rabiFreq*pulseShape[:numPixels].reshape((1,numPixels))
+            tmpPulseSeq.timeSteps = 2e-9*np.ones(numPixels)
+            tmpPulseSeq.maxTimeStep = 1e-9
+            pulseSeqs.append(tmpPulseSeq)
+        #And a common preparation followed by different pulses
+        for pulseAmp in [-1, 0.5, 1]:
+            tmpPulseSeq = PulseSequence()
+            tmpPulseSeq.add_control_line(freq=0e9, phase=0)
+            tmpPulseSeq.controlAmps = self.rabiFreq*np.hstack((pulseShape, pulseAmp*np.ones(3))).reshape((1,numSteps+3))
+            tmpPulseSeq.timeSteps = 2e-9*np.ones(numSteps+3)
+            tmpPulseSeq.maxTimeStep = 1e-9
+            pulseSeqs.append(tmpPulseSeq)
+        
+        for simType in ['unitary', 'lindblad']:
+            treeResults = simulate_prefix_tree(pulseSeqs, self.systemParams, self.rhoIn, simType)
+            stackResults = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, simType, outputs='measurement', sharePrefixes=True)
+            for pulseSeq, treeResult, stackResult in zip(pulseSeqs, treeResults, stackResults):
+                singleResult = simulate_sequence(pulseSeq, self.systemParams, self.rhoIn, simType)
+                np.testing.assert_allclose(treeResult[1], singleResult[1], atol = 1e-8)
+                np.testing.assert_allclose(treeResult[0], singleResult[0], atol = 1e-8)
+                np.testing.assert_allclose(stackResult, singleResult[0], atol = 1e-8)
+        
+        #The length sweep is a chain down to the branch point so it goes along with the first of the three branches
+        groups = split_prefix_tree(pulseSeqs, 3)
+        self.assertEqual(sorted([len(tmpGroup) for tmpGroup in groups]), [1, 1, len(pulseSeqs)-2])
+        self.assertEqual(sorted([seqct for tmpGroup in groups for seqct in tmpGroup]), list(range(len(pulseSeqs))))
+        self.assertTrue(set(range(len(pulseSeqs)-3)) <= set(max(groups, key=len)))
+        self.assertEqual(split_prefix_tree(pulseSeqs[:-3], 3), [list(range(len(pulseSeqs)-3))])
+        
+        #Splitting the group over several workers gives the same results
+        with SimulationPool(self.systemParams, numWorkers=3) as pool:
+            stackResults = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, 'lindblad', pool=pool, outputs='measurement', sharePrefixes=True)
+        np.testing.assert_allclose(stackResults, [tmpResult[0] for tmpResult in treeResults], atol = 1e-8)
+
+    def testResultCache(self):
+        '''
+        Test simulations are read back from the result cache and the cache stays within its size.
+        '''
+        pulseSeqs = self.rabiSeqs
+        
+        expectedResults = np.cos(2*pi*self.rabiFreq*self.pulseLengths)
+        tmpDir = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(tmpDir)
+            results = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, outputs='measurement', cache=cache)
+            np.testing.assert_allclose(results, expectedResults, atol = 1e-4)
+            self.assertEqual(len(os.listdir(tmpDir)), len(pulseSeqs))
+            
+            #Plant a result to check it is what comes back
+            cacheKey = cache.key(pulseSeqs[1], self.systemParams, self.rhoIn, 'unitary')
+            cache.put(cacheKey, (5.0, np.eye(2), self.rhoIn))
+            self.assertEqual(simulate_sequence(pulseSeqs[1], self.systemParams, self.rhoIn, cache=cache)[0], 5.0)
+            #The prefix trees use the Python step propagators so they read and write the Python entries
+            cache.put(cache.key(pulseSeqs[1], self.systemParams, self.rhoIn, 'unitary', 'python'), (5.0, np.eye(2), self.rhoIn))
+            results = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, outputs='measurement', cache=cache, sharePrefixes=True)
+            self.assertEqual(results[1], 5.0)
+            self.assertTrue(cache.key(pulseSeqs[1], self.systemParams, self.rhoIn, 'unitary', 'cpp') != cache.key(pulseSeqs[1], self.systemParams, self.rhoIn, 'unitary', 'python'))
+            
+            #A different input state is a different entry
+            self.assertTrue(cache.key(pulseSeqs[1], self.systemParams, self.qubit.levelProjector(1), 'unitary') != cacheKey)
+            #As is a stack of one input state
+            self.assertTrue(cache.key(pulseSeqs[1], self.systemParams, self.rhoIn[np.newaxis], 'unitary') != cacheKey)
+            
+            #Shrink the cache down to about one entry
+            cache.maxSize = max([os.path.getsize(os.path.join(tmpDir, fileName)) for fileName in os.listdir(tmpDir)])
+            cache.evict()
+            self.assertEqual(len(os.listdir(tmpDir)), 1)
+            
+            #New entries keep it there without explicit evictions
+            for tmpPulseSeq in pulseSeqs[:3]:
+                simulate_sequence(tmpPulseSeq, self.systemParams, 0.5*self.rhoIn, cache=cache)
+            self.assertEqual(len(os.listdir(tmpDir)), 1)
+        finally:
+            shutil.rmtree(tmpDir)
+
+    def testSharedOutputs(self):
+        '''
+        Test the workers writing a lindblad stack straight into shared memory give the same results as sending them back.
+        '''
+        self.systemParams.dissipators = [Dissipator(self.qubit.T1Dissipator)]
+        pulseSeqs = self.rabiSeqs
+        
+        with SimulationPool(self.systemParams, 2) as simPool:
+            measResults, props, rhos = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, simType='lindblad', pool=simPool)
+            sharedResults = simulate_sequence_stack(pulseSeqs, self.systemParams, self.rhoIn, simType='lindblad', pool=simPool, sharedOutputs=True)
+            #The workers move on to the next stack's arrays
+            excitedResults = simulate_sequence_stack(pulseSeqs, self.systemParams, self.qubit.levelProjector(1), 'lindblad', simPool, 'measurement')
+            excitedShared = simulate_sequence_stack(pulseSeqs, self.systemParams, self.qubit.levelProjector(1), 'lindblad', simPool, 'measurement', sharedOutputs=True)
+        
+        np.testing.assert_allclose(excitedShared, excitedResults, atol = 1e-12)
+        self.assertEqual(sharedResults[1].shape, (len(pulseSeqs), 4, 4))
+        np.testing.assert_allclose(sharedResults[0], measResults, atol = 1e-12)
+        np.testing.assert_allclose(sharedResults[1], np.array(props), atol = 1e-12)
+        np.testing.assert_allclose(sharedResults[2], np.array(rhos), atol = 1e-12)
+
+    def testScheduleChunks(self):
+        '''
+        Test the cost model follows the sub-step count and the scheduler sends the expensive sequences out first.
+        '''
+        pulseSeqs = []
+        for pulseLength in self.pulseLengths:
+            tmpPulseSeq = PulseSequence()
+            tmpPulseSeq.add_control_line(freq=0e9, phase=0)
+            tmpPulseSeq.controlAmps = self.rabiFreq*np.array([[1]], dtype=np.float64)
+            tmpPulseSeq.timeSteps = np.array([pulseLength])
+            tmpPulseSeq.maxTimeStep = 1e-9
+            pulseSeqs.append(tmpPulseSeq)
+        
+        costs = np.array([sequence_cost(tmpPulseSeq, self.systemParams, 'unitary') for tmpPulseSeq in pulseSeqs])
+        self.assertEqual(costs[0], 8)
+        self.assertEqual(costs[-1], 101*8)
+        self.assertEqual(sequence_cost(pulseSeqs[-1], self.systemParams, 'lindblad'), 101*64)
+        
+        chunks = schedule_chunks(costs, 2)
+        self.assertEqual(sorted(np.concatenate(chunks)), list(range(len(pulseSeqs))))
+        self.assertEqual(chunks[0][0], len(pulseSeqs)-1)
+        self.assertTrue(len(chunks[-1]) > len(chunks[0]))
+
     def testRabiInteractionFrame(self):
         '''
         Test Rabi oscillations after moving into an interaction frame that is different to the pulsing frame and with an irrational timestep for good measure.